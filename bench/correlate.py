@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+#
+# Compares package correlation in OpenwrtOperation.prepare() against the previous
+# implementation (kept below as a reference), which looked every client alias up
+# in the metadata index one by one.
+#
+# A synthetic packageinfo is indexed the way MetadataIndex does it, and --distinct
+# client manifests of --manifest-size packages each are correlated against it. Each
+# manifest keeps most of the defaults (some of them under another name that provides
+# a default), and installs packages of its own (some of them under an old name whose
+# Provides: exist in the target). Every manifest is correlated by both implementations,
+# which must agree, and then through the memo, as a fleet sending the same manifests would.
+#
+# Usage: bench/correlate.py [--packages N] [--defaults N] [--manifest-size N] [--distinct N] [--repeat N]
+#
+
+import os.path as p
+import sys
+import random
+import sqlite3
+import logging
+import argparse
+import tempfile
+import timeit
+
+sys.path.insert(0, p.join(p.dirname(p.abspath(__file__)), '..'))
+sys.path.insert(0, p.dirname(p.abspath(__file__)))
+
+from upenwrt.metaindex import MetadataIndex, IndexedPackageinfo
+from upenwrt.operation import OpenwrtOperation
+import fixtures
+
+
+def legacy_correlate(client_packages, default_packages, packageinfo):
+	# 0. Load input packages, parse aliases
+	def load_packages(packages):
+		for p in packages:
+			aliases = p.split(',')
+			yield aliases[0], set(aliases[1:])
+	aliases = dict(load_packages(client_packages))
+	packages = set(aliases.keys())
+
+	# 1. correlate default and installed packages using Provides:
+	def correlate_defaults(packages, aliases, src_defaults):
+		for p in packages:
+			# shortcut
+			if p in src_defaults:
+				yield p
+				continue
+
+			correlated = set()
+			for a in aliases[p]:
+				# try to correlate with default packages in source
+				if a in src_defaults:
+					correlated.add(a)
+
+			if len(correlated) > 1:
+				raise RuntimeError(f'OpenwrtOperation: prepare(): package {p} is referenced by more than one alias in defaults: {correlated}')
+			elif correlated:
+				yield correlated.pop()
+			else:
+				yield p
+	packages = set(correlate_defaults(packages, aliases, default_packages))
+
+	user_only_packages = packages - default_packages
+
+	# 2. attempt Provides: substitution for client packages that do not exist in target
+	def correlate_target(packages, aliases, target_packageinfo):
+		for p in packages:
+			# shortcut
+			if p in target_packageinfo.aliases:
+				yield p
+				continue
+
+			correlated = set()
+			for a in aliases.get(p, ()):
+				# try to correlate with packages that exist in target
+				if a in target_packageinfo.aliases:
+					correlated.add(a)
+
+			if len(correlated) > 1:
+				# HACK: if we managed to get into this situation, try to select a single preferred alias that is a substring of package name
+				preferred = { c for c in correlated if c in p }
+				if len(preferred) == 1:
+					yield preferred.pop()
+					continue
+
+				raise RuntimeError(f'OpenwrtOperation: prepare(): package {p} has more than one alias in target: {correlated}')
+			elif correlated:
+				yield correlated.pop()
+			else:
+				yield p
+	return set(correlate_target(user_only_packages, aliases, packageinfo))
+
+
+def make_manifest(rnd, args, defaults):
+	# fixtures.make_packageinfo() gives every fifth package the aliases <name>-alias and <name>-compat
+	defaults = sorted(defaults)
+	kept = rnd.sample(defaults, len(defaults) * 3 // 4)
+	renamed_defaults = kept[:len(kept) // 8]
+	manifest = [ f'{name}-r2,{name}' for name in renamed_defaults ]
+	manifest += kept[len(renamed_defaults):]
+
+	while len(manifest) < args.manifest_size:
+		n = rnd.randrange(args.packages)
+		if f'pkg{n}' in defaults:
+			continue
+		if n % 5 == 0 and rnd.random() < 0.5:
+			manifest.append(f'pkg{n}-old,pkg{n}-alias')
+		else:
+			manifest.append(f'pkg{n}')
+	return manifest
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--packages', type=int, default=8000, help='number of packages in the packageinfo')
+	parser.add_argument('--defaults', type=int, default=80, help='number of default packages of the target and profile')
+	parser.add_argument('--manifest-size', type=int, default=200, help='number of packages in each client manifest')
+	parser.add_argument('--distinct', type=int, default=50, help='number of distinct client manifests')
+	parser.add_argument('--repeat', type=int, default=5)
+	args = parser.parse_args()
+
+	logging.getLogger().setLevel(logging.WARNING)
+	rnd = random.Random(0)
+
+	with tempfile.TemporaryDirectory() as tmp:
+		path = p.join(tmp, '.packageinfo')
+		with open(path, 'w') as f:
+			f.write(fixtures.make_packageinfo(packages=args.packages))
+		db = sqlite3.connect(p.join(tmp, 'packageinfo.sqlite'))
+		with db:
+			MetadataIndex._write_packageinfo(db, path)
+
+		defaults = { f'pkg{n}' for n in rnd.sample(range(args.packages), args.defaults) }
+		manifests = [ make_manifest(rnd, args, defaults) for _ in range(args.distinct) ]
+
+		# the daemon keeps one packageinfo per imagebuilder, and so its memo
+		packageinfo = IndexedPackageinfo(db)
+		for manifest in manifests:
+			legacy = legacy_correlate(manifest, defaults, packageinfo)
+			current = OpenwrtOperation.correlate(manifest, defaults, packageinfo)
+			if legacy != current:
+				raise RuntimeError(f'implementations disagree: {sorted(legacy ^ current)}')
+
+		def run_legacy():
+			for manifest in manifests:
+				legacy_correlate(manifest, defaults, packageinfo)
+
+		def run_current():
+			for manifest in manifests:
+				OpenwrtOperation.correlate(manifest, defaults, packageinfo)
+
+		def run_memoised():
+			for manifest in manifests:
+				packageinfo.memoise(
+					(frozenset(defaults), frozenset(manifest)),
+					lambda: frozenset(OpenwrtOperation.correlate(manifest, defaults, packageinfo)),
+				)
+
+		print(f'{args.distinct} manifests of {args.manifest_size} packages against {args.packages} packages, {args.defaults} defaults')
+		t_legacy = min(timeit.repeat(run_legacy, number=1, repeat=args.repeat)) / len(manifests)
+		t_current = min(timeit.repeat(run_current, number=1, repeat=args.repeat)) / len(manifests)
+		t_memoised = min(timeit.repeat(run_memoised, number=1, repeat=args.repeat)) / len(manifests)
+		print(f'legacy:   {t_legacy * 1e6:9.1f} us/manifest')
+		print(f'current:  {t_current * 1e6:9.1f} us/manifest, speedup {t_legacy / t_current:.1f}x')
+		print(f'memoised: {t_memoised * 1e6:9.1f} us/manifest, speedup {t_legacy / t_memoised:.1f}x')
+
+
+if __name__ == '__main__':
+	main()
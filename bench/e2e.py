@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+#
+# End-to-end benchmark of the daemon against a fake OpenWrt mirror.
+#
+# A local HTTP server plays downloads.openwrt.org, serving a synthetic imagebuilder
+# (generated .targetinfo and .packageinfo, and a stub Makefile whose `make image` sleeps
+# for --build-time seconds and writes a fake sysupgrade image) together with its sha256sums.
+# A bare git repository stands in for openwrt.git. UpenwrtApp then runs in-process in a
+# temporary root directory, and --clients concurrent clients issue --requests requests each
+# against every endpoint in turn. Latency percentiles and throughput are reported per endpoint,
+# followed by the hit rates of the build and package caches.
+# With --dispatch N, the clients talk to a dispatcher in front of N build workers instead,
+# and the cache hit rates are summed over the workers.
+#
+# Usage: bench/e2e.py [--clients N] [--requests N] [--endpoints list,build,jobs] [--variants N]
+#                     [--build-time SECONDS] [--no-source] [--dispatch N] [--keep DIR] [upenwrt options...]
+#
+
+import os
+import os.path as p
+import sys
+import time
+import shutil
+import hashlib
+import logging
+import argparse
+import asyncio
+import tempfile
+import contextlib
+import collections
+import aiohttp
+import aiohttp.web
+import aiohttp.test_utils
+
+sys.path.insert(0, p.join(p.dirname(p.abspath(__file__)), '..'))
+sys.path.insert(0, p.dirname(p.abspath(__file__)))
+
+from upenwrt import util
+from upenwrt.server import UpenwrtContext, UpenwrtApp
+import fixtures
+
+
+TARGET = 'arch0/soc0'
+BOARD = 'vendor0,model0'
+REPO_STATIC = p.join(p.dirname(p.abspath(__file__)), '..', 'root', 'static')
+
+
+def make_mirror(mirrordir, args):
+	targetdir = p.join(mirrordir, 'snapshots', 'targets', TARGET)
+	os.makedirs(targetdir)
+
+	name = f'openwrt-imagebuilder-{TARGET.replace("/", "-")}.Linux-x86_64'
+	path = p.join(targetdir, f'{name}.tar.xz')
+	fixtures.make_imagebuilder(
+		path,
+		name=name,
+		target=TARGET,
+		targetinfo=fixtures.make_targetinfo(),
+		packageinfo=fixtures.make_packageinfo(packages=args.packages),
+		build_time=args.build_time,
+		image_size=args.image_size,
+	)
+
+	h = hashlib.sha256()
+	with open(path, 'rb') as f:
+		for chunk in iter(lambda: f.read(1 << 20), b''):
+			h.update(chunk)
+	with open(p.join(targetdir, 'sha256sums'), 'w') as f:
+		f.write(f'{h.hexdigest()} *{p.basename(path)}\n')
+
+
+def make_rootdir(rootdir, args):
+	# our buildsystem patches do not apply to the fake source tree
+	os.makedirs(p.join(rootdir, 'static', 'patches'))
+	for f in ('README.txt', 'get.sh'):
+		shutil.copy(p.join(REPO_STATIC, f), p.join(rootdir, 'static', f))
+
+	if args.no_source:
+		return None
+	return fixtures.make_source_repo(
+		p.join(rootdir, 'repo', 'openwrt.git'),
+		target=TARGET,
+		targetinfo=fixtures.make_targetinfo(),
+	)
+
+
+def make_query(args, commit, i):
+	query = [
+		('target_name', TARGET),
+		('board_name', BOARD),
+	]
+	if commit:
+		query += [
+			('current_release', 'SNAPSHOT'),
+			('current_revision', f'r1-{commit[:10]}'),
+		]
+	# every variant is a distinct build, repeated ones are served from the build cache
+	query += [ ('pkgs', f'pkg{n}') for n in range(i % args.variants + 1) ]
+	return query
+
+
+async def request(session, endpoint, query):
+	if endpoint == 'list':
+		async with session.get('/api/list', params=query) as r:
+			r.raise_for_status()
+			await r.read()
+
+	elif endpoint == 'build':
+		async with session.get('/api/build', params=query) as r:
+			r.raise_for_status()
+			await r.read()
+
+	elif endpoint == 'jobs':
+		async with session.post('/api/jobs', data=query) as r:
+			r.raise_for_status()
+			job_id = (await r.json())['id']
+		while True:
+			async with session.get(f'/api/jobs/{job_id}') as r:
+				r.raise_for_status()
+				state = (await r.json())['state']
+			if state in ('done', 'failed'):
+				break
+			await asyncio.sleep(0.05)
+		async with session.get(f'/api/jobs/{job_id}/image') as r:
+			r.raise_for_status()
+			await r.read()
+
+	else:
+		raise ValueError(f'bad endpoint: {endpoint}')
+
+
+async def client(session, endpoint, args, commit, n, latencies, errors):
+	for i in range(args.requests):
+		started = time.monotonic()
+		try:
+			await request(session, endpoint, make_query(args, commit, n * args.requests + i))
+		except Exception as e:
+			logging.warning(f'{endpoint}: request failed: {e}')
+			errors.append(e)
+			continue
+		latencies.append(time.monotonic() - started)
+
+
+def percentile(values, q):
+	values = sorted(values)
+	if not values:
+		return float('nan')
+	return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def report(endpoint, latencies, errors, elapsed):
+	print(f'{endpoint:>8}: {len(latencies):5d} ok {len(errors):4d} failed  '
+	      f'p50 {percentile(latencies, 0.5) * 1000:9.1f} ms  '
+	      f'p99 {percentile(latencies, 0.99) * 1000:9.1f} ms  '
+	      f'{len(latencies) / elapsed:8.2f} req/s')
+
+
+async def run(args, upenwrt_args):
+	with tempfile.TemporaryDirectory() as tmp:
+		basedir = args.keep or tmp
+		mirrordir = p.join(basedir, 'mirror')
+		rootdir = p.join(basedir, 'root')
+
+		print(f'generating fixtures in {basedir}')
+		make_mirror(mirrordir, args)
+		commit = make_rootdir(rootdir, args)
+
+		mirror = aiohttp.web.Application()
+		mirror.router.add_static('/', mirrordir)
+
+		async with contextlib.AsyncExitStack() as stack:
+			mirror_server = await stack.enter_async_context(aiohttp.test_utils.TestServer(mirror))
+
+			# with --dispatch, the app under test only routes requests to build workers, each with a root directory of its own
+			worker_urls = []
+			for n in range(args.dispatch):
+				workerdir = p.join(basedir, f'worker{n}')
+				shutil.copytree(rootdir, workerdir, symlinks=True)
+				worker = UpenwrtApp(UpenwrtContext.from_args(
+					basedir=workerdir,
+					baseurl='http://localhost',
+					mirror_url=str(mirror_server.make_url('')),
+					prefetch_interval=0,
+					**upenwrt_args,
+				))
+				worker_server = await stack.enter_async_context(aiohttp.test_utils.TestServer(worker))
+				worker_urls.append(str(worker_server.make_url('')))
+
+			context = UpenwrtContext.from_args(
+				basedir=rootdir,
+				baseurl='http://localhost',
+				mirror_url=str(mirror_server.make_url('')),
+				prefetch_interval=0,
+				dispatch=worker_urls,
+				dispatch_interval=1,
+				**upenwrt_args,
+			)
+			app = UpenwrtApp(context)
+
+			server = await stack.enter_async_context(aiohttp.test_utils.TestServer(app))
+			async with aiohttp.ClientSession(base_url=server.make_url('/')) as session:
+				# the first request downloads, extracts and parses everything
+				started = time.monotonic()
+				await request(session, 'list', make_query(args, commit, 0))
+				print(f'cold start: {(time.monotonic() - started) * 1000:.1f} ms')
+
+				for endpoint in args.endpoints:
+					latencies, errors = [], []
+					started = time.monotonic()
+					await asyncio.gather(*[
+						client(session, endpoint, args, commit, n, latencies, errors)
+						for n in range(args.clients)
+					])
+					report(endpoint, latencies, errors, time.monotonic() - started)
+
+			# a dispatcher builds nothing itself, so its cache counters are those of its workers
+			totals = collections.defaultdict(collections.Counter)
+			async with aiohttp.ClientSession() as session:
+				for url in worker_urls or [ str(server.make_url('')) ]:
+					async with session.get(f'{url.rstrip("/")}/api/stats') as r:
+						r.raise_for_status()
+						categories = (await r.json())['categories']
+					for name in ('builds', 'packages'):
+						counters = categories.get(name, {})
+						totals[name].update(hits=counters.get('hits', 0), misses=counters.get('misses', 0))
+			for name in ('builds', 'packages'):
+				print(f'{name:>8}: {totals[name]["hits"]:5} hits {totals[name]["misses"]:5} misses')
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--clients', type=int, default=8)
+	parser.add_argument('--requests', type=int, default=8)
+	parser.add_argument('--endpoints', type=lambda arg: arg.split(','), default=['list', 'build', 'jobs'])
+	parser.add_argument('--variants', type=int, default=4, help='number of distinct package sets requested')
+	parser.add_argument('--packages', type=int, default=8000, help='number of packages in the imagebuilder')
+	parser.add_argument('--build-time', type=float, default=1)
+	parser.add_argument('--image-size', type=util.parse_size, default='8M')
+	parser.add_argument('--no-source', action='store_true', help='do not correlate against a source tree')
+	parser.add_argument('--keep', metavar='DIR', help='generate everything in DIR and keep it afterwards')
+	parser.add_argument('--dispatch', type=int, default=0, metavar='N', help='dispatch requests to N build workers')
+	parser.add_argument('--debug', action='store_true')
+	# passed through to UpenwrtContext
+	parser.add_argument('--pool-size', type=int)
+	parser.add_argument('--pool-method')
+	parser.add_argument('--build-cache-size', type=util.parse_size)
+	parser.add_argument('--repack', action='store_true', default=None)
+	parser.add_argument('--job-concurrency', type=int)
+	parser.add_argument('--extract-concurrency', type=int)
+	parser.add_argument('--build-concurrency', type=int)
+	parser.add_argument('--max-queue', type=int)
+	args = parser.parse_args()
+
+	util.configure_logging(prefix='e2e', debug=args.debug)
+	if not args.debug:
+		logging.getLogger().setLevel(logging.WARNING)
+
+	upenwrt_args = {
+		k: v for k, v in vars(args).items()
+		if k in ('pool_size', 'pool_method', 'build_cache_size', 'repack', 'job_concurrency', 'extract_concurrency', 'build_concurrency', 'max_queue')
+		and v is not None
+	}
+	if args.keep:
+		os.makedirs(args.keep)
+	asyncio.run(run(args, upenwrt_args))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,148 @@
+#!/hint/python3
+
+import os
+import io
+import hashlib
+import random
+import subprocess
+import tarfile
+import tempfile
+
+
+def make_packageinfo(*, packages=8000, seed=0):
+	rnd = random.Random(seed)
+	lines = []
+	for i in range(packages):
+		name = f'pkg{i}'
+		lines.append(f'Source-Makefile: package/feeds/packages/{name}/Makefile')
+		lines.append(f'Build-Depends: libc libgcc')
+		lines.append(f'')
+		lines.append(f'Package: {name}')
+		lines.append(f'Submenu: Miscellaneous')
+		lines.append(f'Version: 1.{i % 10}.{i % 7}-r{i % 3}')
+		lines.append(f'Depends: +libc ' + ' '.join(f'+pkg{rnd.randrange(packages)}' for _ in range(rnd.randrange(5))))
+		lines.append(f'Conflicts: ')
+		lines.append(f'Menu-Depends: ')
+		if i % 5 == 0:
+			lines.append(f'Provides: {name}-alias {name}-compat')
+		lines.append(f'Section: utils')
+		lines.append(f'Category: Utilities')
+		lines.append(f'Repository: base')
+		lines.append(f'Title: Synthetic package number {i}')
+		lines.append(f'Maintainer: Nobody <nobody@example.org>')
+		lines.append(f'Source: {name}-1.0.tar.xz')
+		lines.append(f'License: GPL-2.0-or-later')
+		lines.append(f'Type: ipkg')
+		lines.append(f'Description: Synthetic package {i} used for benchmarking.')
+		for j in range(rnd.randrange(1, 6)):
+			lines.append(f'  Continuation line {j} of the description of the package.')
+		lines.append(f'https://example.org/{name}')
+		lines.append(f'@@')
+		lines.append(f'')
+	return '\n'.join(lines) + '\n'
+
+
+def make_targetinfo(*, targets=40, profiles=60, shared=0, seed=0):
+	# the first `shared` profiles of each target reappear, under the same name and devices, in every subtarget of its arch
+	rnd = random.Random(seed)
+	lines = []
+	for t in range(targets):
+		target = f'arch{t // 4}/soc{t % 4}'
+		lines.append(f'Source-Makefile: target/linux/arch{t // 4}/Makefile')
+		lines.append(f'Target: {target}')
+		lines.append(f'Target-Board: arch{t // 4}')
+		lines.append(f'Target-Name: Synthetic target {t}')
+		lines.append(f'Target-Arch: mipsel')
+		lines.append(f'Target-Arch-Packages: mipsel_24kc')
+		lines.append(f'Target-Features: fpu gpio ramdisk squashfs')
+		lines.append(f'Target-Depends: ')
+		lines.append(f'Target-Optimization: -Os -pipe')
+		lines.append(f'CPU-Type: 24kc')
+		lines.append(f'Linux-Version: 6.6.{t}')
+		lines.append(f'Linux-Release: 1')
+		lines.append(f'Linux-Kernel-Arch: mips')
+		lines.append(f'Target-Description:')
+		lines.append(f'\tSynthetic target {t}')
+		lines.append(f'@@')
+		lines.append(f'Default-Packages: base-files busybox dnsmasq dropbear firewall4 fstools libc logd mtd netifd opkg uci')
+		for pr in range(profiles):
+			vendor = f'arch{t // 4}' if pr < shared else t
+			lines.append(f'Target-Profile: DEVICE_vendor{vendor}_model{pr}')
+			lines.append(f'Target-Profile-Name: Vendor {vendor} Model {pr}')
+			lines.append(f'Target-Profile-Packages: ' + ' '.join(f'kmod-{rnd.randrange(200)}' for _ in range(rnd.randrange(1, 6))))
+			lines.append(f'Target-Profile-hasImageMetadata: 1')
+			lines.append(f'Target-Profile-SupportedDevices: vendor{vendor},model{pr} model{pr}-t{vendor}')
+			lines.append(f'Target-Profile-Priority: 0')
+			lines.append(f'Target-Profile-Description:')
+			lines.append(f'Build firmware images for Vendor {t} Model {pr}')
+			lines.append(f'@@')
+			lines.append(f'')
+	return '\n'.join(lines) + '\n'
+
+
+def make_imagebuilder(path, *, name, target, targetinfo, packageinfo, build_time=0, image_size=0):
+	# a tarball shaped like a real imagebuilder, whose `make image` only waits and writes a fake sysupgrade image
+	# it also "downloads" the list of a feed and one package from it into dl/, as opkg does, unless the package is there already
+	outdir = f'bin/targets/{target}'
+	output = f'{outdir}/openwrt-{target.replace("/", "-")}-$(PROFILE)-squashfs-sysupgrade.bin'
+	ipk_name = 'bench-feed_1.0_all.ipk'
+	ipk = f'synthetic package {name}\n'
+	feed_list = '\n'.join([
+		f'Package: bench-feed',
+		f'Version: 1.0',
+		f'Filename: {ipk_name}',
+		f'SHA256sum: {hashlib.sha256(ipk.encode("utf-8")).hexdigest()}',
+		f'',
+	]) + '\n'
+	makefile = '\n'.join([
+		f'image:',
+		f'\tmkdir -p {outdir}',
+		f'\tcp feed/Packages dl/bench_feed',
+		f'\ttest -e dl/{ipk_name} || cp feed/{ipk_name} dl/{ipk_name}',
+		f'\tsleep {build_time}',
+		f'\techo "$(PROFILE) $(PACKAGES)" > {output}',
+		f'\thead -c {image_size} /dev/zero >> {output}',
+	]) + '\n'
+
+	files = {
+		'.targetinfo': targetinfo,
+		'.packageinfo': packageinfo,
+		'Makefile': makefile,
+		'feed/Packages': feed_list,
+		f'feed/{ipk_name}': ipk,
+	}
+	with tarfile.open(path, 'w:xz', preset=0) as tar:
+		for subdir in ('bin', 'dl', 'tmp', 'build_dir', 'staging_dir', 'feed'):
+			info = tarfile.TarInfo(f'{name}/{subdir}')
+			info.type = tarfile.DIRTYPE
+			info.mode = 0o755
+			tar.addfile(info)
+		for filename, contents in files.items():
+			data = contents.encode('utf-8')
+			info = tarfile.TarInfo(f'{name}/{filename}')
+			info.size = len(data)
+			info.mode = 0o644
+			tar.addfile(info, io.BytesIO(data))
+
+
+def make_source_repo(path, *, target, targetinfo):
+	# a bare repository standing in for openwrt.git, whose `make prepare-tmpinfo` emits the given targetinfo
+	# returns the commit hash
+	board_arch = target.split('/')[0]
+	makefile = '\n'.join([
+		f'prepare-tmpinfo:',
+		f'\tmkdir -p tmp/info',
+		f'\tcp targetinfo tmp/info/.targetinfo-{board_arch}',
+	]) + '\n'
+
+	env = dict(os.environ, GIT_AUTHOR_NAME='bench', GIT_AUTHOR_EMAIL='bench@localhost', GIT_COMMITTER_NAME='bench', GIT_COMMITTER_EMAIL='bench@localhost')
+	with tempfile.TemporaryDirectory() as tree:
+		with open(os.path.join(tree, 'Makefile'), 'w') as f:
+			f.write(makefile)
+		with open(os.path.join(tree, 'targetinfo'), 'w') as f:
+			f.write(targetinfo)
+		for args in (['init', '-q'], ['add', '.'], ['commit', '-q', '-m', 'bench']):
+			subprocess.run(['git', *args], cwd=tree, env=env, check=True)
+		subprocess.run(['git', 'clone', '-q', '--bare', tree, path], env=env, check=True)
+		commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=tree, stdout=subprocess.PIPE, check=True)
+	return commit.stdout.decode('utf-8').strip()
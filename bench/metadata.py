@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+#
+# Compares the metadata parsers in upenwrt.targetinfo against the previous
+# regex-per-line implementation (kept below as a reference), and checks that
+# the SQLite index of upenwrt.metaindex gives the same answers as the parser.
+#
+# Usage: bench/metadata.py [--targetinfo FILE] [--packageinfo FILE] [--min-speedup X]
+# (e. g. the .targetinfo and .packageinfo files of an extracted snapshot imagebuilder;
+# synthetic files are generated if not given)
+#
+# Both parsers are run alternately --repeat times, and their median times are compared.
+# Fails if either parser is less than --min-speedup times faster than the legacy one.
+# The default leaves a margin below the medians seen on synthetic files (targetinfo
+# 13-16x, packageinfo 4.5-5.8x: the latter is dominated by building the package objects).
+#
+
+import os
+import os.path as p
+import sys
+import re
+import gc
+import sqlite3
+import logging
+import argparse
+import tempfile
+import time
+import statistics
+
+sys.path.insert(0, p.join(p.dirname(p.abspath(__file__)), '..'))
+sys.path.insert(0, p.dirname(p.abspath(__file__)))
+
+from upenwrt.targetinfo import OpenwrtTargetinfo, OpenwrtPackageinfo, OpenwrtTarget, OpenwrtProfile, OpenwrtPackage
+from upenwrt.metaindex import MetadataIndex, IndexedTargetinfo
+import fixtures
+
+
+class LegacyPackageinfo:
+	PACKAGEINFO_PACKAGE = re.compile('Package: (.+)')
+	PACKAGEINFO_PROVIDES = re.compile('Provides: (.+)')
+
+	def __init__(self, packageinfo):
+		self.packages = dict()
+		self.aliases = dict()
+
+		with open(packageinfo, 'r') as f:
+			logging.debug(f'OpenwrtPackageinfo(f={f.name}): parsing packageinfo')
+			self._parse_packageinfo(f)
+
+
+	def _parse_packageinfo(self, f):
+		packages = dict()
+		aliases = dict()
+		section = dict()
+		section_raw = []
+
+		for line in f:
+			line = line.rstrip('\n')
+			section_raw.append(line)
+
+			m = self.PACKAGEINFO_PACKAGE.fullmatch(line)
+			if m:
+				section['package'] = m[1]
+				continue
+			m = self.PACKAGEINFO_PROVIDES.fullmatch(line)
+			if m:
+				section['provides'] = set(m[1].split(' '))
+
+			if line == '@@':
+				if 'package' in section.keys():
+					package = OpenwrtPackage(
+						name=section['package'],
+						aliases=section.get('provides', set()),
+					)
+
+					packages[package.name] = package
+					aliases.setdefault(package.name, list()).append(package)
+					for a in package.aliases:
+						aliases.setdefault(a, list()).append(package)
+
+				else:
+					section_raw_string = '\n'.join(section_raw)
+					logging.debug(f'OpenwrtPackageinfo(f={f.name}): strange section:\n{section_raw_string}')
+
+				section = dict()
+				section_raw = []
+
+		self.packages = packages
+		self.aliases = aliases
+
+
+class LegacyTargetinfo:
+	TARGETINFO_TARGET = re.compile('Target: (.*)')
+	TARGETINFO_TARGET_PACKAGES = re.compile('Default-Packages: (.*)')
+
+	TARGETINFO_PROFILE = re.compile('Target-Profile: DEVICE_(.*)')
+	TARGETINFO_PROFILE_DEVICES = re.compile('Target-Profile-SupportedDevices: (.*)')
+	TARGETINFO_PROFILE_PACKAGES = re.compile('Target-Profile-Packages: (.*)')
+
+	def __init__(self, targetinfo):
+		self.profiles = dict()
+		self.targets = dict()
+
+		with open(targetinfo, 'r') as f:
+			logging.debug(f'OpenwrtTargetinfo(f={f.name}): parsing targetinfo')
+			self._parse_targetinfo(f)
+
+	def _parse_targetinfo(self, f):
+		targets = dict()
+		profiles = dict()
+		section = dict()
+		section_raw = []
+		last_target = None
+		profiles_by_target = dict()
+
+		for line in f:
+			line = line.rstrip('\n')
+			section_raw.append(line)
+
+			# parse target fields
+			m = self.TARGETINFO_TARGET.fullmatch(line)
+			if m:
+				section['target'] = m[1]
+				continue
+			m = self.TARGETINFO_TARGET_PACKAGES.fullmatch(line)
+			if m:
+				section['target_packages'] = m[1].split()
+				continue
+
+			# parse profile fields
+			m = self.TARGETINFO_PROFILE.fullmatch(line)
+			if m:
+				section['profile'] = m[1]
+				continue
+			m = self.TARGETINFO_PROFILE_DEVICES.fullmatch(line)
+			if m:
+				section['profile_devices'] = m[1].split()
+				continue
+			m = self.TARGETINFO_PROFILE_PACKAGES.fullmatch(line)
+			if m:
+				section['profile_packages'] = m[1].split()
+				continue
+
+			# parse separator
+			if line == '@@':
+				if {'profile'} <= section.keys():
+					# noinspection PyArgumentList
+					profile = OpenwrtProfile(
+						name=section['profile'],
+						target=last_target,  # NOTE: stateful format!
+						devices=section.get('profile_devices', []),
+						packages=section.get('profile_packages', []),
+					)
+					logging.debug(f'OpenwrtTargetinfo(f={f.name}): {profile}')
+					# lookup dict
+					for d in profile.devices:
+						profiles[d] = profile
+					profiles[profile.name] = profile
+					# hierarchy dict
+					last_target.profiles[profile.name] = profile
+				elif {'target'} <= section.keys():
+					# noinspection PyArgumentList
+					target = OpenwrtTarget(
+						name=section['target'],
+						packages=section.get('target_packages', []),
+						profiles=dict(),
+					)
+					logging.debug(f'OpenwrtTargetinfo(f={f.name}): {target}')
+					targets[target.name] = target
+					last_target = target
+				else:
+					section_raw_string = '\n'.join(section_raw)
+					logging.debug(f'OpenwrtTargetinfo(f={f.name}: strange section:\n{section_raw_string}')
+
+				section = dict()
+				section_raw = []
+
+		self.profiles = profiles
+		self.targets = targets
+
+
+def same_packageinfo(a, b):
+	return (
+		{ k: (v.name, v.aliases) for k, v in a.packages.items() } == { k: (v.name, v.aliases) for k, v in b.packages.items() } and
+		{ k: [ x.name for x in v ] for k, v in a.aliases.items() } == { k: [ x.name for x in v ] for k, v in b.aliases.items() }
+	)
+
+
+def same_targetinfo(a, b):
+	return (
+		{ k: (v.name, v.packages, sorted(v.profiles)) for k, v in a.targets.items() } == { k: (v.name, v.packages, sorted(v.profiles)) for k, v in b.targets.items() } and
+		{ k: (v.name, v.packages, v.devices) for k, v in a.profiles.items() } == { k: (v.name, v.packages, v.devices) for k, v in b.profiles.items() }
+	)
+
+
+def same_indexed_targetinfo(parsed, indexed):
+	# the parser links a profile to its target object, the index to the target name
+	def profile(v):
+		return (v.name, getattr(v.target, 'name', v.target), v.packages, v.devices)
+	return (
+		same_targetinfo(parsed, indexed) and
+		{ k: profile(v) for k, v in parsed.profiles.items() } == { k: profile(v) for k, v in indexed.profiles.items() } and
+		{ k: { n: profile(x) for n, x in v.profiles.items() } for k, v in parsed.targets.items() } ==
+		{ k: { n: profile(x) for n, x in v.profiles.items() } for k, v in indexed.targets.items() }
+	)
+
+
+def check_index(tmp):
+	# subtargets of one arch sharing profile names and devices, as x86/64 and x86/generic do
+	path = p.join(tmp, '.targetinfo-shared')
+	with open(path, 'w') as f:
+		f.write(fixtures.make_targetinfo(targets=8, profiles=10, shared=3))
+	db = sqlite3.connect(p.join(tmp, 'targetinfo.sqlite'))
+	with db:
+		MetadataIndex._write_targetinfo(db, path)
+	if not same_indexed_targetinfo(OpenwrtTargetinfo(path), IndexedTargetinfo(db)):
+		raise RuntimeError(f'targetinfo: index disagrees with the parser on {path}')
+	print(f'targetinfo: index agrees with the parser')
+
+
+def bench(name, path, legacy, current, same, repeat, min_speedup):
+	size = os.stat(path).st_size
+	if not same(legacy(path), current(path)):
+		raise RuntimeError(f'{name}: parsers disagree on {path}')
+
+	def timed(parser):
+		# as timeit does, keep the collector from charging one parser for the garbage of the other
+		gc.collect()
+		gc.disable()
+		try:
+			started = time.perf_counter()
+			parser(path)
+			return time.perf_counter() - started
+		finally:
+			gc.enable()
+
+	# alternating runs see the same background load, and the median ignores outliers in either direction
+	samples = [ (timed(legacy), timed(current)) for _ in range(repeat) ]
+	t_legacy = statistics.median(t for t, _ in samples)
+	t_current = statistics.median(t for _, t in samples)
+	speedup = t_legacy / t_current
+	print(f'{name}: {size / 1e6:.1f} MB: legacy {t_legacy * 1e3:.1f} ms, current {t_current * 1e3:.1f} ms (median of {repeat}), speedup {speedup:.1f}x')
+	if speedup < min_speedup:
+		raise RuntimeError(f'{name}: speedup {speedup:.1f}x is below {min_speedup:.1f}x')
+	return speedup
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--targetinfo')
+	parser.add_argument('--packageinfo')
+	parser.add_argument('--repeat', type=int, default=15)
+	parser.add_argument('--min-speedup', type=float, default=4.0)
+	args = parser.parse_args()
+
+	with tempfile.TemporaryDirectory() as tmp:
+		if not args.targetinfo:
+			args.targetinfo = p.join(tmp, '.targetinfo')
+			with open(args.targetinfo, 'w') as f:
+				f.write(fixtures.make_targetinfo())
+		if not args.packageinfo:
+			args.packageinfo = p.join(tmp, '.packageinfo')
+			with open(args.packageinfo, 'w') as f:
+				f.write(fixtures.make_packageinfo())
+
+		bench('targetinfo', args.targetinfo, LegacyTargetinfo, OpenwrtTargetinfo, same_targetinfo, args.repeat, args.min_speedup)
+		bench('packageinfo', args.packageinfo, LegacyPackageinfo, OpenwrtPackageinfo, same_packageinfo, args.repeat, args.min_speedup)
+		check_index(tmp)
+
+
+if __name__ == '__main__':
+	main()
@@ -94,6 +94,18 @@ opkg_get_user_all() {
 	awk "$@" "$AWK_FILTER_PACKAGES" "$OPKG_STATUS" | sort
 }
 
+# canonical form of the request, as understood by the server (see /api/manifest)
+manifest() {
+	echo "target_name=$TARGET_NAME"
+	echo "board_name=$BOARD_NAME"
+	echo "current_release=$RELEASE"
+	echo "current_revision=$REVISION"
+	echo "target_version=$TARGET"
+	for p in $PACKAGES; do
+		echo "pkgs=$p"
+	done | LC_ALL=C sort -u
+}
+
 opkg_get_user() {
 	pkgs_2="$(mktemp)"
 
@@ -131,6 +143,14 @@ while test "$#" -ne 0; do
 		var=DRY_RUN
 		needvalue=0
 		;;
+	--async)
+		var=ASYNC
+		needvalue=0
+		;;
+	--poll-interval)
+		var=POLL_INTERVAL
+		needvalue=1
+		;;
 	--hw-target)
 		var=TARGET_NAME
 		needvalue=1
@@ -290,18 +310,49 @@ else
 fi
 log_choice TARGET
 
+# determine polling interval for --async
+if test -n "$POLL_INTERVAL"; then
+	:
+else
+	POLL_INTERVAL=10
+	POLL_INTERVAL_reason='default'
+fi
+if test -n "$ASYNC"; then
+	if test "$API_ENDPOINT" != "build"; then die "--async is only supported for building images"; fi
+	dbg log_choice POLL_INTERVAL
+fi
+
 # generate CURL call
-URL="$BASE_URL/api/$API_ENDPOINT"
-CURL="curl '$URL'"
-CURL="$CURL -G"
-CURL="$CURL -d 'target_name=$TARGET_NAME'"
-CURL="$CURL -d 'board_name=$BOARD_NAME'"
-CURL="$CURL -d 'current_release=$RELEASE'"
-CURL="$CURL -d 'current_revision=$REVISION'"
-CURL="$CURL -d 'target_version=$TARGET'"
+CURL_ARGS=""
+CURL_ARGS="$CURL_ARGS -d 'target_name=$TARGET_NAME'"
+CURL_ARGS="$CURL_ARGS -d 'board_name=$BOARD_NAME'"
+CURL_ARGS="$CURL_ARGS -d 'current_release=$RELEASE'"
+CURL_ARGS="$CURL_ARGS -d 'current_revision=$REVISION'"
+CURL_ARGS="$CURL_ARGS -d 'target_version=$TARGET'"
 for p in $PACKAGES; do
-	CURL="$CURL -d 'pkgs=$p'"
+	CURL_ARGS="$CURL_ARGS -d 'pkgs=$p'"
 done
+
+if test -n "$ASYNC"; then
+	# submit a job, then poll for it to finish
+	URL="$BASE_URL/api/jobs"
+	CURL="curl '$URL' $CURL_ARGS"
+else
+	URL="$BASE_URL/api/$API_ENDPOINT"
+	CURL="curl '$URL' -G $CURL_ARGS"
+fi
+
+# images that have been built before for the same manifest are fetched by its hash alone
+if test "$API_ENDPOINT" = "build"; then
+	MANIFEST_HASH="$(manifest | sha256sum | cut -d' ' -f1)"
+	dbg log "\$MANIFEST_HASH='$MANIFEST_HASH'"
+	PROBE="curl '$BASE_URL/api/manifest/$MANIFEST_HASH/image'"
+	dbg log "\$PROBE='$PROBE'"
+	if test -z "$ASYNC"; then
+		# unless it has, the manifest is uploaded compressed rather than as a (huge) query string
+		CURL="manifest | gzip -c | curl '$BASE_URL/api/manifest/$MANIFEST_HASH' -H 'Content-Type: text/plain' -H 'Content-Encoding: gzip' --data-binary @-"
+	fi
+fi
 dbg log "\$CURL='$CURL'"
 
 # exit at this point if we're asked not to do anything
@@ -315,20 +366,60 @@ TMP_STATUS="$(mktemp)"
 cleanup() { rm -f "$TMP_BODY" "$TMP_STATUS"; }
 trap cleanup EXIT
 
-eval "$CURL -sSL -w '%{http_code}' -o '$TMP_BODY' >'$TMP_STATUS'"
-STATUS="$(cat "$TMP_STATUS")"
-if [ -n "$STATUS" -a "$STATUS" -ge 200 -a "$STATUS" -lt 400 ]; then
-	if [ -t 1 ]; then
-		mv "$TMP_BODY" /tmp/sysupgrade-$TARGET.img
-		echo /tmp/sysupgrade-$TARGET.img
-	else
-		cat "$TMP_BODY"
-	fi
-	rc=0
-else
+call() {
+	eval "$1 -sSL -w '%{http_code}' -o '$TMP_BODY' >'$TMP_STATUS'"
+	STATUS="$(cat "$TMP_STATUS")"
+	[ -n "$STATUS" -a "$STATUS" -ge 200 -a "$STATUS" -lt 400 ]
+}
+
+call_failed() {
 	cat "$TMP_BODY" >&2
 	if [ -t 2 ]; then echo >&2; fi
-	rc=1
+	exit 1
+}
+
+# extracts a string field from the (flat) JSON object in the response body
+json_field() {
+	sed -n "s/.*\"$1\": \"\([^\"]*\)\".*/\1/p" "$TMP_BODY"
+}
+
+if test -n "$PROBE"; then
+	if call "$PROBE"; then
+		log "manifest $MANIFEST_HASH has been built before"
+		FOUND=1
+	elif test "$STATUS" != 404; then
+		call_failed
+	fi
+fi
+
+if test -n "$FOUND"; then
+	:
+elif test -n "$ASYNC"; then
+	call "$CURL" || call_failed
+	JOB_ID="$(json_field id)"
+	test -n "$JOB_ID" || die "could not parse job id from server response: $(cat "$TMP_BODY")"
+	log "submitted job $JOB_ID"
+
+	while :; do
+		sleep "$POLL_INTERVAL"
+		call "curl '$BASE_URL/api/jobs/$JOB_ID'" || call_failed
+		JOB_STATE="$(json_field state)"
+		log "job $JOB_ID: $JOB_STATE ($(json_field phase))"
+		case "$JOB_STATE" in
+		done|failed) break ;;
+		esac
+	done
+
+	# on failure, this will return the error
+	CURL="curl '$BASE_URL/api/jobs/$JOB_ID/image'"
+	call "$CURL" || call_failed
+else
+	call "$CURL" || call_failed
 fi
 
-exit $rc
+if [ -t 1 ]; then
+	mv "$TMP_BODY" /tmp/sysupgrade-$TARGET.img
+	echo /tmp/sysupgrade-$TARGET.img
+else
+	cat "$TMP_BODY"
+fi
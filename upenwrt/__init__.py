@@ -5,7 +5,8 @@ import os.path as p
 import argparse
 
 from . import util
-from .server import UpenwrtContext, UpenwrtApp, upenwrt_serve
+from .pool import ImagebuilderPool
+from .server import UpenwrtContext, UpenwrtApp, upenwrt_serve, upenwrt_serve_workers
 
 
 def parse_args(argv=None):
@@ -15,11 +16,67 @@ def parse_args(argv=None):
 	parser.add_argument('-d', '--basedir', default='')
 	parser.add_argument('-b', '--baseurl', default='http://localhost:8000')
 	parser.add_argument('--debug', action='store_true')
+	parser.add_argument('--pool-size', type=int, default=4)
+	parser.add_argument('--pool-idle-timeout', type=float, default=3600)
+	parser.add_argument('--pool-refill-interval', type=float, default=60)
+	parser.add_argument('--pool-method', choices=ImagebuilderPool.METHODS, default='auto')
+	parser.add_argument('--build-cache-size', type=util.parse_size, default='1G')
+	parser.add_argument('--package-cache-size', type=util.parse_size, default='2G')
+	parser.add_argument('--cache-size', type=util.parse_size, default='8G')
+	parser.add_argument('--checkout-cache-size', type=int, default=2)
+	parser.add_argument('--mirror-url', default='https://downloads.openwrt.org')
+	parser.add_argument('--artifact-ttl', type=float, default=300)
+	parser.add_argument('--repack', action='store_true')
+	parser.add_argument('--download-segments', type=int, default=4)
+	parser.add_argument('--prefetch', action='append', default=[], metavar='VERSION/TARGET')
+	parser.add_argument('--prefetch-interval', type=float, default=900)
+	parser.add_argument('--prefetch-window', type=float, default=86400)
+	parser.add_argument('--prefetch-concurrency', type=int, default=1)
+	parser.add_argument('--trace-file')
+	parser.add_argument('--trace-otlp', metavar='URL')
+	parser.add_argument('--job-concurrency', type=int, default=2)
+	parser.add_argument('--job-ttl', type=float, default=3600)
+	parser.add_argument('--extract-concurrency', type=int, default=2)
+	parser.add_argument('--source-concurrency', type=int, default=1)
+	parser.add_argument('--build-concurrency', type=int, default=2)
+	parser.add_argument('--max-queue', type=int, default=16)
+	parser.add_argument('--retry-after', type=int, default=30)
+	parser.add_argument('-w', '--workers', type=int, default=1)
+	parser.add_argument('--dispatch', action='append', default=[], metavar='URL')
+	parser.add_argument('--dispatch-interval', type=float, default=5)
 	args = parser.parse_args(args=argv)
 
 	context = UpenwrtContext.from_args(
 		basedir=p.join(os.getcwd(), args.basedir),
 		baseurl=args.baseurl,
+		pool_size=args.pool_size,
+		pool_idle_timeout=args.pool_idle_timeout,
+		pool_refill_interval=args.pool_refill_interval,
+		pool_method=args.pool_method,
+		build_cache_size=args.build_cache_size,
+		package_cache_size=args.package_cache_size,
+		cache_size=args.cache_size,
+		checkout_cache_size=args.checkout_cache_size,
+		mirror_url=args.mirror_url,
+		artifact_ttl=args.artifact_ttl,
+		repack=args.repack,
+		download_segments=args.download_segments,
+		prefetch=args.prefetch,
+		prefetch_interval=args.prefetch_interval,
+		prefetch_window=args.prefetch_window,
+		prefetch_concurrency=args.prefetch_concurrency,
+		trace_file=args.trace_file,
+		trace_otlp=args.trace_otlp,
+		job_concurrency=args.job_concurrency,
+		job_ttl=args.job_ttl,
+		extract_concurrency=args.extract_concurrency,
+		source_concurrency=args.source_concurrency,
+		build_concurrency=args.build_concurrency,
+		max_queue=args.max_queue,
+		retry_after=args.retry_after,
+		workers=args.workers,
+		dispatch=args.dispatch,
+		dispatch_interval=args.dispatch_interval,
 	)
 
 	return args, context
@@ -36,5 +93,8 @@ def main(argv=None):
 		prefix='upenwrt',
 		debug=args.debug,
 	)
-	app = UpenwrtApp(context)
-	upenwrt_serve(host=args.listen, port=args.port, app=app)
+	if context.workers > 1:
+		upenwrt_serve_workers(host=args.listen, port=args.port, context=context)
+	else:
+		app = UpenwrtApp(context)
+		upenwrt_serve(host=args.listen, port=args.port, app=app)
@@ -1,15 +1,20 @@
 #!/hint/python3
 
 import os.path as p
+import logging
+import asyncio
+import time
+import collections
+import aiofiles
+from contextlib import asynccontextmanager
 
-from . import util
 from . import wrapio
-from .targetinfo import OpenwrtTargetinfo, OpenwrtPackageinfo
+from . import tracing
 
 
 class OpenwrtArtifact:
 	def openwrt_base_url(self):
-		return f'https://downloads.openwrt.org/{self.release_path}/targets/{self.target_name}'
+		return f'{self.context.mirror_url}/{self.release_path}/targets/{self.target_name}'
 
 
 	def openwrt_imagebuilder_name(self):
@@ -34,34 +39,173 @@ class OpenwrtArtifact:
 
 		self.base_url = self.openwrt_base_url()
 		self.imagebuilder_file = None
+		self.imagebuilder_stat = None
+		self.imagebuilder_sha256 = None
+		self.checked_at = None
+		self.requested_at = None
+		self.peeked_at = None
+		self.peeked_identity = None
+		self.lock = asyncio.Lock()
 		self.targetinfo = None
 		self.packageinfo = None
 
 
-	async def get_imagebuilder(self, target_dir):
-		if not self.imagebuilder_file:
-			imagebuilder_name = self.openwrt_imagebuilder_name()
-			imagebuilder_url = f'{self.base_url}/{imagebuilder_name}'
-			imagebuilder_file = p.join(self.context.cachedir, imagebuilder_name)
-			await util.get_file(imagebuilder_url, dest=imagebuilder_file)
-
-			self.imagebuilder_file = imagebuilder_file
-
-		target_path = await wrapio.tempfile_mkdtemp(dir=target_dir, prefix='imagebuilder')
-		untar_imagebuilder = await util.run(
-			[ 'tar', '-xaf', self.imagebuilder_file, '--strip-components', '1', ],
-			cwd=target_path,
-		)
-		return target_path
+	def is_fresh(self):
+		return self.checked_at is not None and time.monotonic() - self.checked_at < self.context.artifact_ttl
+
+
+	async def get_sha256sums(self):
+		sha256sums_file = p.join(self.context.cachedir, 'sha256sums', f'{self.version_id}-{self.target_name.replace("/", "-")}')
+		try:
+			await self.context.downloader.get_file(f'{self.base_url}/sha256sums', dest=sha256sums_file)
+		except Exception as e:
+			logging.warning(f'OpenwrtArtifact: could not fetch sha256sums for {self.version_id} {self.target_name}: {e}')
+
+		sha256sums = dict()
+		try:
+			async with aiofiles.open(sha256sums_file, 'r') as f:
+				for line in (await f.read()).splitlines():
+					digest, _, name = line.partition(' ')
+					sha256sums[name.lstrip(' *')] = digest
+		except FileNotFoundError:
+			pass
+		return sha256sums
+
+
+	@tracing.traced('artifact.get_imagebuilder_file')
+	async def get_imagebuilder_file(self):
+		async with self.lock:
+			if not self.imagebuilder_file or not self.is_fresh() or not p.exists(self.imagebuilder_file):
+				imagebuilder_name = self.openwrt_imagebuilder_name()
+				imagebuilder_url = f'{self.base_url}/{imagebuilder_name}'
+				imagebuilder_file = p.join(self.context.cachedir, imagebuilder_name)
+				sha256 = (await self.get_sha256sums()).get(imagebuilder_name)
+				if sha256 is None:
+					logging.warning(f'OpenwrtArtifact: no sha256 for {imagebuilder_name}, not verifying')
+				async with self.context.cache.pin(imagebuilder_file):
+					with self.context.metrics.phase_seconds.time(phase='download'):
+						downloaded = await self.context.downloader.get_file(imagebuilder_url, dest=imagebuilder_file, sha256=sha256)
+				self.context.cache.record('imagebuilders', hit=not downloaded)
+				self.context.artifacts.confirm(self)
+
+				st = await wrapio.os_stat(imagebuilder_file)
+				imagebuilder_stat = (st.st_size, st.st_mtime_ns)
+				if imagebuilder_stat != self.imagebuilder_stat:
+					if self.imagebuilder_stat is not None:
+						logging.info(f'OpenwrtArtifact: {imagebuilder_name} has changed, dropping metadata')
+					self.targetinfo = None
+					self.packageinfo = None
+
+				self.imagebuilder_file = imagebuilder_file
+				self.imagebuilder_stat = imagebuilder_stat
+				self.imagebuilder_sha256 = sha256
+				self.checked_at = time.monotonic()
+				self.context.repacker.schedule(imagebuilder_file)
+			else:
+				await self.context.cache.touch(self.imagebuilder_file)
+		return self.imagebuilder_file
+
+
+	async def get_imagebuilder_identity(self):
+		imagebuilder_file = await self.get_imagebuilder_file()
+		if self.imagebuilder_sha256 is not None:
+			return f'{p.basename(imagebuilder_file)}:{self.imagebuilder_sha256}'
+		st = await wrapio.os_stat(imagebuilder_file)
+		return f'{p.basename(imagebuilder_file)}:{st.st_size}:{st.st_mtime_ns}'
+
+
+	async def peek_imagebuilder_identity(self):
+		# same as get_imagebuilder_identity(), but only ever fetches sha256sums, never the imagebuilder itself,
+		# and at most once per artifact-ttl
+		if self.imagebuilder_file and self.is_fresh() and p.exists(self.imagebuilder_file):
+			return await self.get_imagebuilder_identity()
+		if self.peeked_at is not None and time.monotonic() - self.peeked_at < self.context.artifact_ttl:
+			return self.peeked_identity
+
+		imagebuilder_name = self.openwrt_imagebuilder_name()
+		sha256 = (await self.get_sha256sums()).get(imagebuilder_name)
+		self.peeked_at = time.monotonic()
+		self.peeked_identity = f'{imagebuilder_name}:{sha256}' if sha256 is not None else None
+		if sha256 is not None:
+			self.context.artifacts.confirm(self)
+		return self.peeked_identity
+
+
+	@asynccontextmanager
+	async def imagebuilder_base(self):
+		# shared read-only tree, suitable only for reading metadata
+		async with self.context.pool.base(
+			key=(self.version_id, self.target_name),
+			source=await self.get_imagebuilder_file(),
+		) as path:
+			yield path
+
+
+	@asynccontextmanager
+	async def imagebuilder(self, target_dir):
+		# private copy-on-write tree, suitable for building
+		async with self.context.pool.view(
+			key=(self.version_id, self.target_name),
+			source=await self.get_imagebuilder_file(),
+			target_dir=target_dir,
+		) as path:
+			yield path
 
 
 	async def get_targetinfo(self, imagebuilder_dir):
 		if self.targetinfo is None:
-			self.targetinfo = OpenwrtTargetinfo(p.join(imagebuilder_dir, '.targetinfo'))
+			self.targetinfo = await self.context.metaindex.load_targetinfo(p.join(imagebuilder_dir, '.targetinfo'))
 		return self.targetinfo
 
 
 	async def get_packageinfo(self, imagebuilder_dir):
 		if self.packageinfo is None:
-			self.packageinfo = OpenwrtPackageinfo(p.join(imagebuilder_dir, '.packageinfo'))
+			self.packageinfo = await self.context.metaindex.load_packageinfo(p.join(imagebuilder_dir, '.packageinfo'))
 		return self.packageinfo
+
+
+class ArtifactRegistry:
+	# artifacts are remembered (and prefetched) only once the mirror has shown that they exist,
+	# and only this many of them, least recently used first out; as many unconfirmed ones are kept apart
+	SIZE = 128
+
+	def __init__(self, *, context):
+		self.context = context
+		self.artifacts = collections.OrderedDict()
+		self.pending = collections.OrderedDict()
+
+
+	@staticmethod
+	def _put(artifacts, key, artifact):
+		artifacts[key] = artifact
+		artifacts.move_to_end(key)
+		while len(artifacts) > ArtifactRegistry.SIZE:
+			artifacts.popitem(last=False)
+
+
+	def get(self, *, target_name, version_id, requested=False):
+		key = (version_id, target_name)
+		artifact = self.artifacts.get(key)
+		if artifact is not None:
+			self.artifacts.move_to_end(key)
+		else:
+			artifact = self.pending.get(key)
+			if artifact is None:
+				artifact = OpenwrtArtifact(
+					context=self.context,
+					target_name=target_name,
+					version_id=version_id,
+				)
+			ArtifactRegistry._put(self.pending, key, artifact)
+		if requested:
+			artifact.requested_at = time.monotonic()
+		return artifact
+
+
+	def confirm(self, artifact):
+		key = (artifact.version_id, artifact.target_name)
+		if self.pending.get(key) is artifact:
+			del self.pending[key]
+		if key not in self.artifacts:
+			logging.debug(f'ArtifactRegistry: registering {artifact.version_id} {artifact.target_name}')
+			ArtifactRegistry._put(self.artifacts, key, artifact)
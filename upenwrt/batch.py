@@ -0,0 +1,142 @@
+#!/hint/python3
+
+import logging
+import asyncio
+import collections
+import subprocess
+
+from .util import UpenwrtUserError, UpenwrtBusyError
+
+
+class BatchBuild:
+	def __init__(self, *, context, make_operation, devices):
+		self.context = context
+		self.make_operation = make_operation
+		self.devices = BatchBuild.validate(devices)
+		# build key -> job building it
+		self.builds = dict()
+
+
+	@staticmethod
+	def validate(devices):
+		if not isinstance(devices, list) or not devices:
+			raise UpenwrtUserError(f'BatchBuild: expected a non-empty list of devices')
+		for i, device in enumerate(devices):
+			if not isinstance(device, dict):
+				raise UpenwrtUserError(f'BatchBuild: device #{i}: expected an object')
+			for field in ('target_name', 'board_name'):
+				if not isinstance(device.get(field), str):
+					raise UpenwrtUserError(f'BatchBuild: device #{i}: missing {field}')
+			if not isinstance(device.get('pkgs', []), list):
+				raise UpenwrtUserError(f'BatchBuild: device #{i}: pkgs must be a list')
+		return devices
+
+
+	def groups(self):
+		groups = collections.defaultdict(list)
+		for i, device in enumerate(self.devices):
+			groups[(device.get('target_version', 'snapshot'), device['target_name'])].append(i)
+		return groups
+
+
+	async def results(self):
+		queue = asyncio.Queue()
+		tasks = []
+		for (version_id, target_name), indices in self.groups().items():
+			ops = dict()
+			for i in indices:
+				try:
+					ops[i] = self.make_operation(
+						target_name=self.devices[i]['target_name'],
+						board_name=self.devices[i]['board_name'],
+						current_release=self.devices[i].get('current_release'),
+						current_revision=self.devices[i].get('current_revision'),
+						target_version=version_id,
+						pkgs=self.devices[i].get('pkgs', []),
+					)
+				except Exception as e:
+					queue.put_nowait(self._error(i, e))
+			if ops:
+				logging.info(f'BatchBuild: {len(ops)} devices for {version_id} {target_name}')
+				tasks.append(asyncio.ensure_future(self._run_group(ops, queue)))
+
+		try:
+			for _ in self.devices:
+				yield await queue.get()
+		finally:
+			for task in tasks:
+				task.cancel()
+
+
+	async def _run_group(self, ops, queue):
+		# extract and parse the imagebuilder once, and keep it around for the whole group
+		artifact = next(iter(ops.values())).artifact
+		try:
+			async with artifact.imagebuilder_base() as basedir:
+				await artifact.get_targetinfo(basedir)
+				await artifact.get_packageinfo(basedir)
+				await asyncio.gather(*[ self._run_device(i, op, queue) for i, op in ops.items() ])
+		except asyncio.CancelledError:
+			raise
+		except Exception as e:
+			# the imagebuilder itself is unusable, and no device has been reported yet
+			for i in ops:
+				queue.put_nowait(self._error(i, e))
+
+
+	async def _run_device(self, i, op, queue):
+		try:
+			await op.prepare()
+			key = await op.build_key()
+			# devices that end up with the same profile and packages share a single build
+			job = self.builds.get(key)
+			if job is None:
+				job = self.context.jobs.submit(op, check=False)
+				self.builds[key] = job
+			await asyncio.shield(job.task)
+		except asyncio.CancelledError:
+			raise
+		except Exception as e:
+			queue.put_nowait(self._error(i, e))
+			return
+
+		result = self._result(i)
+		result.update({
+			'state': job.state,
+			'job': job.id,
+			'profile': op.details.profile.name,
+			'packages': sorted(op.details.packages),
+		})
+		if job.state == 'done':
+			result['image_url'] = f'{self.context.baseurl.rstrip("/")}/api/jobs/{job.id}/image'
+		else:
+			result['status'] = job.error_status
+			result['error'] = job.error
+		queue.put_nowait(result)
+
+
+	def _result(self, i):
+		result = { 'index': i }
+		if 'id' in self.devices[i]:
+			result['id'] = self.devices[i]['id']
+		return result
+
+
+	def _error(self, i, e):
+		if isinstance(e, UpenwrtUserError):
+			status, error = 400, str(e)
+		elif isinstance(e, UpenwrtBusyError):
+			status, error = 503, str(e)
+		elif isinstance(e, subprocess.CalledProcessError):
+			status, error = 500, e.stdout
+		else:
+			logging.exception(f'BatchBuild: device #{i} failed')
+			status, error = 500, f'{type(e).__name__}: {e}'
+
+		result = self._result(i)
+		result.update({
+			'state': 'failed',
+			'status': status,
+			'error': error,
+		})
+		return result
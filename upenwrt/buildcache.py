@@ -0,0 +1,134 @@
+#!/hint/python3
+
+import os.path as p
+import logging
+import hashlib
+import json
+import time
+from contextlib import asynccontextmanager
+
+from . import wrapio
+
+
+class BuildCache:
+	def __init__(self, *, context):
+		self.context = context
+		self.cachedir = p.join(context.cachedir, 'builds')
+		self.size = context.build_cache_size
+
+
+	@property
+	def enabled(self):
+		return self.size > 0
+
+
+	@staticmethod
+	def make_key(*, imagebuilder, profile, packages):
+		manifest = {
+			'imagebuilder': imagebuilder,
+			'profile': profile,
+			'packages': sorted(packages),
+		}
+		return hashlib.sha256(json.dumps(manifest, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+	@asynccontextmanager
+	async def pin(self, key):
+		# entries in use by this or another worker are never evicted
+		if not self.enabled:
+			yield
+			return
+		async with self.context.cache.pin(p.join(self.cachedir, key)):
+			yield
+
+
+	@asynccontextmanager
+	async def lock(self, key):
+		# held while building, so that an identical build in another worker waits for ours and then hits the cache
+		if not self.enabled:
+			yield
+			return
+		async with self.context.locks.lock(f'build:{key}'):
+			yield
+
+
+	async def lookup(self, key, *, record=True):
+		if not self.enabled:
+			return None
+
+		entry = p.join(self.cachedir, key)
+		try:
+			files = await wrapio.os_listdir(entry)
+		except FileNotFoundError:
+			logging.debug(f'BuildCache: miss: {key}')
+			if record:
+				self.context.cache.record('builds', hit=False)
+			return None
+		if len(files) != 1:
+			logging.warning(f'BuildCache: bad entry {entry}: {files}, discarding')
+			await wrapio.shutil_rmtree(entry, ignore_errors=True)
+			return None
+
+		# mark as recently used
+		await wrapio.os_utime(entry)
+		logging.info(f'BuildCache: hit: {key}')
+		if record:
+			self.context.cache.record('builds', hit=True)
+		return p.join(entry, files[0])
+
+
+	async def store(self, key, output):
+		if not self.enabled:
+			return output
+
+		await wrapio.os_makedirs(self.cachedir, exist_ok=True)
+		entry = p.join(self.cachedir, key)
+		staging = await wrapio.tempfile_mkdtemp(dir=self.cachedir, prefix=f'.{key}.')
+		try:
+			await wrapio.shutil_copyfile(output, p.join(staging, p.basename(output)))
+			await wrapio.os_rename(staging, entry)
+		except OSError:
+			# lost a race against an identical build, keep the existing entry
+			await wrapio.shutil_rmtree(staging, ignore_errors=True)
+			if not p.isdir(entry):
+				raise
+		logging.info(f'BuildCache: stored: {key}')
+
+		await self.evict(keep=key)
+		return p.join(entry, p.basename(output))
+
+
+	async def _scan(self):
+		entries = []
+		for name in await wrapio.os_listdir(self.cachedir):
+			if name.startswith('.'):
+				continue
+			entry = p.join(self.cachedir, name)
+			try:
+				st = await wrapio.os_stat(entry)
+				size = 0
+				for f in await wrapio.os_listdir(entry):
+					size += (await wrapio.os_stat(p.join(entry, f))).st_size
+			except FileNotFoundError:
+				# evicted by another worker
+				continue
+			entries.append((st.st_mtime, name, size))
+		return sorted(entries)
+
+
+	async def evict(self, keep=None):
+		entries = await self._scan()
+		total = sum(size for _, _, size in entries)
+		for mtime, name, size in entries:
+			if total <= self.size:
+				break
+			if name == keep or self.context.cache.in_use(f'builds/{name}'):
+				continue
+			# entries pinned by other workers hold a shared lock
+			with self.context.locks.try_lock(f'cache:builds/{name}') as unused:
+				if not unused:
+					continue
+				logging.info(f'BuildCache: evicting {name} ({size} bytes, last used {time.ctime(mtime)})')
+				await wrapio.shutil_rmtree(p.join(self.cachedir, name), ignore_errors=True)
+				self.context.locks.unlink(f'cache:builds/{name}')
+			total -= size
@@ -0,0 +1,211 @@
+#!/hint/python3
+
+import os
+import os.path as p
+import logging
+import asyncio
+import collections
+import shutil
+import time
+import aiofiles.os
+
+from .filelock import FileLocks
+from contextlib import asynccontextmanager
+
+
+class CacheManager:
+	# directories under cachedir that are bounded by their own caches and only accounted here
+	SELF_MANAGED = ( 'builds', 'packages' )
+	# directories under cachedir whose every entry is evicted as a whole
+	MANAGED = ( 'index', 'targetinfo', 'sha256sums', 'manifests' )
+
+	INTERVAL = 60
+	# entries used this recently are never evicted, covering the gap between looking a file up and pinning it
+	GRACE = 300
+
+	def __init__(self, *, context):
+		self.context = context
+		self.cachedir = context.cachedir
+		self.size = context.cache_size
+		self.pins = collections.Counter()
+		# shared locks announcing our pins to other workers
+		self.pin_fds = dict()
+		self.accessed = dict()
+		self.counters = collections.defaultdict(lambda: { 'hits': 0, 'misses': 0 })
+		self.evicted = 0
+		self.task = None
+
+
+	@staticmethod
+	def category(key):
+		head, _, _ = key.partition('/')
+		return head if head in CacheManager.MANAGED + CacheManager.SELF_MANAGED else 'imagebuilders'
+
+
+	def entry(self, path):
+		# imagebuilders are evicted together with their sidecars (.sha256, .tar.zst, .part)
+		rel = p.relpath(path, self.cachedir)
+		head, _, tail = rel.partition('/')
+		if not tail:
+			return head.split('.tar.', 1)[0]
+		return f'{head}/{tail.split("/", 1)[0]}'
+
+
+	async def touch(self, path):
+		key = self.entry(path)
+		self.accessed[key] = time.time()
+		# the mtime of the lock file tells other workers when we last used the entry
+		await aiofiles.os.wrap(self.context.locks.touch)(f'cache:{key}')
+
+
+	@staticmethod
+	def _unpin(task):
+		if not task.cancelled() and task.exception() is None:
+			FileLocks.release(task.result())
+
+
+	@asynccontextmanager
+	async def pin(self, path):
+		key = self.entry(path)
+		self.pins[key] += 1
+		try:
+			# the shared lock is taken once per process, by whichever task pins the entry first, without blocking the loop
+			if key not in self.pin_fds:
+				self.pin_fds[key] = asyncio.ensure_future(self.context.locks.acquire_async(f'cache:{key}', shared=True))
+			await asyncio.shield(self.pin_fds[key])
+			await self.touch(path)
+			yield
+		finally:
+			self.pins[key] -= 1
+			if not self.pins[key]:
+				del self.pins[key]
+				self.pin_fds.pop(key).add_done_callback(CacheManager._unpin)
+			await self.touch(path)
+
+
+	def record(self, category, *, hit, count=1):
+		self.counters[category]['hits' if hit else 'misses'] += count
+
+
+	def in_use(self, key):
+		return bool(self.pins[key])
+
+
+	def _scan_sync(self):
+		entries = dict()
+
+		for root, dirs, files in os.walk(self.cachedir):
+			for name in files:
+				path = p.join(root, name)
+				try:
+					st = os.lstat(path)
+				except FileNotFoundError:
+					continue
+				key = self.entry(path)
+				size, atime = entries.get(key, (0, 0))
+				entries[key] = (size + st.st_size, max(atime, st.st_atime, st.st_mtime))
+
+		return {
+			key: (size, max(atime, self.accessed.get(key, 0), self.context.locks.mtime(f'cache:{key}')))
+			for key, (size, atime) in entries.items()
+		}
+
+
+	def _remove(self, key):
+		if '/' in key:
+			path = p.join(self.cachedir, key)
+			if p.isdir(path):
+				shutil.rmtree(path, ignore_errors=True)
+			else:
+				os.unlink(path)
+		else:
+			for name in os.listdir(self.cachedir):
+				if name.split('.tar.', 1)[0] == key:
+					os.unlink(p.join(self.cachedir, name))
+		self.accessed.pop(key, None)
+
+
+	def _collect_sync(self):
+		entries = self._scan_sync()
+		evictable = [
+			(atime, key, size)
+			for key, (size, atime) in entries.items()
+			if CacheManager.category(key) not in CacheManager.SELF_MANAGED and not p.basename(key).startswith('.')
+		]
+
+		total = sum(size for _, _, size in evictable)
+		deadline = time.time() - CacheManager.GRACE
+		for atime, key, size in sorted(evictable):
+			if total <= self.size:
+				break
+			if atime >= deadline or self.in_use(key):
+				continue
+			# entries pinned by other workers hold a shared lock
+			with self.context.locks.try_lock(f'cache:{key}') as unused:
+				if not unused:
+					continue
+				logging.info(f'CacheManager: evicting {key} ({size} bytes, last used {time.ctime(atime)})')
+				try:
+					self._remove(key)
+				except OSError as e:
+					logging.warning(f'CacheManager: could not evict {key}: {e}')
+					continue
+				self.context.locks.unlink(f'cache:{key}')
+			total -= size
+			self.evicted += 1
+
+
+	async def collect(self):
+		if not p.isdir(self.cachedir):
+			return
+		# one worker at a time
+		with self.context.locks.try_lock('cachemgr') as collecting:
+			if collecting:
+				await aiofiles.os.wrap(self._collect_sync)()
+
+
+	async def start(self):
+		self.task = asyncio.ensure_future(self._run())
+
+
+	async def stop(self):
+		if self.task:
+			self.task.cancel()
+			try:
+				await self.task
+			except asyncio.CancelledError:
+				pass
+			self.task = None
+
+
+	async def _run(self):
+		while True:
+			try:
+				await self.collect()
+			except Exception as e:
+				logging.exception(f'CacheManager: collection failed: {e}')
+			await asyncio.sleep(CacheManager.INTERVAL)
+
+
+	async def stats(self):
+		entries = await aiofiles.os.wrap(self._scan_sync)() if p.isdir(self.cachedir) else dict()
+
+		categories = collections.defaultdict(lambda: { 'entries': 0, 'bytes': 0 })
+		for key, (size, atime) in entries.items():
+			category = categories[CacheManager.category(key)]
+			category['entries'] += 1
+			category['bytes'] += size
+
+		for name, counters in self.counters.items():
+			category = categories[name]
+			category.update(counters)
+			lookups = counters['hits'] + counters['misses']
+			category['hit_rate'] = counters['hits'] / lookups if lookups else None
+
+		return {
+			'budget': self.size,
+			'bytes': sum(c['bytes'] for c in categories.values()),
+			'pinned': sorted(self.pins),
+			'evicted': self.evicted,
+			'categories': categories,
+		}
@@ -0,0 +1,123 @@
+#!/hint/python3
+
+import os.path as p
+import logging
+import asyncio
+import time
+import collections
+import attr
+from contextlib import asynccontextmanager
+
+from . import util
+from . import wrapio
+
+
+@attr.s(kw_only=True)
+class SourceCheckout:
+	key = attr.ib(type=tuple)
+	path = attr.ib(type=str)
+	# held while running the buildsystem in the tree
+	lock = attr.ib(factory=asyncio.Lock)
+	refcount = attr.ib(type=int, default=0)
+	last_used = attr.ib(type=float, factory=time.monotonic)
+
+
+class CheckoutManager:
+	def __init__(self, *, context):
+		self.context = context
+		self.checkoutdir = context.checkoutdir
+		self.size = context.checkout_cache_size
+		self.checkouts = dict()
+		self.locks = dict()
+		self.users = collections.Counter()
+
+
+	async def start(self):
+		if p.exists(self.checkoutdir):
+			await wrapio.shutil_rmtree(self.checkoutdir)
+		await wrapio.os_makedirs(self.checkoutdir, exist_ok=True)
+
+
+	async def stop(self):
+		for checkout in self.checkouts.values():
+			await self._remove(checkout)
+		self.checkouts.clear()
+
+
+	async def _create(self, *, repo_path, commit, patches):
+		path = await wrapio.tempfile_mkdtemp(dir=self.checkoutdir, prefix=f'{commit[:12]}.')
+		logging.info(f'CheckoutManager: checking out {commit} into {path}')
+		try:
+			with self.context.metrics.phase_seconds.time(phase='checkout'):
+				# objects are borrowed from the bare repository via alternates
+				git_clone = await util.run(
+					[ 'git', 'clone', '--shared', '--no-checkout', repo_path, path ],
+					cwd=self.checkoutdir,
+				)
+				git_checkout = await util.run(
+					[ 'git', 'checkout', '--force', '--detach', commit ],
+					cwd=path,
+				)
+				for f in patches:
+					git_am = await util.run(
+						[ 'git', 'am', '-3', f ],
+						cwd=path,
+					)
+		except:
+			await wrapio.shutil_rmtree(path, ignore_errors=True)
+			raise
+		return path
+
+
+	async def _remove(self, checkout):
+		logging.info(f'CheckoutManager: removing {checkout.path}')
+		await wrapio.shutil_rmtree(checkout.path, ignore_errors=True)
+
+
+	async def _collect(self):
+		idle = sorted(
+			( c for c in self.checkouts.values() if c.refcount == 0 ),
+			key=lambda c: c.last_used,
+		)
+		excess = len(self.checkouts) - self.size
+		for checkout in idle[:max(excess, 0)]:
+			if checkout.refcount == 0 and self.checkouts.get(checkout.key) is checkout:
+				del self.checkouts[checkout.key]
+				self._prune(checkout.key)
+				await self._remove(checkout)
+
+
+	def _prune(self, key):
+		# the lock of a key is kept for as long as the key is checked out, or anybody holds or waits for it
+		if key not in self.checkouts and key not in self.users:
+			self.locks.pop(key, None)
+
+
+	@asynccontextmanager
+	async def checkout(self, *, repo_path, commit, patches, patches_hash):
+		key = (commit, patches_hash)
+
+		self.users[key] += 1
+		try:
+			async with self.locks.setdefault(key, asyncio.Lock()):
+				checkout = self.checkouts.get(key)
+				if checkout is None:
+					path = await self._create(repo_path=repo_path, commit=commit, patches=patches)
+					# noinspection PyArgumentList
+					checkout = SourceCheckout(key=key, path=path)
+					self.checkouts[key] = checkout
+				else:
+					logging.debug(f'CheckoutManager: reusing {checkout.path} for {commit}')
+				checkout.refcount += 1
+		finally:
+			self.users[key] -= 1
+			if not self.users[key]:
+				del self.users[key]
+			self._prune(key)
+
+		try:
+			yield checkout
+		finally:
+			checkout.refcount -= 1
+			checkout.last_used = time.monotonic()
+			await self._collect()
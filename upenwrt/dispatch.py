@@ -0,0 +1,233 @@
+#!/hint/python3
+
+import os.path as p
+import json
+import logging
+import asyncio
+import time
+import aiohttp
+import aiohttp.web
+import attr
+
+from .util import UpenwrtBusyError
+
+
+@attr.s(kw_only=True)
+class BuildWorker:
+	url = attr.ib(type=str)
+	healthy = attr.ib(type=bool, default=False)
+	# as last reported by the worker itself
+	operations = attr.ib(type=int, default=0)
+	queued = attr.ib(type=int, default=0)
+	capacity = attr.ib(type=int, default=1)
+	warm = attr.ib(type=set, factory=set)
+	cached = attr.ib(type=set, factory=set)
+	# requests we have forwarded and not yet seen completed
+	inflight = attr.ib(type=int, default=0)
+	# (version, target) pairs we sent there since the last report
+	assigned = attr.ib(type=set, factory=set)
+
+	def load(self):
+		return max(self.operations + self.queued, self.inflight) / max(self.capacity, 1)
+
+	def warmth(self, key):
+		if key in self.warm:
+			return 2
+		if key in self.cached or key in self.assigned:
+			return 1
+		return 0
+
+
+class Dispatcher:
+	# hop-by-hop headers and those that aiohttp computes by itself
+	SKIP_HEADERS = { 'connection', 'keep-alive', 'transfer-encoding', 'upgrade', 'host', 'content-length' }
+	# request bodies are read already decoded
+	SKIP_REQUEST_HEADERS = SKIP_HEADERS | { 'content-encoding' }
+	CHUNK_SIZE = 256 * 1024
+
+	def __init__(self, *, context):
+		self.context = context
+		self.interval = context.dispatch_interval
+		self.workers = [ BuildWorker(url=url.rstrip('/')) for url in context.dispatch ]
+		# job id -> (worker, submitted at)
+		self.jobs = dict()
+		self.session = None
+		self.task = None
+
+
+	@property
+	def enabled(self):
+		return bool(self.workers)
+
+
+	async def start(self):
+		if not self.enabled:
+			return
+		self.session = aiohttp.ClientSession(auto_decompress=False)
+		await self.poll()
+		self.task = asyncio.ensure_future(self._run())
+
+
+	async def stop(self):
+		if self.task:
+			self.task.cancel()
+			try:
+				await self.task
+			except asyncio.CancelledError:
+				pass
+			self.task = None
+		if self.session:
+			await self.session.close()
+			self.session = None
+
+
+	async def _run(self):
+		while True:
+			await asyncio.sleep(self.interval)
+			try:
+				await self.poll()
+			except Exception as e:
+				logging.exception(f'Dispatcher: poll failed: {e}')
+
+
+	async def poll(self):
+		await asyncio.gather(*[ self._poll(worker) for worker in self.workers ])
+
+		deadline = time.monotonic() - self.context.job_ttl
+		for job_id, (worker, submitted_at) in list(self.jobs.items()):
+			if submitted_at < deadline:
+				del self.jobs[job_id]
+
+
+	async def _poll(self, worker):
+		try:
+			async with self.session.get(f'{worker.url}/api/worker', timeout=aiohttp.ClientTimeout(total=self.interval)) as r:
+				r.raise_for_status()
+				status = await r.json()
+			# a worker that does not report in the expected shape is as good as unreachable
+			operations = int(status['operations'])
+			queued = int(status['queued'])
+			capacity = int(status['capacity'])
+			warm = { tuple(key) for key in status['warm'] }
+			cached = { tuple(key) for key in status['cached'] }
+		except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError, TypeError) as e:
+			if worker.healthy:
+				logging.warning(f'Dispatcher: worker {worker.url} is unavailable: {type(e).__name__}: {e}')
+			worker.healthy = False
+			return
+
+		if not worker.healthy:
+			logging.info(f'Dispatcher: worker {worker.url} is available')
+		worker.healthy = True
+		worker.operations = operations
+		worker.queued = queued
+		worker.capacity = capacity
+		worker.warm = warm
+		worker.cached = cached
+		worker.assigned.clear()
+
+
+	def candidates(self, key):
+		# saturated workers come last, then prefer those that already have the imagebuilder, then the least loaded
+		healthy = [ w for w in self.workers if w.healthy ]
+		return sorted(healthy, key=lambda w: (w.load() >= 1, -w.warmth(key), w.load()))
+
+
+	def busy(self):
+		return UpenwrtBusyError(
+			f'No build workers available, try again later.',
+			retry_after=self.context.retry_after,
+		)
+
+
+	async def forward(self, request: aiohttp.web.Request, *, key=None, worker=None, path=None, fallthrough=()):
+		# responses with a status in `fallthrough` are passed on only if no other worker answers differently
+		body = await request.read()
+		path = path or p.relpath(request.rel_url.path, self.context.baseurlpath)
+		headers = {
+			k: v for k, v in request.headers.items()
+			if k.lower() not in Dispatcher.SKIP_REQUEST_HEADERS
+		}
+
+		workers = [ worker ] if worker else self.candidates(key)
+		for i, worker in enumerate(workers):
+			worker.inflight += 1
+			try:
+				try:
+					r = await self.session.request(
+						request.method,
+						f'{worker.url}/{path}',
+						params=request.query,
+						data=body,
+						headers=headers,
+						allow_redirects=False,
+					)
+				except aiohttp.ClientConnectionError as e:
+					# nothing has been sent to the client yet, try the next worker
+					logging.warning(f'Dispatcher: worker {worker.url} failed: {e}')
+					worker.healthy = False
+					continue
+
+				if r.status in fallthrough and i < len(workers) - 1:
+					r.release()
+					continue
+				if key is not None:
+					worker.assigned.add(key)
+				logging.debug(f'Dispatcher: {request.method} {path} -> {worker.url}')
+				async with r:
+					return worker, await self._relay(request, r, worker)
+			finally:
+				worker.inflight -= 1
+
+		raise self.busy()
+
+
+	async def _relay(self, request, r, worker):
+		if r.content_type == 'application/json':
+			# small enough to be rewritten by the caller
+			return aiohttp.web.Response(status=r.status, body=await r.read(), headers=self._headers(r))
+
+		response = aiohttp.web.StreamResponse(status=r.status, headers=self._headers(r))
+		if r.content_type == 'application/x-ndjson':
+			# batch results refer to jobs on the worker
+			await response.prepare(request)
+			async for line in r.content:
+				await response.write(self._rewrite_result(line, worker))
+		else:
+			if r.content_length is not None:
+				response.content_length = r.content_length
+			await response.prepare(request)
+			async for chunk in r.content.iter_chunked(Dispatcher.CHUNK_SIZE):
+				await response.write(chunk)
+		await response.write_eof()
+		return response
+
+
+	def _rewrite_result(self, line, worker):
+		try:
+			result = json.loads(line)
+		except ValueError:
+			return line
+		if 'job' not in result:
+			return line
+		self.add_job(result['job'], worker)
+		if 'image_url' in result:
+			result['image_url'] = f'{self.context.baseurl.rstrip("/")}/api/jobs/{result["job"]}/image'
+		return json.dumps(result).encode('utf-8') + b'\n'
+
+
+	@staticmethod
+	def _headers(r):
+		return {
+			k: v for k, v in r.headers.items()
+			if k.lower() not in Dispatcher.SKIP_HEADERS
+		}
+
+
+	def add_job(self, job_id, worker):
+		self.jobs[job_id] = (worker, time.monotonic())
+
+
+	def job_worker(self, job_id):
+		worker, _ = self.jobs.get(job_id, (None, None))
+		return worker
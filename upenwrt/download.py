@@ -0,0 +1,296 @@
+#!/hint/python3
+
+import os
+import os.path as p
+import json
+import hashlib
+import collections
+import logging
+import tempfile
+import asyncio
+import requests
+import aiohttp
+import aiofiles
+import aiofiles.os
+
+from . import util
+from .util import UpenwrtError
+from . import wrapio
+
+
+class DownloadRestart(Exception):
+	pass
+
+
+class Downloader:
+	CHUNK_SIZE = 256 * 1024
+	MIN_SEGMENT_SIZE = 8 << 20
+	# how much data may be downloaded between two saves of the resume state
+	STATE_INTERVAL = 16 << 20
+
+	def __init__(self, *, segments=4, session=None, locks=None):
+		self.segments = segments
+		self.session = session
+		self.own_session = session is None
+		# FileLocks shared with other processes, if any
+		self.file_locks = locks
+		self.locks = collections.defaultdict(asyncio.Lock)
+
+
+	def get_session(self):
+		if self.session is None:
+			self.session = aiohttp.ClientSession()
+		return self.session
+
+
+	async def close(self):
+		if self.own_session and self.session is not None:
+			await self.session.close()
+			self.session = None
+
+
+	@staticmethod
+	def _load_state(path):
+		try:
+			with open(path, 'r') as f:
+				return json.load(f)
+		except (FileNotFoundError, ValueError):
+			return None
+
+
+	@staticmethod
+	def _save_state(path, data):
+		# a cancelled save may still be running in its thread, so every save stages through a file of its own
+		fd, staging_path = tempfile.mkstemp(dir=p.dirname(path), prefix=f'.{p.basename(path)}.')
+		with open(fd, 'w') as f:
+			f.write(data)
+		os.rename(staging_path, path)
+
+
+	@staticmethod
+	async def _checkpoint(path, state, saving):
+		# segments reach their checkpoints concurrently: the state is snapshotted on the loop, where nothing
+		# mutates it underneath, and saves are serialized so that they land in order
+		async with saving:
+			await aiofiles.os.wrap(Downloader._save_state)(path, json.dumps(state))
+
+
+	@staticmethod
+	def _remove(path):
+		try:
+			os.unlink(path)
+		except FileNotFoundError:
+			pass
+
+
+	@staticmethod
+	def _hash_file(path):
+		h = hashlib.sha256()
+		with open(path, 'rb') as f:
+			for chunk in iter(lambda: f.read(1 << 20), b''):
+				h.update(chunk)
+		return h.hexdigest()
+
+
+	@staticmethod
+	def _write_sidecar(path, digest):
+		st = os.stat(path)
+		Downloader._save_sidecar(f'{path}.sha256', f'{digest} {st.st_size} {st.st_mtime_ns}\n')
+
+
+	@staticmethod
+	def _save_sidecar(path, data):
+		# may race against other workers (or threads) hashing the same file
+		fd, staging_path = tempfile.mkstemp(dir=p.dirname(path), prefix=f'.{p.basename(path)}.')
+		with open(fd, 'w') as f:
+			f.write(data)
+		os.rename(staging_path, path)
+
+
+	@staticmethod
+	def _get_sha256(path):
+		# the hash of a file is remembered next to it for as long as the file does not change
+		st = os.stat(path)
+		try:
+			with open(f'{path}.sha256', 'r') as f:
+				digest, size, mtime_ns = f.read().split()
+			if (int(size), int(mtime_ns)) == (st.st_size, st.st_mtime_ns):
+				return digest
+		except (FileNotFoundError, ValueError):
+			pass
+
+		digest = Downloader._hash_file(path)
+		Downloader._write_sidecar(path, digest)
+		return digest
+
+
+	async def get_sha256(self, path):
+		return await aiofiles.os.wrap(Downloader._get_sha256)(path)
+
+
+	@staticmethod
+	def _create(path, size):
+		fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+		try:
+			os.ftruncate(fd, size)
+		finally:
+			os.close(fd)
+
+
+	@staticmethod
+	def _pwrite(fd, data, offset):
+		view = memoryview(data)
+		while view:
+			written = os.pwrite(fd, view, offset)
+			view = view[written:]
+			offset += written
+
+
+	async def get_file(self, url, *, dest, sha256=None, headers=None):
+		# concurrent requests for the same file (from any worker) wait for a single download
+		lock = self.file_locks.lock(f'download:{dest}') if self.file_locks else self.locks[dest]
+		async with lock:
+			return await self._get_file(url, dest=dest, sha256=sha256, headers=headers)
+
+
+	async def _get_file(self, url, *, dest, sha256, headers):
+		headers = dict(headers or {})
+
+		try:
+			st = await wrapio.os_stat(dest)
+			if sha256 is None:
+				headers['If-Modified-Since'] = util.get_last_modified(st)
+			elif await self.get_sha256(dest) == sha256:
+				logging.info(f'get_file(url={url}, dest={dest}): matches sha256 {sha256}, not downloading')
+				return False
+			else:
+				logging.info(f'get_file(url={url}, dest={dest}): does not match sha256 {sha256}, proceeding')
+		except FileNotFoundError:
+			logging.info(f'get_file(url={url}, dest={dest}): dest does not exist, proceeding')
+
+		async with self.get_session().head(url, headers=headers, allow_redirects=True) as r:
+			if r.status == requests.codes.not_modified:
+				logging.info(f'get_file(url={url}, dest={dest}): not modified')
+				return False
+			r.raise_for_status()
+
+			# fetch the segments from wherever the mirror redirector sent us
+			url = str(r.url)
+			size = r.content_length
+			accept_ranges = r.headers.get('Accept-Ranges') == 'bytes'
+			last_modified = r.headers.get('Last-Modified')
+			etag = r.headers.get('ETag')
+
+		if 'If-Modified-Since' in headers and last_modified:
+			req_mtime = util.parse_last_modified(headers['If-Modified-Since'])
+			resp_mtime = util.parse_last_modified(last_modified)
+			if resp_mtime <= req_mtime:
+				logging.warning(f'get_file(url={url}, dest={dest}): remote is not new enough (Last-Modified={last_modified}, If-Modified-Since={headers["If-Modified-Since"]})!')
+				return False
+
+		# weak validators cannot be used with If-Range
+		validator = etag if etag and not etag.startswith('W/') else last_modified
+
+		await wrapio.os_makedirs(p.dirname(dest), exist_ok=True)
+		part = f'{dest}.part'
+		state_path = f'{part}.state'
+
+		if accept_ranges and size and self.segments > 1 and size >= 2 * Downloader.MIN_SEGMENT_SIZE:
+			try:
+				digest = await self._get_ranged(url, part=part, state_path=state_path, size=size, validator=validator)
+			except DownloadRestart as e:
+				logging.warning(f'get_file(url={url}, dest={dest}): {e}, falling back to a single request')
+				await aiofiles.os.wrap(Downloader._remove)(state_path)
+				digest = await self._get_single(url, part=part)
+		else:
+			digest = await self._get_single(url, part=part)
+
+		if sha256 is not None and digest != sha256:
+			await aiofiles.os.wrap(Downloader._remove)(part)
+			await aiofiles.os.wrap(Downloader._remove)(state_path)
+			raise UpenwrtError(f'get_file(url={url}, dest={dest}): sha256 mismatch (expected {sha256}, got {digest})')
+
+		if last_modified:
+			mtime = util.parse_last_modified(last_modified)
+			await wrapio.os_utime(part, (mtime, mtime))
+		await wrapio.os_rename(part, dest)
+		await aiofiles.os.wrap(Downloader._remove)(state_path)
+		await aiofiles.os.wrap(Downloader._write_sidecar)(dest, digest)
+
+		logging.info(f'get_file(url={url}, dest={dest}): downloaded {size} bytes')
+		return True
+
+
+	async def _get_single(self, url, *, part):
+		async with self.get_session().get(url) as r:
+			r.raise_for_status()
+			logging.debug(f'get_file(url={url}): commencing download of {r.content_length} bytes')
+			# hash the data on its way to the disk, rather than reading it back afterwards
+			h = hashlib.sha256()
+			async with aiofiles.open(part, 'wb') as f:
+				async for chunk in r.content.iter_chunked(Downloader.CHUNK_SIZE):
+					h.update(chunk)
+					await f.write(chunk)
+			return h.hexdigest()
+
+
+	async def _get_ranged(self, url, *, part, state_path, size, validator):
+		state = await aiofiles.os.wrap(Downloader._load_state)(state_path)
+		if state and state['url'] == url and state['size'] == size and state['validator'] == validator and p.exists(part):
+			left = sum(end - pos for start, pos, end in state['segments'])
+			logging.info(f'get_file(url={url}): resuming download, {left} of {size} bytes left')
+		else:
+			step = max(Downloader.MIN_SEGMENT_SIZE, -(-size // self.segments))
+			state = {
+				'url': url,
+				'size': size,
+				'validator': validator,
+				# [ start, position, end ) of every segment
+				'segments': [ [ start, start, min(start + step, size) ] for start in range(0, size, step) ],
+			}
+			await aiofiles.os.wrap(Downloader._create)(part, size)
+			logging.debug(f'get_file(url={url}): commencing download of {size} bytes in {len(state["segments"])} segments')
+
+		fd = await wrapio.os_open(part, os.O_WRONLY)
+		progress = { 'unsaved': 0, 'saving': asyncio.Lock() }
+		tasks = [
+			asyncio.ensure_future(self._get_segment(url, fd=fd, segment=segment, validator=validator, state=state, state_path=state_path, progress=progress))
+			for segment in state['segments']
+			if segment[1] < segment[2]
+		]
+		try:
+			await asyncio.gather(*tasks)
+		finally:
+			for task in tasks:
+				task.cancel()
+			await asyncio.gather(*tasks, return_exceptions=True)
+			os.close(fd)
+			await Downloader._checkpoint(state_path, state, progress['saving'])
+
+		# segments arrive out of order, so the complete file is hashed in one pass (mostly from the page cache)
+		return await aiofiles.os.wrap(Downloader._hash_file)(part)
+
+
+	async def _get_segment(self, url, *, fd, segment, validator, state, state_path, progress):
+		start, pos, end = segment
+		headers = { 'Range': f'bytes={pos}-{end - 1}' }
+		if validator:
+			headers['If-Range'] = validator
+
+		async with self.get_session().get(url, headers=headers) as r:
+			r.raise_for_status()
+			if r.status != requests.codes.partial_content:
+				raise DownloadRestart(f'remote ignored the range request (status {r.status})')
+
+			async for chunk in r.content.iter_chunked(Downloader.CHUNK_SIZE):
+				chunk = chunk[:segment[2] - segment[1]]
+				await aiofiles.os.wrap(Downloader._pwrite)(fd, chunk, segment[1])
+				segment[1] += len(chunk)
+
+				progress['unsaved'] += len(chunk)
+				if progress['unsaved'] >= Downloader.STATE_INTERVAL:
+					progress['unsaved'] = 0
+					await Downloader._checkpoint(state_path, state, progress['saving'])
+
+		if segment[1] < segment[2]:
+			raise aiohttp.ClientPayloadError(f'get_file(url={url}): segment [{start}, {end}) ended at {segment[1]}')
@@ -0,0 +1,141 @@
+#!/hint/python3
+
+import os
+import os.path as p
+import asyncio
+import collections
+import hashlib
+import fcntl
+import urllib.parse
+from contextlib import asynccontextmanager, contextmanager
+
+
+class FileLocks:
+	# flock(2) has no asynchronous form, so waiting is done by polling with backoff
+	POLL_MIN = 0.01
+	POLL_MAX = 0.5
+
+	def __init__(self, *, lockdir):
+		# advisory locks shared by every process serving the same basedir
+		self.lockdir = lockdir
+		# in-process locks exist only while some task holds or waits for them
+		self.locks = dict()
+		self.users = collections.Counter()
+
+
+	def path(self, key):
+		name = urllib.parse.quote(key, safe='')
+		if len(name) > 200:
+			name = hashlib.sha256(key.encode('utf-8')).hexdigest()
+		return p.join(self.lockdir, name)
+
+
+	def open(self, key):
+		os.makedirs(self.lockdir, exist_ok=True)
+		return os.open(self.path(key), os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o644)
+
+
+	def is_current(self, fd, key):
+		try:
+			st = os.stat(self.path(key))
+		except FileNotFoundError:
+			return False
+		fst = os.fstat(fd)
+		return (st.st_dev, st.st_ino) == (fst.st_dev, fst.st_ino)
+
+
+	def acquire(self, key, *, shared=False, blocking=True):
+		# returns a descriptor that holds the lock until closed, or None if it is held elsewhere
+		while True:
+			fd = self.open(key)
+			try:
+				fcntl.flock(fd, (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | (0 if blocking else fcntl.LOCK_NB))
+			except BlockingIOError:
+				os.close(fd)
+				return None
+			except:
+				os.close(fd)
+				raise
+			# the previous holder may have unlinked the file, and a lock on it no longer excludes anyone
+			if self.is_current(fd, key):
+				return fd
+			os.close(fd)
+
+
+	@staticmethod
+	def release(fd):
+		os.close(fd)
+
+
+	def unlink(self, key):
+		# only while holding the lock exclusively: waiters on the old file will start over with a new one
+		try:
+			os.unlink(self.path(key))
+		except FileNotFoundError:
+			pass
+
+
+	def touch(self, key):
+		os.close(self.open(key))
+		os.utime(self.path(key))
+
+
+	def mtime(self, key):
+		try:
+			return os.stat(self.path(key)).st_mtime
+		except FileNotFoundError:
+			return 0
+
+
+	@contextmanager
+	def try_lock(self, key):
+		fd = self.acquire(key, blocking=False)
+		try:
+			yield fd is not None
+		finally:
+			if fd is not None:
+				FileLocks.release(fd)
+
+
+	@contextmanager
+	def lock_sync(self, key):
+		# for code running in executor threads
+		fd = self.acquire(key)
+		try:
+			yield
+		finally:
+			FileLocks.release(fd)
+
+
+	async def acquire_async(self, key, *, shared=False):
+		delay = FileLocks.POLL_MIN
+		while True:
+			fd = self.acquire(key, shared=shared, blocking=False)
+			if fd is not None:
+				return fd
+			await asyncio.sleep(delay)
+			delay = min(delay * 2, FileLocks.POLL_MAX)
+
+
+	@asynccontextmanager
+	async def lock(self, key):
+		# tasks of this process queue up on an asyncio.Lock, so that only one of them polls the file lock
+		lock = self.locks.get(key)
+		if lock is None:
+			lock = self.locks[key] = asyncio.Lock()
+		self.users[key] += 1
+		try:
+			async with lock:
+				fd = await self.acquire_async(key)
+				try:
+					yield
+				finally:
+					# these keys name transient things (a download, a build...), so their files are not kept around
+					if self.users[key] == 1:
+						self.unlink(key)
+					FileLocks.release(fd)
+		finally:
+			self.users[key] -= 1
+			if not self.users[key]:
+				del self.users[key]
+				del self.locks[key]
@@ -0,0 +1,257 @@
+#!/hint/python3
+
+import os
+import os.path as p
+import re
+import glob
+import json
+import logging
+import asyncio
+import time
+import uuid
+import subprocess
+import traceback
+import contextlib
+import attr
+
+from . import wrapio
+from .util import UpenwrtUserError, UpenwrtBusyError
+
+
+@attr.s(kw_only=True)
+class BuildJob:
+	id = attr.ib(type=str)
+	# dropped once the job has finished, along with the build it was attached to
+	op = attr.ib()
+	state = attr.ib(type=str, default='queued')
+	flight = attr.ib(default=None)
+	output = attr.ib(type=str, default=None)
+	# keeps the output in the build cache until the job expires
+	pin = attr.ib(default=None)
+	error = attr.ib(type=str, default=None)
+	error_status = attr.ib(type=int, default=None)
+	submitted_at = attr.ib(type=float, factory=time.time)
+	finished_at = attr.ib(type=float, default=None)
+	finished_phase = attr.ib(type=str, default=None)
+	finished_progress = attr.ib(default=None)
+	task = attr.ib(default=None)
+
+	def _op(self):
+		# while attached to a build, report the progress of whichever operation is doing the work
+		return self.flight.op if self.flight else self.op
+
+	@property
+	def phase(self):
+		op = self._op()
+		return op.phase if op else self.finished_phase
+
+	@property
+	def progress(self):
+		op = self._op()
+		return op.progress if op else self.finished_progress
+
+	def status(self):
+		return {
+			'id': self.id,
+			'state': self.state,
+			'phase': self.phase,
+			'progress': self.progress,
+			'submitted_at': self.submitted_at,
+			'finished_at': self.finished_at,
+			'error': self.error,
+		}
+
+
+@attr.s(kw_only=True)
+class SharedJob:
+	# a job owned by another worker, as last published by it
+	id = attr.ib(type=str)
+	state = attr.ib(type=str)
+	phase = attr.ib(type=str)
+	progress = attr.ib()
+	output = attr.ib(type=str, default=None)
+	error = attr.ib(type=str, default=None)
+	error_status = attr.ib(type=int, default=None)
+	submitted_at = attr.ib(type=float)
+	finished_at = attr.ib(type=float, default=None)
+
+	def status(self):
+		return {
+			'id': self.id,
+			'state': self.state,
+			'phase': self.phase,
+			'progress': self.progress,
+			'submitted_at': self.submitted_at,
+			'finished_at': self.finished_at,
+			'error': self.error,
+		}
+
+
+class JobManager:
+	JOB_ID = re.compile('[0-9a-f]{32}')
+
+	def __init__(self, *, context):
+		self.context = context
+		# with several workers, job state is published here for the others to find
+		self.jobsdir = context.jobsdir
+		# images of finished jobs, when there is no build cache to keep them in
+		self.outputdir = p.join(self.jobsdir or p.join(context.workdir, 'jobs'), 'outputs')
+		self.ttl = context.job_ttl
+		self.semaphore = asyncio.Semaphore(context.job_concurrency)
+		self.jobs = dict()
+		self.task = None
+
+
+	async def start(self):
+		if self.jobsdir:
+			await wrapio.shutil_rmtree(self.jobsdir, ignore_errors=True)
+			await wrapio.os_makedirs(self.jobsdir, exist_ok=True)
+		await wrapio.shutil_rmtree(self.outputdir, ignore_errors=True)
+		self.task = asyncio.ensure_future(self._run())
+
+
+	async def stop(self):
+		if self.task:
+			self.task.cancel()
+			try:
+				await self.task
+			except asyncio.CancelledError:
+				pass
+			self.task = None
+
+		for job in list(self.jobs.values()):
+			await self._discard(job)
+
+
+	async def _run(self):
+		while True:
+			await asyncio.sleep(min(self.ttl, 60))
+			deadline = time.time() - self.ttl
+			for job in list(self.jobs.values()):
+				if job.finished_at is not None and job.finished_at < deadline:
+					logging.debug(f'JobManager: expiring job {job.id}')
+					await self._discard(job)
+
+
+	async def _discard(self, job):
+		self.jobs.pop(job.id, None)
+		self._unpublish(job)
+		if job.task and not job.task.done():
+			job.task.cancel()
+		if job.flight:
+			await job.flight.__aexit__()
+		if job.pin:
+			await job.pin.aclose()
+
+
+	def check_queue(self):
+		self.context.scheduler.check_queue(sum(1 for j in self.jobs.values() if j.state == 'queued'))
+
+
+	def submit(self, op, *, check=True):
+		# batches are admitted as a whole
+		if check:
+			self.check_queue()
+
+		# noinspection PyArgumentList
+		job = BuildJob(
+			id=uuid.uuid4().hex,
+			op=op,
+		)
+		self.jobs[job.id] = job
+		self._publish(job)
+		job.task = asyncio.ensure_future(self._run_job(job))
+		logging.info(f'JobManager: submitted job {job.id}')
+		return job
+
+
+	def get(self, job_id):
+		job = self.jobs.get(job_id)
+		if job is None and self.jobsdir and JobManager.JOB_ID.fullmatch(job_id):
+			job = self._load(job_id)
+		return job
+
+
+	def _publish(self, job):
+		if not self.jobsdir:
+			return
+		data = dict(job.status(), output=job.output, error_status=job.error_status)
+		path = p.join(self.jobsdir, f'{job.id}.json')
+		with open(f'{path}.tmp', 'w') as f:
+			json.dump(data, f)
+		os.rename(f'{path}.tmp', path)
+
+
+	def _unpublish(self, job):
+		if not self.jobsdir:
+			return
+		try:
+			os.unlink(p.join(self.jobsdir, f'{job.id}.json'))
+		except FileNotFoundError:
+			pass
+
+
+	def _load(self, job_id):
+		for path in glob.glob(p.join(p.dirname(self.jobsdir), '*', f'{job_id}.json')):
+			try:
+				with open(path, 'r') as f:
+					return SharedJob(**json.load(f))
+			except (FileNotFoundError, ValueError):
+				continue
+		return None
+
+
+	async def _keep_output(self, job, output):
+		# called while still attached to the build, before its operation may go away
+		job.pin = contextlib.AsyncExitStack()
+		if self.context.build_cache.enabled:
+			await job.pin.enter_async_context(self.context.cache.pin(output))
+			return output
+
+		# the output lives in the operation's work directory, which is removed with it
+		jobdir = p.join(self.outputdir, job.id)
+		job.pin.push_async_callback(wrapio.shutil_rmtree, jobdir, ignore_errors=True)
+		await wrapio.os_makedirs(jobdir, exist_ok=True)
+		copy = p.join(jobdir, p.basename(output))
+		await wrapio.shutil_copyfile(output, copy)
+		return copy
+
+
+	async def _run_job(self, job):
+		try:
+			async with self.semaphore:
+				job.state = 'running'
+				self._publish(job)
+				# leave the build as soon as it is done, so that it is not served to later requests,
+				# and keep only the output
+				job.flight = self.context.flights.join(key=job.op.inputs_key(), op=job.op)
+				async with job.flight:
+					job.output = await self._keep_output(job, await job.flight.result())
+				job.state = 'done'
+		except asyncio.CancelledError:
+			raise
+		except UpenwrtUserError as e:
+			job.state = 'failed'
+			job.error = str(e)
+			job.error_status = 400
+		except UpenwrtBusyError as e:
+			job.state = 'failed'
+			job.error = str(e)
+			job.error_status = 503
+		except subprocess.CalledProcessError as e:
+			job.state = 'failed'
+			job.error = e.stdout
+			job.error_status = 500
+		except Exception as e:
+			logging.exception(f'JobManager: job {job.id} failed')
+			job.state = 'failed'
+			job.error = traceback.format_exc()
+			job.error_status = 500
+		finally:
+			if job.flight:
+				await job.flight.__aexit__()
+			job.finished_phase, job.finished_progress = job.phase, job.progress
+			job.flight = job.op = None
+			job.finished_at = time.time()
+			self._publish(job)
+			logging.info(f'JobManager: job {job.id} finished: {job.state}')
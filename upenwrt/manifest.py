@@ -0,0 +1,147 @@
+#!/hint/python3
+
+import os
+import os.path as p
+import logging
+import hashlib
+import json
+import re
+import tempfile
+import aiofiles
+import aiofiles.os
+from contextlib import asynccontextmanager
+
+from .util import UpenwrtUserError
+
+
+class ManifestIndex:
+	# the canonical manifest, as written by get.sh: one `name=value` line for each of these fields in this order,
+	# then one `pkgs=name` line per package, sorted bytewise and without duplicates
+	FIELDS = ( 'target_name', 'board_name', 'current_release', 'current_revision', 'target_version' )
+	REQUIRED = ( 'target_name', 'board_name', 'target_version' )
+	DIGEST = re.compile(r'[0-9a-f]{64}')
+
+	def __init__(self, *, context):
+		self.context = context
+		self.indexdir = p.join(context.cachedir, 'manifests')
+
+
+	@staticmethod
+	def canonical(*, target_name, board_name, current_release, current_revision, target_version, pkgs):
+		values = ( target_name, board_name, current_release, current_revision, target_version )
+		lines = [ f'{name}={value or ""}' for name, value in zip(ManifestIndex.FIELDS, values) ]
+		lines += [ f'pkgs={pkg}' for pkg in sorted(set(pkgs)) ]
+		return ''.join(f'{line}\n' for line in lines).encode('utf-8')
+
+
+	@staticmethod
+	def digest(manifest):
+		return hashlib.sha256(manifest).hexdigest()
+
+
+	@staticmethod
+	def check_digest(digest):
+		if not ManifestIndex.DIGEST.fullmatch(digest):
+			raise UpenwrtUserError(f'Bad manifest hash: {digest}')
+		return digest
+
+
+	@staticmethod
+	def parse(manifest, digest):
+		if ManifestIndex.digest(manifest) != digest:
+			raise UpenwrtUserError(f'Manifest does not match its hash {digest}')
+		try:
+			text = manifest.decode('utf-8')
+		except UnicodeDecodeError:
+			raise UpenwrtUserError(f'Manifest is not valid UTF-8')
+
+		args = { 'pkgs': [] }
+		for line in text.splitlines():
+			name, sep, value = line.partition('=')
+			if sep and name == 'pkgs':
+				args['pkgs'].append(value)
+			elif sep and name in ManifestIndex.FIELDS and name not in args:
+				args[name] = value or None
+			else:
+				raise UpenwrtUserError(f'Bad manifest line: {line}')
+
+		for name in ManifestIndex.REQUIRED:
+			if not args.get(name):
+				raise UpenwrtUserError(f'Manifest has no {name}')
+		# the hash would never be found again otherwise
+		if ManifestIndex.canonical(**args) != manifest:
+			raise UpenwrtUserError(f'Manifest is not in canonical form (fields out of order, or packages unsorted or repeated)')
+		return args
+
+
+	def path(self, digest):
+		return p.join(self.indexdir, digest)
+
+
+	@staticmethod
+	def _write_sync(path, entry):
+		os.makedirs(p.dirname(path), exist_ok=True)
+		fd, tmp = tempfile.mkstemp(dir=p.dirname(path), prefix=f'.{p.basename(path)}.')
+		try:
+			with os.fdopen(fd, 'w') as f:
+				json.dump(entry, f)
+			os.replace(tmp, path)
+		except:
+			os.unlink(tmp)
+			raise
+
+
+	async def record(self, digest, *, artifact, build_key, profile, packages):
+		entry = {
+			'target_name': artifact.target_name,
+			'version_id': artifact.version_id,
+			'imagebuilder': await artifact.get_imagebuilder_identity(),
+			'build_key': build_key,
+			'profile': profile,
+			'packages': sorted(packages),
+		}
+		await aiofiles.os.wrap(ManifestIndex._write_sync)(self.path(digest), entry)
+		logging.debug(f'ManifestIndex: recorded {digest}: {build_key}')
+
+
+	async def _load(self, digest):
+		try:
+			async with aiofiles.open(self.path(digest), 'r') as f:
+				return json.loads(await f.read())
+		except FileNotFoundError:
+			return None
+		except ValueError as e:
+			logging.warning(f'ManifestIndex: bad entry {digest}: {e}')
+			return None
+
+
+	@asynccontextmanager
+	async def lookup(self, digest):
+		# yields the index entry and the cached image, if this manifest has been built against the current imagebuilder,
+		# keeping the image in the build cache until the caller is done with it
+		entry = await self._load(digest)
+		if entry is None:
+			self.context.cache.record('manifests', hit=False)
+			logging.debug(f'ManifestIndex: miss: {digest}')
+			yield None
+			return
+
+		artifact = self.context.artifacts.get(
+			target_name=entry['target_name'],
+			version_id=entry['version_id'],
+			requested=True,
+		)
+		current = await artifact.peek_imagebuilder_identity() == entry['imagebuilder']
+		if not current:
+			logging.debug(f'ManifestIndex: {digest} was built against another imagebuilder')
+
+		async with self.context.build_cache.pin(entry['build_key']):
+			output = await self.context.build_cache.lookup(entry['build_key'], record=False) if current else None
+			self.context.cache.record('manifests', hit=output is not None)
+			if output is None:
+				logging.debug(f'ManifestIndex: miss: {digest}')
+				yield None
+				return
+			logging.info(f'ManifestIndex: hit: {digest}')
+			await self.context.cache.touch(self.path(digest))
+			yield entry, output
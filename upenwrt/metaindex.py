@@ -0,0 +1,285 @@
+#!/hint/python3
+
+import os
+import os.path as p
+import logging
+import hashlib
+import sqlite3
+import tempfile
+import asyncio
+import weakref
+import contextlib
+import collections
+import aiofiles.os
+from collections.abc import Mapping
+
+from .targetinfo import OpenwrtTargetinfo, OpenwrtPackageinfo, OpenwrtTarget, OpenwrtProfile, OpenwrtPackage
+
+
+class IndexMapping(Mapping):
+	def __init__(self, *, db, table, key, load):
+		self.db = db
+		self.table = table
+		self.key = key
+		self.load = load
+		self.loaded = dict()
+
+	def __getitem__(self, k):
+		try:
+			return self.loaded[k]
+		except KeyError:
+			pass
+		rows = self.db.execute(f'SELECT * FROM {self.table} WHERE {self.key} = ?', (k,)).fetchall()
+		if not rows:
+			raise KeyError(k)
+		v = self.load(rows)
+		self.loaded[k] = v
+		return v
+
+	def __contains__(self, k):
+		if k in self.loaded:
+			return True
+		return self.db.execute(f'SELECT 1 FROM {self.table} WHERE {self.key} = ? LIMIT 1', (k,)).fetchone() is not None
+
+	def __iter__(self):
+		for row in self.db.execute(f'SELECT DISTINCT {self.key} FROM {self.table}'):
+			yield row[0]
+
+	def __len__(self):
+		return self.db.execute(f'SELECT COUNT(DISTINCT {self.key}) FROM {self.table}').fetchone()[0]
+
+
+class IndexedTargetinfo(OpenwrtTargetinfo):
+	def __init__(self, db):
+		self.db = db
+		self.targets = IndexMapping(db=db, table='targets', key='name', load=self._load_target)
+		self.profiles = IndexMapping(db=db, table='profile_keys', key='key', load=self._load_profile_key)
+
+	def _load_profile(self, row):
+		name, target, packages, devices = row
+		# noinspection PyArgumentList
+		return OpenwrtProfile(
+			name=name,
+			target=target,
+			packages=packages.split(),
+			devices=devices.split(),
+		)
+
+	def _load_profile_key(self, rows):
+		(key, profile), = rows
+		row = self.db.execute('SELECT name, target, packages, devices FROM profiles WHERE id = ?', (profile,)).fetchone()
+		return self._load_profile(row)
+
+	def _load_target(self, rows):
+		(name, packages), = rows
+		# noinspection PyArgumentList
+		return OpenwrtTarget(
+			name=name,
+			packages=packages.split(),
+			profiles={
+				row[0]: self._load_profile(row)
+				for row in self.db.execute('SELECT name, target, packages, devices FROM profiles WHERE target = ?', (name,))
+			},
+		)
+
+
+class IndexedPackageinfo(OpenwrtPackageinfo):
+	def __init__(self, db):
+		self.db = db
+		self.packages = IndexMapping(db=db, table='packages', key='name', load=self._load_package)
+		self.aliases = IndexMapping(db=db, table='aliases', key='alias', load=self._load_alias)
+		# consulted for every client package, so kept in memory
+		self.providers = dict(db.execute('SELECT alias, provider FROM providers'))
+		self.correlations = collections.OrderedDict()
+
+	def _load_package(self, rows):
+		(name, provides), = rows
+		# noinspection PyArgumentList
+		return OpenwrtPackage(
+			name=name,
+			aliases=set(provides.split()),
+		)
+
+	def _load_alias(self, rows):
+		return [
+			self._load_package(self.db.execute('SELECT name, provides FROM package_records WHERE seq = ?', (seq,)).fetchall())
+			for alias, seq in rows
+		]
+
+
+class MetadataIndex:
+	# bump whenever the schema or the parsers change
+	VERSION = 3
+
+	TARGETINFO_SCHEMA = '''
+		CREATE TABLE targets (name TEXT PRIMARY KEY, packages TEXT);
+		CREATE TABLE profiles (id INTEGER PRIMARY KEY, name TEXT, target TEXT, packages TEXT, devices TEXT, UNIQUE (target, name));
+		CREATE TABLE profile_keys (key TEXT PRIMARY KEY, profile INTEGER);
+	'''
+
+	PACKAGEINFO_SCHEMA = '''
+		CREATE TABLE packages (name TEXT PRIMARY KEY, provides TEXT);
+		CREATE TABLE package_records (seq INTEGER PRIMARY KEY, name TEXT, provides TEXT);
+		CREATE TABLE aliases (alias TEXT, seq INTEGER);
+		CREATE INDEX aliases_alias ON aliases (alias);
+		CREATE TABLE providers (alias TEXT PRIMARY KEY, provider TEXT);
+	'''
+
+	# indexes nobody uses any more are kept open (and pinned in the cache) for reuse, up to this many
+	IDLE_SIZE = 8
+
+	def __init__(self, *, context):
+		self.context = context
+		self.indexdir = p.join(context.cachedir, 'index')
+		# index path -> (connection, cache pin), least recently used first
+		self.dbs = collections.OrderedDict()
+		self.users = collections.Counter()
+
+
+	@staticmethod
+	def _hash_file(path):
+		h = hashlib.sha256()
+		h.update(f'{MetadataIndex.VERSION}\0'.encode('utf-8'))
+		with open(path, 'rb') as f:
+			for chunk in iter(lambda: f.read(1 << 20), b''):
+				h.update(chunk)
+		return h.hexdigest()
+
+
+	@staticmethod
+	def _write_targetinfo(db, path):
+		targetinfo = OpenwrtTargetinfo(path)
+		db.executescript(MetadataIndex.TARGETINFO_SCHEMA)
+		for target in targetinfo.targets.values():
+			db.execute('INSERT INTO targets VALUES (?, ?)', (target.name, ' '.join(target.packages)))
+			for profile in target.profiles.values():
+				db.execute('INSERT INTO profiles (name, target, packages, devices) VALUES (?, ?, ?, ?)', (
+					profile.name, target.name, ' '.join(profile.packages), ' '.join(profile.devices),
+				))
+		# profile names are only unique within a (sub)target
+		for key, profile in targetinfo.profiles.items():
+			db.execute('INSERT INTO profile_keys SELECT ?, id FROM profiles WHERE target = ? AND name = ?', (
+				key, profile.target.name, profile.name,
+			))
+
+
+	@staticmethod
+	def _write_packageinfo(db, path):
+		packageinfo = OpenwrtPackageinfo(path)
+		db.executescript(MetadataIndex.PACKAGEINFO_SCHEMA)
+		for package in packageinfo.packages.values():
+			db.execute('INSERT INTO packages VALUES (?, ?)', (package.name, ' '.join(sorted(package.aliases))))
+		records = dict()
+		for alias, packages in packageinfo.aliases.items():
+			for package in packages:
+				seq = records.get(id(package))
+				if seq is None:
+					seq = db.execute('INSERT INTO package_records (name, provides) VALUES (?, ?)', (
+						package.name, ' '.join(sorted(package.aliases)),
+					)).lastrowid
+					records[id(package)] = seq
+				db.execute('INSERT INTO aliases VALUES (?, ?)', (alias, seq))
+		for alias, provider in packageinfo.providers.items():
+			db.execute('INSERT INTO providers VALUES (?, ?)', (alias, provider))
+
+
+	def _write_sync(self, path, kind, digest, index_path, write):
+		logging.info(f'MetadataIndex: indexing {path} into {index_path}')
+		os.makedirs(self.indexdir, exist_ok=True)
+		fd, staging_path = tempfile.mkstemp(dir=self.indexdir, prefix=f'.{kind}-{digest}.')
+		os.close(fd)
+		try:
+			db = sqlite3.connect(staging_path)
+			with db, self.context.metrics.phase_seconds.time(phase='metadata'):
+				write(db, path)
+			db.close()
+			os.rename(staging_path, index_path)
+		except:
+			os.unlink(staging_path)
+			raise
+
+
+	def _connect_sync(self, path, kind, digest, index_path, write):
+		self.context.cache.record('index', hit=p.exists(index_path))
+		if not p.exists(index_path):
+			self._write_sync(path, kind, digest, index_path, write)
+		else:
+			logging.debug(f'MetadataIndex: using {index_path} for {path}')
+		return sqlite3.connect(f'file:{index_path}?mode=ro', uri=True, check_same_thread=False)
+
+
+	async def _open(self, path, kind, write):
+		digest = await aiofiles.os.wrap(MetadataIndex._hash_file)(path)
+		index_path = p.join(self.indexdir, f'{kind}-{digest}.sqlite')
+
+		# only one task (and one worker) indexes a given file, the others wait for it
+		async with self.context.locks.lock(f'index:{index_path}'):
+			entry = self.dbs.get(index_path)
+			if entry is None:
+				db = await aiofiles.os.wrap(self._connect_sync)(path, kind, digest, index_path, write)
+				pin = contextlib.AsyncExitStack()
+				try:
+					await pin.enter_async_context(self.context.cache.pin(index_path))
+				except:
+					db.close()
+					raise
+				entry = self.dbs[index_path] = db, pin
+			self.dbs.move_to_end(index_path)
+			self.users[index_path] += 1
+			self._trim()
+			return index_path, entry[0]
+
+
+	def _attach(self, obj, index_path):
+		# the index is in use for as long as the object loaded from it is alive
+		weakref.finalize(obj, self._finalize, asyncio.get_event_loop(), index_path)
+		return obj
+
+
+	def _finalize(self, loop, index_path):
+		# objects may be collected in executor threads, or after shutdown
+		if not loop.is_closed():
+			loop.call_soon_threadsafe(self._release, index_path)
+
+
+	def _release(self, index_path):
+		self.users[index_path] -= 1
+		if self.users[index_path] > 0:
+			return
+		del self.users[index_path]
+		if index_path in self.dbs:
+			self.dbs.move_to_end(index_path)
+		self._trim()
+
+
+	def _trim(self):
+		# close superseded and idle indexes, least recently used first
+		idle = [ index_path for index_path in self.dbs if not self.users[index_path] ]
+		for index_path in idle[:max(len(idle) - MetadataIndex.IDLE_SIZE, 0)]:
+			logging.debug(f'MetadataIndex: closing {index_path}')
+			db, pin = self.dbs.pop(index_path)
+			db.close()
+			asyncio.ensure_future(pin.aclose())
+
+
+	async def load_targetinfo(self, path):
+		index_path, db = await self._open(path, 'targetinfo', MetadataIndex._write_targetinfo)
+		return self._attach(IndexedTargetinfo(db), index_path)
+
+
+	async def load_packageinfo(self, path):
+		index_path, db = await self._open(path, 'packageinfo', MetadataIndex._write_packageinfo)
+		try:
+			packageinfo = await aiofiles.os.wrap(IndexedPackageinfo)(db)
+		except:
+			self._release(index_path)
+			raise
+		return self._attach(packageinfo, index_path)
+
+
+	async def close(self):
+		for db, pin in self.dbs.values():
+			db.close()
+			await pin.aclose()
+		self.dbs.clear()
+		self.users.clear()
@@ -0,0 +1,224 @@
+#!/hint/python3
+
+import os
+import math
+import time
+import threading
+from contextlib import contextmanager
+
+
+def _format_value(v):
+	if v == math.inf:
+		return '+Inf'
+	if isinstance(v, float) and v.is_integer():
+		return str(int(v))
+	return repr(v)
+
+
+def _format_labels(labels):
+	if not labels:
+		return ''
+	escaped = (
+		(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+		for k, v in labels
+	)
+	return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
+
+
+class Metric:
+	TYPE = None
+
+	def __init__(self, name, help, *, labels=(), collect=None):
+		self.name = name
+		self.help = help
+		self.labels = tuple(labels)
+		# computes the values at scrape time instead, returning { (label values...): value }
+		self.collect = collect
+		self.values = dict()
+		self.lock = threading.Lock()
+
+
+	def _key(self, labels):
+		if set(labels) != set(self.labels):
+			raise ValueError(f'{self.name}: expected labels {self.labels}, got {tuple(labels)}')
+		return tuple(str(labels[k]) for k in self.labels)
+
+
+	def get(self, **labels):
+		key = self._key(labels)
+		with self.lock:
+			return self.values.get(key, 0)
+
+
+	def samples(self):
+		values = self.collect() if self.collect else self.values
+		with self.lock:
+			return [
+				(self.name, tuple(zip(self.labels, key)), value)
+				for key, value in sorted(values.items())
+			]
+
+
+	def render(self):
+		lines = [
+			f'# HELP {self.name} {self.help}',
+			f'# TYPE {self.name} {self.TYPE}',
+		]
+		for name, labels, value in self.samples():
+			lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+		return lines
+
+
+class Counter(Metric):
+	TYPE = 'counter'
+
+	def inc(self, amount=1, **labels):
+		key = self._key(labels)
+		with self.lock:
+			self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+	TYPE = 'gauge'
+
+	def set(self, value, **labels):
+		key = self._key(labels)
+		with self.lock:
+			self.values[key] = value
+
+	def inc(self, amount=1, **labels):
+		key = self._key(labels)
+		with self.lock:
+			self.values[key] = self.values.get(key, 0) + amount
+
+	def dec(self, amount=1, **labels):
+		self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+	TYPE = 'histogram'
+	BUCKETS = ( 0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, math.inf )
+
+	def __init__(self, name, help, *, labels=(), buckets=BUCKETS):
+		super().__init__(name, help, labels=labels)
+		self.buckets = tuple(buckets)
+
+
+	def observe(self, value, **labels):
+		key = self._key(labels)
+		with self.lock:
+			counts, total = self.values.get(key, ([0] * len(self.buckets), 0.0))
+			for i, bound in enumerate(self.buckets):
+				if value <= bound:
+					counts[i] += 1
+			self.values[key] = (counts, total + value)
+
+
+	@contextmanager
+	def time(self, **labels):
+		started = time.monotonic()
+		try:
+			yield
+		finally:
+			self.observe(time.monotonic() - started, **labels)
+
+
+	def samples(self):
+		samples = []
+		with self.lock:
+			for key, (counts, total) in sorted(self.values.items()):
+				labels = tuple(zip(self.labels, key))
+				for bound, count in zip(self.buckets, counts):
+					samples.append((f'{self.name}_bucket', labels + (('le', _format_value(float(bound))),), count))
+				samples.append((f'{self.name}_sum', labels, total))
+				samples.append((f'{self.name}_count', labels, counts[-1]))
+		return samples
+
+
+class Metrics:
+	def __init__(self, *, context):
+		self.context = context
+		self.metrics = []
+
+		self.phase_seconds = self.add(Histogram(
+			'upenwrt_phase_seconds',
+			'Time spent in each phase of handling requests',
+			labels=('phase',),
+		))
+		self.operations = self.add(Gauge(
+			'upenwrt_operations_in_flight',
+			'Number of operations currently being handled',
+		))
+		self.operations.set(0)
+		self.add(Counter(
+			'upenwrt_cache_lookups_total',
+			'Number of cache lookups by result',
+			labels=('cache', 'result'),
+			collect=self._collect_cache,
+		))
+		self.add(Gauge(
+			'upenwrt_scheduler_queued',
+			'Number of tasks waiting for a scheduler lane',
+			labels=('lane',),
+			collect=self._collect_queue,
+		))
+		self.add(Gauge(
+			'upenwrt_jobs',
+			'Number of asynchronous jobs by state',
+			labels=('state',),
+			collect=self._collect_jobs,
+		))
+		self.add(Gauge(
+			'upenwrt_workdir_bytes',
+			'Size and usage of the filesystem holding the working directory',
+			labels=('kind',),
+			collect=self._collect_workdir,
+		))
+
+
+	def add(self, metric):
+		self.metrics.append(metric)
+		return metric
+
+
+	def _collect_cache(self):
+		values = dict()
+		for cache, counters in self.context.cache.counters.items():
+			values[(cache, 'hit')] = counters['hits']
+			values[(cache, 'miss')] = counters['misses']
+		return values
+
+
+	def _collect_queue(self):
+		return {
+			(name,): lane.waiting
+			for name, lane in self.context.scheduler.lanes.items()
+		}
+
+
+	def _collect_jobs(self):
+		values = dict()
+		for job in list(self.context.jobs.jobs.values()):
+			values[(job.state,)] = values.get((job.state,), 0) + 1
+		return values
+
+
+	def _collect_workdir(self):
+		try:
+			st = os.statvfs(self.context.workdir)
+		except FileNotFoundError:
+			return dict()
+		size = st.f_blocks * st.f_frsize
+		free = st.f_bfree * st.f_frsize
+		return {
+			('size',): size,
+			('used',): size - free,
+			('available',): st.f_bavail * st.f_frsize,
+		}
+
+
+	def render(self):
+		lines = []
+		for metric in self.metrics:
+			lines += metric.render()
+		return '\n'.join(lines) + '\n'
@@ -4,53 +4,93 @@ import os.path as p
 import logging
 import attr
 import re
+import time
+from contextlib import AsyncExitStack
 
 from . import util
 from . import wrapio
+from . import tracing
+from .buildcache import BuildCache
 from .targetinfo import OpenwrtProfile
 from .util import UpenwrtError, UpenwrtUserError
 
 
 @attr.s(kw_only=True)
 class OpenwrtOperationDetails:
-	builddir = attr.ib(type=str)
 	profile = attr.ib(type=OpenwrtProfile)
 	packages = attr.ib(type=set)
 
 
 class OpenwrtOperation:
-	def __init__(self, *, context, source, artifact, target_name, board_name, pkgs):
+	PHASES = ( 'queued', 'imagebuilder', 'source', 'correlate', 'build', 'done' )
+
+	def __init__(self, *, context, source, artifact, target_name, board_name, pkgs, manifest=None):
 		self.context = context
 		self.source = source
 		self.artifact = artifact
 		self.target_name = target_name
 		self.board_name = board_name
 		self.packages = pkgs
+		# hash of the canonical manifest of the request, see ManifestIndex
+		self.manifest = manifest
 		self.workdir = None
+		self.exit_stack = AsyncExitStack()
+		self.phase = 'queued'
+		self.details = None
+
+
+	@property
+	def progress(self):
+		return OpenwrtOperation.PHASES.index(self.phase) / (len(OpenwrtOperation.PHASES) - 1)
+
+
+	def inputs_key(self):
+		return (
+			self.artifact.version_id,
+			self.artifact.target_name,
+			self.board_name,
+			self.source.ref if self.source else None,
+			tuple(sorted(self.packages)),
+		)
 
 
 	async def __aenter__(self):
+		self.context.metrics.operations.inc()
+
+
+	async def get_workdir(self):
+		# created lazily, cache hits never touch the work directory
 		if not self.workdir:
 			self.workdir = await wrapio.tempfile_mkdtemp(dir=self.context.workdir)
+			logging.debug(f'OpenwrtOperation: workdir at: {self.workdir}')
+		return self.workdir
 
 
 	async def __aexit__(self, *args, **kwargs):
-		if self.workdir:
-			await wrapio.shutil_rmtree(self.workdir)
-			self.workdir = None
+		try:
+			await self.exit_stack.aclose()
+			if self.workdir:
+				await wrapio.shutil_rmtree(self.workdir)
+				self.workdir = None
+		finally:
+			self.context.metrics.operations.dec()
 
 
+	@tracing.traced('operation.prepare')
 	async def prepare(self):
-		assert(self.workdir)
+		# batches prepare their operations up front
+		if self.details is not None:
+			return self.details
+
 		logging.info(f'OpenwrtOperation: prepare(): target name: {self.target_name}')
 		logging.info(f'OpenwrtOperation: prepare(): board name: {self.board_name}')
-		logging.debug(f'OpenwrtOperation: prepare(): workdir at: {self.workdir}')
 
-		builddir = await self.artifact.get_imagebuilder(self.workdir)
-		logging.debug(f'OpenwrtOperation: prepare(): builddir at: {builddir}')
+		self.phase = 'imagebuilder'
+		async with self.artifact.imagebuilder_base() as basedir:
+			logging.debug(f'OpenwrtOperation: prepare(): imagebuilder at: {basedir}')
+			bld_packageinfo = await self.artifact.get_packageinfo(basedir)
+			bld_targetinfo = await self.artifact.get_targetinfo(basedir)
 
-		bld_packageinfo = await self.artifact.get_packageinfo(builddir)
-		bld_targetinfo = await self.artifact.get_targetinfo(builddir)
 		try:
 			bld_target = bld_targetinfo.targets[self.target_name]
 			logging.debug(f'OpenwrtOperation: prepare(): builder target: {bld_target}')
@@ -65,10 +105,8 @@ Available targets, boards and devices for this imagebuilder:
 """.strip())
 
 		if self.source:
-			sourcedir = await self.source.get_checkout(self.workdir)
-			logging.debug(f'OpenwrtOperation: prepare(): sourcedir at: {sourcedir}')
-
-			src_targetinfo = await self.source.get_targetinfo(sourcedir)
+			self.phase = 'source'
+			src_targetinfo = await self.source.get_targetinfo()
 			src_target = src_targetinfo.targets[self.target_name]
 			logging.debug(f'OpenwrtOperation: prepare(): source target: {src_target}')
 			src_profile = src_targetinfo.profiles[self.board_name]
@@ -90,17 +128,37 @@ Available targets, boards and devices for this imagebuilder:
 		logging.debug(f'OpenwrtOperation: prepare(): note: excl. per-profile defaults: {default_profile_only_packages}')
 		logging.debug(f'OpenwrtOperation: prepare(): note: common defaults: {default_both_packages}')
 
+		self.phase = 'correlate'
+		correlate_started = time.monotonic()
 		default_packages = default_target_packages | default_profile_packages
 		logging.info(f'OpenwrtOperation: prepare(): client defaults: {default_packages}')
 
-		logging.info(f'OpenwrtOperation: prepare(): client packages (raw): {self.packages}')
+		# the outcome only depends on the packageinfo, the defaults and the client packages, and fleets send the same ones over and over
+		user_only_packages = bld_packageinfo.memoise(
+			(frozenset(default_packages), frozenset(self.packages)),
+			lambda: frozenset(OpenwrtOperation.correlate(self.packages, default_packages, bld_packageinfo)),
+		)
+
+		self.context.metrics.phase_seconds.observe(time.monotonic() - correlate_started, phase='correlate')
+
+		# noinspection PyArgumentList
+		self.details = OpenwrtOperationDetails(
+			profile=bld_profile,
+			packages=set(user_only_packages),
+		)
+		return self.details
+
+
+	@staticmethod
+	def correlate(client_packages, default_packages, packageinfo):
+		logging.info(f'OpenwrtOperation: prepare(): client packages (raw): {client_packages}')
 
 		# 0. Load input packages, parse aliases
 		def load_packages(packages):
 			for p in packages:
 				aliases = p.split(',')
 				yield aliases[0], set(aliases[1:])
-		aliases = dict(load_packages(self.packages))
+		aliases = dict(load_packages(client_packages))
 		packages = set(aliases.keys())
 		logging.info(f'OpenwrtOperation: prepare(): client packages: {packages}')
 
@@ -112,12 +170,7 @@ Available targets, boards and devices for this imagebuilder:
 					yield p
 					continue
 
-				correlated = set()
-				for a in aliases[p]:
-					# try to correlate with default packages in source
-					if a in src_defaults:
-						correlated.add(a)
-
+				correlated = aliases[p] & src_defaults
 				if len(correlated) > 1:
 					raise RuntimeError(f'OpenwrtOperation: prepare(): package {p} is referenced by more than one alias in defaults: {correlated}')
 				elif correlated:
@@ -133,71 +186,84 @@ Available targets, boards and devices for this imagebuilder:
 		logging.info(f'OpenwrtOperation: prepare(): client INSTALLED: {user_only_packages}')
 
 		# 2. attempt Provides: substitution for client packages that do not exist in target
-		def correlate_target(packages, aliases, target_packageinfo):
-			for p in packages:
-				# shortcut
-				if p in target_packageinfo.aliases:
-					yield p
-					continue
-
-				correlated = set()
-				# FIXME: after first round of correlation, aliases might become mismatched with packages
-				for a in aliases.get(p, ()):
-					# try to correlate with packages that exist in target
-					if a in target_packageinfo.aliases:
-						# there may be multiple aliases pointing to the same package, both in source information and in target information
-						# e. g. in source, libwolfssl<unique> provides libwolfssl, libcyassl
-						#       in target, libwolfssl<unique2> provides libwolfssl, libcyassl
-						# naïvely, this is a failure condition because libwolfssl<unique> is referenced by two aliases both of which exist in target
-						# but in fact, the situation is still unambiguous
-						#for p2 in target_packageinfo.aliases[a]:
-						#	correlated.add(p2.name)
-						correlated.add(a)
-
-				if len(correlated) > 1:
-					# HACK: if we managed to get into this situation, try to select a single preferred alias that is a substring of package name
-					preferred = { c for c in correlated if c in p }
-					if len(preferred) == 1:
-						yield preferred.pop()
-						continue
-
-					raise RuntimeError(f'OpenwrtOperation: prepare(): package {p} has more than one alias in target: {correlated}')
-				elif correlated:
-					yield correlated.pop()
-				else:
-					yield p
-		user_only_packages = set(correlate_target(user_only_packages, aliases, bld_packageinfo))
+		# FIXME: after first round of correlation, aliases might become mismatched with packages
+		user_only_packages = { packageinfo.resolve(p, aliases.get(p, ())) for p in user_only_packages }
 		logging.info(f'OpenwrtOperation: prepare(): client INSTALLED (correlated 2): {user_only_packages}')
-
-		# noinspection PyArgumentList
-		return OpenwrtOperationDetails(
-			builddir=builddir,
-			profile=bld_profile,
-			packages=user_only_packages,
-		)
+		return user_only_packages
 
 
+	@tracing.traced('operation.list_packages')
 	async def list_packages(self):
 		prep = await self.prepare()
 
+		self.phase = 'done'
 		return ' '.join(prep.packages)
 
 
-	async def build(self):
+	async def build_key(self):
+		# identifies the image that build() would produce
 		prep = await self.prepare()
-
-		make_image = await util.run(
-			[ 'make', 'image', f'PROFILE={prep.profile.name}', f'PACKAGES={" ".join(prep.packages)}' ],
-			cwd=prep.builddir,
+		return BuildCache.make_key(
+			imagebuilder=await self.artifact.get_imagebuilder_identity(),
+			profile=prep.profile.name,
+			packages=prep.packages,
 		)
 
-		outdir = p.join(prep.builddir, 'bin', 'targets', self.artifact.target_name)
-		logging.debug(f'OpenwrtOperation: build(): outdir at: {outdir}')
-		filelist = await wrapio.os_listdir(outdir)
-		logging.debug(f'OpenwrtOperation: build(): outputs: {filelist}')
 
-		outputs = [ x for x in filelist if 'sysupgrade' in x ]
-		if len(outputs) != 1:
-			raise RuntimeError(f'OpenwrtOperation: got {len(outputs)} != 1 sysupgrade files after building: {outputs}')
+	@tracing.traced('operation.build')
+	async def build(self):
+		prep = await self.prepare()
 
-		return p.join(outdir, outputs[0])
+		cache_key = await self.build_key()
+		# the output stays in the build cache for as long as this operation is alive
+		await self.exit_stack.enter_async_context(self.context.build_cache.pin(cache_key))
+		output = await self._build(prep, cache_key)
+		# only a manifest whose image actually exists may be served by hash
+		if self.manifest:
+			await self.context.manifests.record(
+				self.manifest,
+				artifact=self.artifact,
+				build_key=cache_key,
+				profile=prep.profile.name,
+				packages=prep.packages,
+			)
+		self.phase = 'done'
+		return output
+
+
+	async def _build(self, prep, cache_key):
+		cached = await self.context.build_cache.lookup(cache_key)
+		if cached:
+			logging.info(f'OpenwrtOperation: build(): using cached output: {cached}')
+			return cached
+
+		async with self.context.build_cache.lock(cache_key):
+			# another worker may have built the same image while we were waiting for it
+			cached = await self.context.build_cache.lookup(cache_key, record=False)
+			if cached:
+				logging.info(f'OpenwrtOperation: build(): using output built concurrently: {cached}')
+				return cached
+
+			async with self.context.scheduler.slot('build'):
+				self.phase = 'build'
+				builddir = await self.exit_stack.enter_async_context(self.artifact.imagebuilder(await self.get_workdir()))
+				logging.debug(f'OpenwrtOperation: build(): builddir at: {builddir}')
+
+				await self.context.package_cache.populate(builddir)
+				with self.context.metrics.phase_seconds.time(phase='build'):
+					make_image = await util.run(
+						[ 'make', 'image', f'PROFILE={prep.profile.name}', f'PACKAGES={" ".join(prep.packages)}' ],
+						cwd=builddir,
+					)
+				await self.context.package_cache.harvest(builddir)
+
+			outdir = p.join(builddir, 'bin', 'targets', self.artifact.target_name)
+			logging.debug(f'OpenwrtOperation: build(): outdir at: {outdir}')
+			filelist = await wrapio.os_listdir(outdir)
+			logging.debug(f'OpenwrtOperation: build(): outputs: {filelist}')
+
+			outputs = [ x for x in filelist if 'sysupgrade' in x ]
+			if len(outputs) != 1:
+				raise RuntimeError(f'OpenwrtOperation: got {len(outputs)} != 1 sysupgrade files after building: {outputs}')
+
+			return await self.context.build_cache.store(cache_key, p.join(outdir, outputs[0]))
@@ -0,0 +1,159 @@
+#!/hint/python3
+
+import os
+import os.path as p
+import logging
+import gzip
+import hashlib
+import shutil
+import tempfile
+import aiofiles.os
+
+from . import wrapio
+
+
+class PackageCache:
+	def __init__(self, *, context):
+		self.context = context
+		self.cachedir = p.join(context.cachedir, 'packages')
+		self.size = context.package_cache_size
+
+
+	@property
+	def enabled(self):
+		return self.size > 0
+
+
+	@staticmethod
+	def _hash_file(path):
+		h = hashlib.sha256()
+		with open(path, 'rb') as f:
+			for chunk in iter(lambda: f.read(1 << 20), b''):
+				h.update(chunk)
+		return h.hexdigest()
+
+
+	@staticmethod
+	def _read_lists(builddir):
+		# opkg package lists downloaded by the imagebuilder, one per feed, which go to LISTS_DIR=$(DL_DIR)
+		# next to the packages themselves
+		listsdir = p.join(builddir, 'dl')
+		index = dict()
+		try:
+			feeds = os.listdir(listsdir)
+		except FileNotFoundError:
+			return index
+
+		for feed in feeds:
+			path = p.join(listsdir, feed)
+			if feed.startswith('.') or feed.endswith(('.ipk', '.sig')) or p.islink(path) or not p.isfile(path):
+				continue
+			with open(path, 'rb') as f:
+				data = f.read()
+			if data[:2] == b'\x1f\x8b':
+				data = gzip.decompress(data)
+
+			filename = sha256 = None
+			for line in data.decode('utf-8', errors='replace').split('\n') + ['']:
+				if line.startswith('Filename: '):
+					filename = p.basename(line[len('Filename: '):].strip())
+				elif line.startswith('SHA256sum: '):
+					sha256 = line[len('SHA256sum: '):].strip()
+				elif not line:
+					if filename and sha256:
+						index[filename] = (feed, sha256)
+					filename = sha256 = None
+		return index
+
+
+	def _populate_sync(self, builddir):
+		dldir = p.join(builddir, 'dl')
+		os.makedirs(dldir, exist_ok=True)
+		count = 0
+		for feed in os.listdir(self.cachedir):
+			feeddir = p.join(self.cachedir, feed)
+			for filename in os.listdir(feeddir):
+				if filename.startswith('.'):
+					continue
+				target = p.join(dldir, filename)
+				if not p.lexists(target):
+					os.symlink(p.join(feeddir, filename), target)
+					count += 1
+		logging.debug(f'PackageCache: linked {count} packages into {dldir}')
+
+
+	def _harvest_sync(self, builddir):
+		dldir = p.join(builddir, 'dl')
+		index = PackageCache._read_lists(builddir)
+		stored = 0
+
+		for filename in os.listdir(dldir):
+			path = p.join(dldir, filename)
+			if p.islink(path) or not p.isfile(path) or not filename.endswith('.ipk'):
+				continue
+			if filename not in index:
+				logging.debug(f'PackageCache: {filename} is not listed in any feed, not caching')
+				continue
+
+			feed, sha256 = index[filename]
+			if PackageCache._hash_file(path) != sha256:
+				logging.warning(f'PackageCache: {filename} does not match SHA256sum of feed {feed}, not caching')
+				continue
+
+			feeddir = p.join(self.cachedir, feed)
+			os.makedirs(feeddir, exist_ok=True)
+			fd, staging_path = tempfile.mkstemp(dir=feeddir, prefix=f'.{filename}.')
+			os.close(fd)
+			shutil.copyfile(path, staging_path)
+			os.rename(staging_path, p.join(feeddir, filename))
+			stored += 1
+
+		# packages that are still current in the feeds stay in the cache the longest
+		for filename, (feed, sha256) in index.items():
+			path = p.join(self.cachedir, feed, filename)
+			if p.exists(path):
+				os.utime(path)
+
+		# a hit is a build that did not have to download any packages
+		self.context.cache.record('packages', hit=not stored)
+		if stored:
+			logging.info(f'PackageCache: stored {stored} new packages')
+		self._evict_sync()
+
+
+	def _evict_sync(self):
+		entries = []
+		for feed in os.listdir(self.cachedir):
+			feeddir = p.join(self.cachedir, feed)
+			for filename in os.listdir(feeddir):
+				try:
+					st = os.stat(p.join(feeddir, filename))
+				except FileNotFoundError:
+					# evicted by another worker
+					continue
+				entries.append((st.st_mtime, p.join(feeddir, filename), st.st_size))
+
+		total = sum(size for _, _, size in entries)
+		for mtime, path, size in sorted(entries):
+			if total <= self.size:
+				break
+			logging.debug(f'PackageCache: evicting {path}')
+			try:
+				os.unlink(path)
+			except FileNotFoundError:
+				pass
+			total -= size
+
+
+	async def populate(self, builddir):
+		if not self.enabled:
+			return
+		await wrapio.os_makedirs(self.cachedir, exist_ok=True)
+		await aiofiles.os.wrap(self._populate_sync)(builddir)
+
+
+	async def harvest(self, builddir):
+		if not self.enabled:
+			return
+		await wrapio.os_makedirs(self.cachedir, exist_ok=True)
+		await aiofiles.os.wrap(self._harvest_sync)(builddir)
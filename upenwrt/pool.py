@@ -0,0 +1,322 @@
+#!/hint/python3
+
+import os
+import os.path as p
+import shutil
+import logging
+import asyncio
+import time
+import subprocess
+import collections
+import attr
+import aiofiles.os
+from contextlib import asynccontextmanager
+
+from . import util
+from . import wrapio
+
+
+@attr.s(kw_only=True)
+class ImagebuilderTree:
+	key = attr.ib(type=tuple)
+	source = attr.ib(type=str)
+	identity = attr.ib(type=tuple)
+	path = attr.ib(type=str)
+	refcount = attr.ib(type=int, default=0)
+	last_used = attr.ib(type=float, factory=time.monotonic)
+
+
+class ImagebuilderPool:
+	METHODS = ( 'auto', 'overlay', 'reflink', 'hardlink' )
+
+	# A hardlink farm shares inodes with the base tree and with every other view, so anything that `make image`
+	# might write in place must be copied instead. Known to be written: .config, bin/, build_dir/ (the rootfs
+	# and kernel images), dl/ (feed lists and downloaded packages), tmp/, repositories.conf, staging_dir/
+	# (target staging and stamps), target/ and packages/Packages* (`package_index` redirects into them).
+	# Hence only these paths, which are only ever read, are hardlinked, and everything else is copied:
+	SHARED_PATHS = ( 'packages', 'staging_dir/host', 'include', 'scripts' )
+	# ...except for these, inside of them
+	PRIVATE_PATHS = ( 'packages/Packages', 'packages/Packages.gz', 'packages/Packages.sig', 'packages/Packages.manifest' )
+
+	@staticmethod
+	def identity(st):
+		return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+	def __init__(self, *, context):
+		self.context = context
+		self.pooldir = context.pooldir
+		self.size = context.pool_size
+		self.idle_timeout = context.pool_idle_timeout
+		self.refill_interval = context.pool_refill_interval
+		self.method = context.pool_method
+		if self.method not in ImagebuilderPool.METHODS:
+			raise ValueError(f'ImagebuilderPool: bad method: {self.method}')
+
+		# one current tree per key (the last one), preceded by superseded ones that are still in use
+		self.trees = dict()
+		self.locks = dict()
+		self.users = collections.Counter()
+		self.task = None
+
+
+	async def start(self):
+		if p.exists(self.pooldir):
+			await wrapio.shutil_rmtree(self.pooldir)
+		await wrapio.os_makedirs(self.pooldir, exist_ok=True)
+		self.task = asyncio.ensure_future(self._run())
+
+
+	async def stop(self):
+		if self.task:
+			self.task.cancel()
+			try:
+				await self.task
+			except asyncio.CancelledError:
+				pass
+			self.task = None
+
+		for trees in self.trees.values():
+			for tree in trees:
+				await self._remove(tree)
+		self.trees.clear()
+
+
+	async def _run(self):
+		while True:
+			await asyncio.sleep(self.refill_interval)
+			try:
+				await self._evict_idle()
+				await self._refill()
+			except Exception as e:
+				logging.exception(f'ImagebuilderPool: maintenance failed: {e}')
+
+
+	async def _extract(self, key, source, identity):
+		target_name = key[1].replace('/', '-')
+		path = await wrapio.tempfile_mkdtemp(dir=self.pooldir, prefix=f'{key[0]}-{target_name}.')
+		# a repacked copy of the same archive is much cheaper to decompress, if we have one
+		archive = await self.context.repacker.best(source)
+		logging.info(f'ImagebuilderPool: extracting {archive} into {path}')
+		try:
+			async with self.context.cache.pin(source):
+				async with self.context.scheduler.slot('extract'):
+					with self.context.metrics.phase_seconds.time(phase='extract'):
+						untar_imagebuilder = await util.run(
+							[ 'tar', '-xaf', archive, '--strip-components', '1', ],
+							cwd=path,
+						)
+		except:
+			await wrapio.shutil_rmtree(path)
+			raise
+
+		# noinspection PyArgumentList
+		return ImagebuilderTree(
+			key=key,
+			source=source,
+			identity=identity,
+			path=path,
+		)
+
+
+	async def _remove(self, tree):
+		logging.info(f'ImagebuilderPool: removing {tree.path}')
+		await wrapio.shutil_rmtree(tree.path, ignore_errors=True)
+
+
+	def _current(self, key):
+		trees = self.trees.get(key, [])
+		return trees[-1] if trees else None
+
+
+	async def _discard(self, tree):
+		trees = self.trees.get(tree.key, [])
+		if tree in trees:
+			trees.remove(tree)
+		if not trees:
+			self.trees.pop(tree.key, None)
+			self._prune(tree.key)
+		await self._remove(tree)
+
+
+	@asynccontextmanager
+	async def _locked(self, key):
+		# the lock of a key is kept for as long as the key has trees, or anybody holds or waits for it
+		lock = self.locks.setdefault(key, asyncio.Lock())
+		self.users[key] += 1
+		try:
+			async with lock:
+				yield
+		finally:
+			self.users[key] -= 1
+			if not self.users[key]:
+				del self.users[key]
+			self._prune(key)
+
+
+	def _prune(self, key):
+		if key not in self.trees and key not in self.users:
+			self.locks.pop(key, None)
+
+
+	async def _acquire(self, key, source):
+		identity = ImagebuilderPool.identity(await wrapio.os_stat(source))
+
+		async with self._locked(key):
+			tree = self._current(key)
+			if tree is None or tree.identity != identity or tree.source != source:
+				tree = await self._extract(key, source, identity)
+				self.trees.setdefault(key, []).append(tree)
+			tree.refcount += 1
+			tree.last_used = time.monotonic()
+
+		await self._collect()
+		return tree
+
+
+	async def _release(self, tree):
+		tree.refcount -= 1
+		tree.last_used = time.monotonic()
+		await self._collect()
+
+
+	async def _collect(self):
+		# drop superseded trees that are no longer in use
+		for key, trees in list(self.trees.items()):
+			for tree in trees[:-1]:
+				if tree.refcount == 0:
+					await self._discard(tree)
+
+		# enforce pool size, least recently used first
+		idle = sorted(
+			( t for trees in self.trees.values() for t in trees if t.refcount == 0 ),
+			key=lambda t: t.last_used,
+		)
+		excess = sum(len(trees) for trees in self.trees.values()) - self.size
+		for tree in idle[:max(excess, 0)]:
+			if tree.refcount == 0:
+				await self._discard(tree)
+
+
+	async def _evict_idle(self):
+		deadline = time.monotonic() - self.idle_timeout
+		for trees in list(self.trees.values()):
+			for tree in list(trees):
+				if tree.refcount == 0 and tree.last_used < deadline:
+					logging.debug(f'ImagebuilderPool: evicting idle tree {tree.path}')
+					await self._discard(tree)
+
+
+	async def _refill(self):
+		# re-extract trees whose imagebuilder has been re-downloaded since
+		for key in list(self.trees.keys()):
+			tree = self._current(key)
+			if tree is None:
+				continue
+			try:
+				identity = ImagebuilderPool.identity(await wrapio.os_stat(tree.source))
+			except FileNotFoundError:
+				continue
+			if identity == tree.identity:
+				continue
+
+			logging.info(f'ImagebuilderPool: refilling {key}')
+			async with self._locked(key):
+				if self._current(key) is tree:
+					self.trees.setdefault(key, []).append(await self._extract(key, tree.source, identity))
+			await self._collect()
+
+
+	@asynccontextmanager
+	async def base(self, *, key, source):
+		tree = await self._acquire(key, source)
+		try:
+			yield tree.path
+		finally:
+			await self._release(tree)
+
+
+	@asynccontextmanager
+	async def view(self, *, key, source, target_dir):
+		tree = await self._acquire(key, source)
+		try:
+			view_path = await wrapio.tempfile_mkdtemp(dir=target_dir, prefix='imagebuilder')
+			path, cleanup = await self._make_view(tree.path, view_path)
+			try:
+				yield path
+			finally:
+				await cleanup()
+		finally:
+			await self._release(tree)
+
+
+	async def _make_view(self, base_path, view_path):
+		async def noop():
+			pass
+
+		if self.method == 'overlay':
+			return await self._make_overlay(base_path, view_path)
+
+		if self.method in ('auto', 'reflink'):
+			try:
+				cp_reflink = await util.run(
+					[ 'cp', '-a', '--reflink=always', '-T', base_path, view_path ],
+				)
+				return view_path, noop
+			except subprocess.CalledProcessError:
+				if self.method == 'reflink':
+					raise
+				logging.info(f'ImagebuilderPool: reflinks are not supported, falling back to hardlinks')
+				self.method = 'hardlink'
+				await wrapio.shutil_rmtree(view_path)
+				await wrapio.os_makedirs(view_path)
+
+		await aiofiles.os.wrap(ImagebuilderPool._make_farm)(base_path, view_path)
+		return view_path, noop
+
+
+	@staticmethod
+	def is_shared(rel):
+		if rel in ImagebuilderPool.PRIVATE_PATHS:
+			return False
+		return any(rel == s or rel.startswith(f'{s}/') for s in ImagebuilderPool.SHARED_PATHS)
+
+
+	@staticmethod
+	def _make_farm(base_path, view_path):
+		for root, dirs, files in os.walk(base_path):
+			rel_root = p.relpath(root, base_path)
+			for name in list(dirs):
+				if p.islink(p.join(root, name)):
+					# os.walk() does not descend into those
+					dirs.remove(name)
+					files.append(name)
+				else:
+					os.mkdir(p.normpath(p.join(view_path, rel_root, name)))
+			for name in files:
+				rel = p.normpath(p.join(rel_root, name))
+				src, dst = p.join(base_path, rel), p.join(view_path, rel)
+				if p.islink(src):
+					os.symlink(os.readlink(src), dst)
+				elif ImagebuilderPool.is_shared(rel):
+					os.link(src, dst)
+				else:
+					shutil.copy2(src, dst)
+			shutil.copystat(root, p.join(view_path, rel_root))
+
+
+	async def _make_overlay(self, base_path, view_path):
+		upper, work, merged = ( p.join(view_path, d) for d in ('upper', 'work', 'merged') )
+		for d in (upper, work, merged):
+			await wrapio.os_makedirs(d)
+
+		mount_overlay = await util.run(
+			[ 'mount', '-t', 'overlay', 'overlay', '-o', f'lowerdir={base_path},upperdir={upper},workdir={work}', merged ],
+		)
+
+		async def umount():
+			umount_overlay = await util.run(
+				[ 'umount', merged ],
+			)
+
+		return merged, umount
@@ -0,0 +1,83 @@
+#!/hint/python3
+
+import logging
+import asyncio
+import time
+
+from . import tracing
+from .scheduler import Scheduler
+
+
+class Prefetcher:
+	def __init__(self, *, context):
+		self.context = context
+		self.interval = context.prefetch_interval
+		self.window = context.prefetch_window
+		self.semaphore = asyncio.Semaphore(context.prefetch_concurrency)
+		self.configured = [ Prefetcher.parse(spec) for spec in context.prefetch ]
+		self.task = None
+
+
+	@staticmethod
+	def parse(spec):
+		# VERSION/TARGET/SUBTARGET, e. g. snapshot/ramips/mt7621
+		version_id, _, target_name = spec.partition('/')
+		if not version_id or not target_name:
+			raise ValueError(f'Prefetcher: bad prefetch spec: {spec}')
+		return version_id, target_name
+
+
+	async def start(self):
+		if self.interval > 0:
+			self.task = asyncio.ensure_future(self._run())
+
+
+	async def stop(self):
+		if self.task:
+			self.task.cancel()
+			try:
+				await self.task
+			except asyncio.CancelledError:
+				pass
+			self.task = None
+
+
+	def artifacts(self):
+		artifacts = [
+			self.context.artifacts.get(target_name=target_name, version_id=version_id)
+			for version_id, target_name in self.configured
+		]
+		deadline = time.monotonic() - self.window
+		artifacts += [
+			artifact
+			for artifact in list(self.context.artifacts.artifacts.values())
+			if artifact not in artifacts and artifact.requested_at is not None and artifact.requested_at >= deadline
+		]
+		return artifacts
+
+
+	async def _run(self):
+		# everything spawned from here yields to client requests
+		Scheduler.priority.set(Scheduler.PRIORITY_PREFETCH)
+		while True:
+			try:
+				await asyncio.gather(*[ self._prefetch(artifact) for artifact in self.artifacts() ])
+			except Exception as e:
+				logging.exception(f'Prefetcher: prefetch failed: {e}')
+			await asyncio.sleep(self.interval)
+
+
+	async def _prefetch(self, artifact):
+		async with self.semaphore:
+			# each prefetch is traced as a request of its own
+			tracing.request_id.set(tracing.new_trace_id())
+			logging.debug(f'Prefetcher: prefetching {artifact.version_id} {artifact.target_name}')
+			try:
+				await artifact.get_imagebuilder_file()
+				async with artifact.imagebuilder_base() as basedir:
+					await artifact.get_targetinfo(basedir)
+					await artifact.get_packageinfo(basedir)
+			except asyncio.CancelledError:
+				raise
+			except Exception as e:
+				logging.warning(f'Prefetcher: could not prefetch {artifact.version_id} {artifact.target_name}: {e}')
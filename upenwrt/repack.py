@@ -0,0 +1,98 @@
+#!/hint/python3
+
+import os
+import os.path as p
+import logging
+import asyncio
+import shutil
+
+from . import util
+from . import wrapio
+
+
+class Repacker:
+	def __init__(self, *, context):
+		self.context = context
+		self.enabled = context.repack
+		self.tasks = dict()
+
+		if self.enabled and not (shutil.which('zstd') and shutil.which('xz') and shutil.which('bash')):
+			logging.warning(f'Repacker: zstd(1), xz(1) or bash(1) not found, disabling repacking')
+			self.enabled = False
+
+
+	@staticmethod
+	def repacked_path(source):
+		base = source[:-len('.tar.xz')] if source.endswith('.tar.xz') else source
+		return f'{base}.tar.zst'
+
+
+	async def is_current(self, source, repacked):
+		# the repacked copy carries the mtime of the archive it was made from
+		try:
+			return (await wrapio.os_stat(repacked)).st_mtime_ns == (await wrapio.os_stat(source)).st_mtime_ns
+		except FileNotFoundError:
+			return False
+
+
+	async def best(self, source):
+		repacked = Repacker.repacked_path(source)
+		if repacked != source and await self.is_current(source, repacked):
+			return repacked
+		return source
+
+
+	def schedule(self, source):
+		if not self.enabled or not source.endswith('.tar.xz'):
+			return
+		# an archive that has been repacked already is skipped by the task itself
+		if source in self.tasks:
+			return
+		self.tasks[source] = asyncio.ensure_future(self._repack(source))
+
+
+	async def stop(self):
+		for task in list(self.tasks.values()):
+			task.cancel()
+			try:
+				await task
+			except asyncio.CancelledError:
+				pass
+
+
+	async def _repack(self, source):
+		repacked = Repacker.repacked_path(source)
+		staging = None
+		try:
+			if await self.is_current(source, repacked):
+				return
+			fd, staging = await wrapio.tempfile_mkstemp(dir=p.dirname(repacked), prefix=f'.{p.basename(repacked)}.')
+			os.close(fd)
+			async with self.context.cache.pin(source):
+				async with self.context.locks.lock(f'repack:{source}'):
+					# another worker may have repacked it while we were waiting
+					if await self.is_current(source, repacked):
+						return
+					st = await wrapio.os_stat(source)
+					async with self.context.scheduler.slot('extract'):
+						logging.info(f'Repacker: repacking {source} into {repacked}')
+						with self.context.metrics.phase_seconds.time(phase='repack'):
+							# a truncated or corrupt archive must fail the repack rather than leave a short copy behind
+							await util.run(
+								[ 'bash', '-c', 'set -o pipefail; xz -dc -T0 -- "$1" | zstd -q -T0 -f -o "$2"', 'bash', source, staging ],
+							)
+							await util.run([ 'zstd', '-q', '-t', '--', staging ])
+					await wrapio.os_utime(staging, ns=(st.st_atime_ns, st.st_mtime_ns))
+					await wrapio.os_rename(staging, repacked)
+			logging.info(f'Repacker: repacked {source}')
+		except asyncio.CancelledError:
+			raise
+		except Exception as e:
+			logging.warning(f'Repacker: failed to repack {source}: {e}')
+		finally:
+			if staging is not None:
+				try:
+					await wrapio.os_unlink(staging)
+				except FileNotFoundError:
+					pass
+			self.tasks.pop(source, None)
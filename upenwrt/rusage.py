@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+
+# Runs a command and reports its resource usage, which asyncio cannot retrieve for its own children.
+# Usage: rusage.py FD ARGV...
+# The rusage of the command is written to FD as JSON once it exits; the exit status is passed through.
+
+import os
+import sys
+import json
+import signal
+
+
+def main():
+	fd = int(sys.argv[1])
+	argv = sys.argv[2:]
+
+	pid = os.fork()
+	if pid == 0:
+		os.close(fd)
+		try:
+			os.execvp(argv[0], argv)
+		except OSError as e:
+			print(f'rusage.py: {argv[0]}: {e}', file=sys.stderr)
+			os._exit(127)
+
+	# let the caller terminate the command through us
+	for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+		signal.signal(signum, lambda signum, frame: os.kill(pid, signum))
+
+	while True:
+		try:
+			_, status, rusage = os.wait4(pid, 0)
+			break
+		except InterruptedError:
+			continue
+
+	with os.fdopen(fd, 'w') as f:
+		json.dump({
+			'cpu_user': rusage.ru_utime,
+			'cpu_system': rusage.ru_stime,
+			# kilobytes on Linux
+			'max_rss': rusage.ru_maxrss * 1024,
+		}, f)
+
+	if os.WIFSIGNALED(status):
+		sys.exit(128 + os.WTERMSIG(status))
+	sys.exit(os.WEXITSTATUS(status))
+
+
+if __name__ == '__main__':
+	main()
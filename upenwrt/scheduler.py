@@ -0,0 +1,96 @@
+#!/hint/python3
+
+import logging
+import asyncio
+import contextvars
+import heapq
+import itertools
+from contextlib import asynccontextmanager
+
+from .util import UpenwrtBusyError
+
+
+class PrioritySemaphore:
+	def __init__(self, value):
+		self.value = value
+		self.waiters = []
+		self.seq = itertools.count()
+
+
+	@property
+	def waiting(self):
+		return sum(1 for _, _, f in self.waiters if not f.done())
+
+
+	async def acquire(self, priority):
+		if self.value > 0 and not self.waiting:
+			self.value -= 1
+			return
+
+		future = asyncio.get_event_loop().create_future()
+		heapq.heappush(self.waiters, (priority, next(self.seq), future))
+		try:
+			await future
+		except asyncio.CancelledError:
+			if future.done() and not future.cancelled():
+				# we were woken up, but nobody is going to use the slot
+				self.release()
+			raise
+
+
+	def release(self):
+		while self.waiters:
+			_, _, future = heapq.heappop(self.waiters)
+			if not future.done():
+				future.set_result(None)
+				return
+		self.value += 1
+
+
+class Scheduler:
+	LANES = ( 'extract', 'source', 'build' )
+
+	# lower is served first
+	PRIORITY_LIST = 0
+	PRIORITY_BUILD = 1
+	PRIORITY_PREFETCH = 2
+
+	# inherited by everything (including background tasks) spawned while handling a request
+	priority = contextvars.ContextVar('upenwrt_priority', default=PRIORITY_BUILD)
+
+	def __init__(self, *, context):
+		self.context = context
+		self.max_queue = context.max_queue
+		self.retry_after = context.retry_after
+		self.lanes = {
+			'extract': PrioritySemaphore(context.extract_concurrency),
+			'source': PrioritySemaphore(context.source_concurrency),
+			'build': PrioritySemaphore(context.build_concurrency),
+		}
+
+
+	@property
+	def queue_depth(self):
+		return sum(lane.waiting for lane in self.lanes.values())
+
+
+	def check_queue(self, waiting):
+		if waiting >= self.max_queue:
+			raise UpenwrtBusyError(
+				f'Server is busy ({waiting} operations queued), try again later.',
+				retry_after=self.retry_after,
+			)
+
+
+	@asynccontextmanager
+	async def slot(self, lane):
+		semaphore = self.lanes[lane]
+		self.check_queue(semaphore.waiting)
+
+		priority = Scheduler.priority.get()
+		logging.debug(f'Scheduler: waiting for {lane} (priority {priority}, {semaphore.waiting} queued)')
+		await semaphore.acquire(priority)
+		try:
+			yield
+		finally:
+			semaphore.release()
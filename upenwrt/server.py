@@ -1,8 +1,17 @@
 #!/hint/python3
 
 import sys
+import os
+import time
+import signal
+import shutil
 import os.path as p
 import logging
+import asyncio
+import hashlib
+import json
+import re
+import collections
 import aiofiles
 import aiofiles.os
 import aiohttp.web
@@ -13,10 +22,29 @@ import traceback
 from typing import *
 
 from . import util
-from .artifact import OpenwrtArtifact
+from . import wrapio
+from . import tracing
+from .artifact import ArtifactRegistry
 from .source import OpenwrtSource
 from .operation import OpenwrtOperation
-from .util import UpenwrtError, UpenwrtUserError
+from .pool import ImagebuilderPool
+from .checkout import CheckoutManager
+from .buildcache import BuildCache
+from .pkgcache import PackageCache
+from .cachemgr import CacheManager
+from .repack import Repacker
+from .download import Downloader
+from .filelock import FileLocks
+from .prefetch import Prefetcher
+from .dispatch import Dispatcher
+from .singleflight import SingleFlight
+from .metaindex import MetadataIndex
+from .manifest import ManifestIndex
+from .jobs import JobManager
+from .batch import BatchBuild
+from .scheduler import Scheduler
+from .metrics import Metrics
+from .util import UpenwrtError, UpenwrtUserError, UpenwrtBusyError
 
 
 @attr.s(kw_only=True)
@@ -25,12 +53,67 @@ class UpenwrtContext:
 	staticdir = attr.ib()
 	cachedir = attr.ib()
 	workdir = attr.ib()
+	pooldir = attr.ib()
+	checkoutdir = attr.ib()
+	lockdir = attr.ib()
 	repodir = attr.ib()
 	baseurl = attr.ib()
 	baseurlpath = attr.ib()
+	pool_size = attr.ib(type=int)
+	pool_idle_timeout = attr.ib(type=float)
+	pool_refill_interval = attr.ib(type=float)
+	pool_method = attr.ib(type=str)
+	build_cache_size = attr.ib(type=int)
+	package_cache_size = attr.ib(type=int)
+	cache_size = attr.ib(type=int)
+	checkout_cache_size = attr.ib(type=int)
+	mirror_url = attr.ib(type=str)
+	artifact_ttl = attr.ib(type=float)
+	repack = attr.ib(type=bool)
+	download_segments = attr.ib(type=int)
+	prefetch = attr.ib(type=list)
+	prefetch_interval = attr.ib(type=float)
+	prefetch_window = attr.ib(type=float)
+	prefetch_concurrency = attr.ib(type=int)
+	trace_file = attr.ib(type=str)
+	trace_otlp = attr.ib(type=str)
+	job_concurrency = attr.ib(type=int)
+	job_ttl = attr.ib(type=float)
+	extract_concurrency = attr.ib(type=int)
+	source_concurrency = attr.ib(type=int)
+	build_concurrency = attr.ib(type=int)
+	max_queue = attr.ib(type=int)
+	retry_after = attr.ib(type=int)
+	workers = attr.ib(type=int)
+	dispatch = attr.ib(type=list)
+	dispatch_interval = attr.ib(type=float)
+
+	# set up by for_worker() when serving with several worker processes
+	worker = attr.ib(type=int, default=None)
+	jobsdir = attr.ib(type=str, default=None)
+
+	# runtime state, set up by UpenwrtApp
+	locks = attr.ib(default=None)
+	pool = attr.ib(default=None)
+	checkouts = attr.ib(default=None)
+	build_cache = attr.ib(default=None)
+	package_cache = attr.ib(default=None)
+	cache = attr.ib(default=None)
+	repacker = attr.ib(default=None)
+	downloader = attr.ib(default=None)
+	prefetcher = attr.ib(default=None)
+	dispatcher = attr.ib(default=None)
+	flights = attr.ib(default=None)
+	metaindex = attr.ib(default=None)
+	manifests = attr.ib(default=None)
+	artifacts = attr.ib(default=None)
+	jobs = attr.ib(default=None)
+	scheduler = attr.ib(default=None)
+	metrics = attr.ib(default=None)
+	tracer = attr.ib(default=None)
 
 	@staticmethod
-	def from_args(*, basedir, baseurl):
+	def from_args(*, basedir, baseurl, pool_size=4, pool_idle_timeout=3600, pool_refill_interval=60, pool_method='auto', build_cache_size=1 << 30, package_cache_size=2 << 30, cache_size=8 << 30, checkout_cache_size=2, mirror_url='https://downloads.openwrt.org', artifact_ttl=300, repack=False, download_segments=4, prefetch=(), prefetch_interval=900, prefetch_window=86400, prefetch_concurrency=1, trace_file=None, trace_otlp=None, job_concurrency=2, job_ttl=3600, extract_concurrency=2, source_concurrency=1, build_concurrency=2, max_queue=16, retry_after=30, workers=1, dispatch=(), dispatch_interval=5):
 		baseparsed = urllib.parse.urlparse(baseurl)
 		# noinspection PyArgumentList
 		return UpenwrtContext(
@@ -38,15 +121,62 @@ class UpenwrtContext:
 			staticdir=p.join(basedir, 'static'),
 			cachedir=p.join(basedir, 'cache'),
 			workdir=p.join(basedir, 'work'),
+			pooldir=p.join(basedir, 'work', 'pool'),
+			checkoutdir=p.join(basedir, 'work', 'checkouts'),
+			lockdir=p.join(basedir, 'work', 'locks'),
 			repodir=p.join(basedir, 'repo'),
 			baseurl=baseurl,
 			baseurlpath=p.normpath(p.join('/', baseparsed.path)),
+			pool_size=pool_size,
+			pool_idle_timeout=pool_idle_timeout,
+			pool_refill_interval=pool_refill_interval,
+			pool_method=pool_method,
+			build_cache_size=build_cache_size,
+			package_cache_size=package_cache_size,
+			cache_size=cache_size,
+			checkout_cache_size=checkout_cache_size,
+			mirror_url=mirror_url.rstrip('/'),
+			artifact_ttl=artifact_ttl,
+			repack=repack,
+			download_segments=download_segments,
+			prefetch=list(prefetch),
+			prefetch_interval=prefetch_interval,
+			prefetch_window=prefetch_window,
+			prefetch_concurrency=prefetch_concurrency,
+			trace_file=trace_file,
+			trace_otlp=trace_otlp,
+			job_concurrency=job_concurrency,
+			job_ttl=job_ttl,
+			extract_concurrency=extract_concurrency,
+			source_concurrency=source_concurrency,
+			build_concurrency=build_concurrency,
+			max_queue=max_queue,
+			retry_after=retry_after,
+			workers=workers,
+			dispatch=list(dispatch),
+			dispatch_interval=dispatch_interval,
+		)
+
+
+	def for_worker(self, worker):
+		# extracted trees and checkouts are private to each worker, everything in cachedir is shared
+		return attr.evolve(
+			self,
+			worker=worker,
+			pooldir=p.join(self.pooldir, str(worker)),
+			checkoutdir=p.join(self.checkoutdir, str(worker)),
+			jobsdir=p.join(self.workdir, 'jobs', str(worker)),
 		)
 
 
 class UpenwrtHandler:
+	CHUNK_SIZE = 256 * 1024
+	ETAG_CACHE_SIZE = 256
+	BYTE_RANGE = re.compile(r'\s*bytes\s*=\s*([0-9]*)\s*-\s*([0-9]*)\s*', re.IGNORECASE)
+
 	def __init__(self, context: UpenwrtContext):
 		self.context = context
+		self.etags = collections.OrderedDict()
 
 
 	async def response_template_file(self, request: aiohttp.web.Request, file, replacements):
@@ -62,16 +192,98 @@ class UpenwrtHandler:
 		return response
 
 
-	async def response_stream_file(self, request: aiohttp.web.Request, fobj):
-		st = await aiofiles.os.stat(fobj.fileno())
+	@staticmethod
+	def _hash_fd(fd):
+		h = hashlib.sha256()
+		offset = 0
+		while True:
+			chunk = os.pread(fd, 1 << 20, offset)
+			if not chunk:
+				return h.hexdigest()
+			h.update(chunk)
+			offset += len(chunk)
+
+
+	async def file_etag(self, fobj, st):
+		# built images never change in place, so the hash is remembered by inode
+		key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+		etag = self.etags.get(key)
+		if etag is None:
+			etag = (await aiofiles.os.wrap(UpenwrtHandler._hash_fd)(fobj.fileno()))[:32]
+			self.etags[key] = etag
+			if len(self.etags) > UpenwrtHandler.ETAG_CACHE_SIZE:
+				self.etags.popitem(last=False)
+		else:
+			self.etags.move_to_end(key)
+		return etag
+
 
-		resp = aiohttp.web.StreamResponse()
+	@staticmethod
+	def byte_range(header, size):
+		# returns (start, stop) of the requested range, or None to send everything: a Range header
+		# in another unit, with several ranges or that does not parse is ignored (RFC 9110, 14.2)
+		m = UpenwrtHandler.BYTE_RANGE.fullmatch(header)
+		if not m or not (m[1] or m[2]):
+			return None
+		if not m[1]:
+			# suffix range, the last N bytes
+			start, stop = max(0, size - int(m[2])), size
+		else:
+			start = int(m[1])
+			stop = size if not m[2] else min(int(m[2]) + 1, size)
+			if m[2] and int(m[2]) < start:
+				return None
+		if start >= stop:
+			raise aiohttp.web.HTTPRequestRangeNotSatisfiable(headers={ 'Content-Range': f'bytes */{size}' })
+		return start, stop
+
+
+	async def response_send_file(self, request: aiohttp.web.Request, fobj):
+		st = await wrapio.os_fstat(fobj.fileno())
+		etag = await self.file_etag(fobj, st)
+		size = st.st_size
+
+		if request.if_none_match and any(e.value in (etag, '*') for e in request.if_none_match):
+			raise aiohttp.web.HTTPNotModified(headers={ 'ETag': f'"{etag}"' })
+
+		offset, count = 0, size
+		content_range = None
+		# a stale If-Range (our ETags are strong, dates are not) means "send everything"
+		if_range = request.headers.get('If-Range')
+		rng = request.headers.get('Range')
+		if rng is not None and (if_range is None or if_range == f'"{etag}"'):
+			rng = UpenwrtHandler.byte_range(rng, size)
+			if rng is not None:
+				start, stop = rng
+				offset, count = start, stop - start
+				content_range = f'bytes {start}-{stop - 1}/{size}'
+
+		resp = aiohttp.web.StreamResponse(status=206 if content_range else 200)
 		resp.content_type = 'application/octet-stream'
-		resp.content_length = st.st_size
+		resp.content_length = count
 		resp.last_modified = st.st_mtime
+		resp.etag = etag
+		resp.headers['Accept-Ranges'] = 'bytes'
+		if content_range:
+			resp.headers['Content-Range'] = content_range
 		await resp.prepare(request)
-
-		await util.copy_stream(src=fobj, dst=resp)
+		if not count:
+			return resp
+
+		if request.transport is None:
+			raise ConnectionResetError('Connection lost')
+		try:
+			await asyncio.get_event_loop().sendfile(request.transport, fobj, offset, count)
+		except NotImplementedError:
+			# e. g. TLS transports
+			while count:
+				chunk = await wrapio.os_pread(fobj.fileno(), min(count, UpenwrtHandler.CHUNK_SIZE), offset)
+				if not chunk:
+					break
+				await resp.write(chunk)
+				offset += len(chunk)
+				count -= len(chunk)
+		await resp.write_eof()
 
 		return resp
 
@@ -94,22 +306,28 @@ class UpenwrtHandler:
 
 
 	async def api_prepare_operation(self, request: aiohttp.web.Request):
-		logging.info(f'GET {request.rel_url.path}(args={request.query})')
-
-		args = request.query
+		if request.method == 'POST':
+			args = await request.post()
+		else:
+			args = request.query
+		logging.info(f'{request.method} {request.rel_url.path}(args={args})')
 
 		# read arguments from URL query string
-		target_name = args['target_name']
-		board_name = args['board_name']
-		current_release = args.get('current_release', None)
-		current_revision = args.get('current_revision', None)
-		target_version = args.get('target_version', 'snapshot')
-		pkgs = args.getall('pkgs', [])
-
-		artifact = OpenwrtArtifact(
-			context=self.context,
+		return self.make_operation(
+			target_name=args['target_name'],
+			board_name=args['board_name'],
+			current_release=args.get('current_release', None),
+			current_revision=args.get('current_revision', None),
+			target_version=args.get('target_version', 'snapshot'),
+			pkgs=args.getall('pkgs', []),
+		)
+
+
+	def make_operation(self, *, target_name, board_name, current_release, current_revision, target_version, pkgs):
+		artifact = self.context.artifacts.get(
 			target_name=target_name,
 			version_id=target_version,
+			requested=True,
 		)
 
 		source = OpenwrtSource(
@@ -126,6 +344,14 @@ class UpenwrtHandler:
 			target_name=target_name,
 			board_name=board_name,
 			pkgs=pkgs,
+			manifest=ManifestIndex.digest(ManifestIndex.canonical(
+				target_name=target_name,
+				board_name=board_name,
+				current_release=current_release,
+				current_revision=current_revision,
+				target_version=target_version,
+				pkgs=pkgs,
+			)),
 		)
 
 		return op
@@ -133,17 +359,25 @@ class UpenwrtHandler:
 
 	async def handle_api_build(self, request: aiohttp.web.Request):
 		op = await self.api_prepare_operation(request=request)
-		async with op:
-			output = await op.build()
+		return await self.response_build(request=request, op=op)
+
 
-			async with aiofiles.open(output, 'rb') as f:
+	async def response_build(self, request: aiohttp.web.Request, op: OpenwrtOperation):
+		# identical concurrent requests share a single build
+		flight = self.context.flights.join(key=op.inputs_key(), op=op)
+		async with flight:
+			output = await flight.result()
+
+			with await wrapio.builtins_open(output, 'rb') as f:
 				# we have already opened the output, release resources
-				# (i. e. remove the working directory)
-				await op.__aexit__()
-				return await self.response_stream_file(request=request, fobj=f)
+				# (i. e. remove the working directory once no other request needs it)
+				await flight.__aexit__()
+				return await self.response_send_file(request=request, fobj=f)
 
 
 	async def handle_api_list(self, request: aiohttp.web.Request):
+		# listing never runs make, let it overtake queued builds
+		Scheduler.priority.set(Scheduler.PRIORITY_LIST)
 		op = await self.api_prepare_operation(request=request)
 		async with op:
 			output = await op.list_packages()
@@ -151,6 +385,207 @@ class UpenwrtHandler:
 		return aiohttp.web.Response(text=output)
 
 
+	async def handle_api_batch(self, request: aiohttp.web.Request):
+		try:
+			body = await request.json()
+		except ValueError:
+			raise UpenwrtUserError(f'Expected a JSON object with a list of devices')
+		devices = body.get('devices') if isinstance(body, dict) else None
+		logging.info(f'POST {request.rel_url.path}({len(devices or ())} devices)')
+
+		batch = BatchBuild(context=self.context, make_operation=self.make_operation, devices=devices)
+		# admitted as a whole, however many builds it turns out to need
+		self.context.jobs.check_queue()
+
+		# one line per device, in the order they finish
+		response = aiohttp.web.StreamResponse(headers={ 'Content-Type': 'application/x-ndjson' })
+		await response.prepare(request)
+		async for result in batch.results():
+			await response.write(json.dumps(result).encode('utf-8') + b'\n')
+		await response.write_eof()
+		return response
+
+
+	def api_manifest_digest(self, request: aiohttp.web.Request):
+		logging.info(f'{request.method} {request.rel_url.path}')
+		return ManifestIndex.check_digest(request.match_info['digest'])
+
+
+	async def handle_api_manifest(self, request: aiohttp.web.Request):
+		digest = self.api_manifest_digest(request)
+		async with self.context.manifests.lookup(digest) as found:
+			if found is None:
+				raise aiohttp.web.HTTPNotFound(text=f'Unknown manifest: {digest}')
+			entry, output = found
+
+		return aiohttp.web.json_response(data={
+			'profile': entry['profile'],
+			'packages': entry['packages'],
+			'image_url': f'{self.context.baseurl.rstrip("/")}/api/manifest/{digest}/image',
+		})
+
+
+	async def handle_api_manifest_image(self, request: aiohttp.web.Request):
+		digest = self.api_manifest_digest(request)
+		async with self.context.manifests.lookup(digest) as found:
+			if found is None:
+				raise aiohttp.web.HTTPNotFound(text=f'Unknown manifest: {digest}')
+			entry, output = found
+			f = await wrapio.builtins_open(output, 'rb')
+
+		# once opened, the image may be evicted
+		with f:
+			return await self.response_send_file(request=request, fobj=f)
+
+
+	async def handle_api_manifest_build(self, request: aiohttp.web.Request):
+		digest = self.api_manifest_digest(request)
+		# the body may come gzip-compressed, aiohttp undoes the Content-Encoding
+		args = ManifestIndex.parse(await request.read(), digest)
+		op = self.make_operation(**args)
+		return await self.response_build(request=request, op=op)
+
+
+	def api_get_job(self, request: aiohttp.web.Request):
+		job = self.context.jobs.get(request.match_info['job_id'])
+		if job is None:
+			raise aiohttp.web.HTTPNotFound(text=f'No such job: {request.match_info["job_id"]}')
+		return job
+
+
+	async def handle_api_job_submit(self, request: aiohttp.web.Request):
+		op = await self.api_prepare_operation(request=request)
+		job = self.context.jobs.submit(op)
+
+		base = self.context.baseurl.rstrip('/')
+		return aiohttp.web.json_response(
+			status=202,
+			data={
+				'id': job.id,
+				'status_url': f'{base}/api/jobs/{job.id}',
+				'image_url': f'{base}/api/jobs/{job.id}/image',
+			},
+		)
+
+
+	async def handle_api_job_status(self, request: aiohttp.web.Request):
+		job = self.api_get_job(request)
+		return aiohttp.web.json_response(data=job.status())
+
+
+	async def handle_api_job_image(self, request: aiohttp.web.Request):
+		logging.info(f'GET {request.rel_url.path}')
+		job = self.api_get_job(request)
+		if job.state == 'failed':
+			factory = {
+				400: aiohttp.web.HTTPBadRequest,
+				503: aiohttp.web.HTTPServiceUnavailable,
+			}.get(job.error_status, aiohttp.web.HTTPInternalServerError)
+			raise factory(text=job.error)
+		if job.state != 'done':
+			raise aiohttp.web.HTTPConflict(text=f'Job {job.id} is not finished yet ({job.state}, {job.phase})')
+
+		with await wrapio.builtins_open(job.output, 'rb') as f:
+			return await self.response_send_file(request=request, fobj=f)
+
+
+	async def handle_api_worker(self, request: aiohttp.web.Request):
+		# load and inventory, polled by a dispatcher in front of us
+		return aiohttp.web.json_response(data={
+			'operations': self.context.metrics.operations.get(),
+			'queued': self.context.scheduler.queue_depth,
+			'capacity': self.context.build_concurrency,
+			'warm': sorted(self.context.pool.trees.keys()),
+			'cached': sorted(
+				(artifact.version_id, artifact.target_name)
+				for artifact in list(self.context.artifacts.artifacts.values())
+				if artifact.imagebuilder_file and p.exists(artifact.imagebuilder_file)
+			),
+		})
+
+
+	async def dispatch_key(self, request: aiohttp.web.Request):
+		if request.method == 'POST':
+			args = await request.post()
+		else:
+			args = request.query
+		logging.info(f'{request.method} {request.rel_url.path}(args={args}): dispatching')
+		return args.get('target_version', 'snapshot'), args.get('target_name')
+
+
+	async def handle_dispatch(self, request: aiohttp.web.Request):
+		worker, response = await self.context.dispatcher.forward(request, key=await self.dispatch_key(request))
+		return response
+
+
+	async def handle_dispatch_job_submit(self, request: aiohttp.web.Request):
+		worker, response = await self.context.dispatcher.forward(request, key=await self.dispatch_key(request))
+		if response.status != 202:
+			return response
+
+		# job ids are only known to the worker that runs the job, remember where it went
+		job_id = json.loads(response.body)['id']
+		self.context.dispatcher.add_job(job_id, worker)
+
+		base = self.context.baseurl.rstrip('/')
+		return aiohttp.web.json_response(
+			status=202,
+			data={
+				'id': job_id,
+				'status_url': f'{base}/api/jobs/{job_id}',
+				'image_url': f'{base}/api/jobs/{job_id}/image',
+			},
+		)
+
+
+	async def handle_dispatch_batch(self, request: aiohttp.web.Request):
+		try:
+			body = await request.json()
+			devices = body['devices']
+			# a batch is not split, send it where most of its devices would go
+			key, _ = collections.Counter(
+				(device.get('target_version', 'snapshot'), device.get('target_name'))
+				for device in devices
+			).most_common(1)[0]
+		except (ValueError, KeyError, TypeError, AttributeError, IndexError):
+			raise UpenwrtUserError(f'Expected a JSON object with a list of devices')
+		worker, response = await self.context.dispatcher.forward(request, key=key)
+		return response
+
+
+	async def handle_dispatch_manifest(self, request: aiohttp.web.Request):
+		self.api_manifest_digest(request)
+		# only the worker that built it knows the manifest, ask each of them in turn
+		worker, response = await self.context.dispatcher.forward(request, key=None, fallthrough=(404,))
+		return response
+
+
+	async def handle_dispatch_manifest_build(self, request: aiohttp.web.Request):
+		digest = self.api_manifest_digest(request)
+		args = ManifestIndex.parse(await request.read(), digest)
+		worker, response = await self.context.dispatcher.forward(request, key=(args['target_version'], args['target_name']))
+		return response
+
+
+	async def handle_dispatch_job(self, request: aiohttp.web.Request):
+		worker = self.context.dispatcher.job_worker(request.match_info['job_id'])
+		if worker is None:
+			raise aiohttp.web.HTTPNotFound(text=f'No such job: {request.match_info["job_id"]}')
+		worker, response = await self.context.dispatcher.forward(request, worker=worker)
+		return response
+
+
+	async def handle_metrics(self, request: aiohttp.web.Request):
+		return aiohttp.web.Response(
+			body=self.context.metrics.render().encode('utf-8'),
+			headers={ 'Content-Type': 'text/plain; version=0.0.4; charset=utf-8' },
+		)
+
+
+	async def handle_api_stats(self, request: aiohttp.web.Request):
+		return aiohttp.web.json_response(data=await self.context.cache.stats())
+
+
 	@staticmethod
 	def handle_error(factory, text=None, user_error=False):
 		e = sys.exc_info()
@@ -174,14 +609,24 @@ class UpenwrtHandler:
 	@staticmethod
 	def wrap(handler: Callable[..., ResponseCoroutine], *args, **kwargs) -> Callable[[aiohttp.web.Request], ResponseCoroutine]:
 		async def wrapped(request: aiohttp.web.Request):
+			tracing.request_id.set(tracing.new_trace_id())
 			try:
-				return await handler(request, *args, **kwargs)
+				with tracing.span(f'{request.method} {request.rel_url.path}', kind='server'):
+					return await handler(request, *args, **kwargs)
+			except aiohttp.web.HTTPException:
+				raise
 			except UpenwrtUserError as e:
 				UpenwrtHandler.handle_error(
 					factory=aiohttp.web.HTTPBadRequest,
 					text=str(e),
 					user_error=True,
 				)
+			except UpenwrtBusyError as e:
+				logging.warning(f'{request.method} {request.rel_url.path}: {e}')
+				raise aiohttp.web.HTTPServiceUnavailable(
+					text=str(e),
+					headers={ 'Retry-After': str(e.retry_after) },
+				)
 			except subprocess.CalledProcessError as e:
 				UpenwrtHandler.handle_error(
 					factory=aiohttp.web.HTTPInternalServerError,
@@ -197,20 +642,96 @@ class UpenwrtHandler:
 	def routes(self):
 		H = UpenwrtHandler.wrap
 		base = self.context.baseurlpath
+		if self.context.dispatcher.enabled:
+			# operations are run by the build workers
+			api = [
+				aiohttp.web.get(p.join(base, 'api/build'), H(self.handle_dispatch), allow_head=False),
+				aiohttp.web.get(p.join(base, 'api/list'), H(self.handle_dispatch), allow_head=False),
+				aiohttp.web.post(p.join(base, 'api/jobs'), H(self.handle_dispatch_job_submit)),
+				aiohttp.web.post(p.join(base, 'api/batch'), H(self.handle_dispatch_batch)),
+				aiohttp.web.get(p.join(base, 'api/manifest/{digest}'), H(self.handle_dispatch_manifest)),
+				aiohttp.web.get(p.join(base, 'api/manifest/{digest}/image'), H(self.handle_dispatch_manifest), allow_head=False),
+				aiohttp.web.post(p.join(base, 'api/manifest/{digest}'), H(self.handle_dispatch_manifest_build)),
+				aiohttp.web.get(p.join(base, 'api/jobs/{job_id}'), H(self.handle_dispatch_job), allow_head=False),
+				aiohttp.web.get(p.join(base, 'api/jobs/{job_id}/image'), H(self.handle_dispatch_job), allow_head=False),
+			]
+		else:
+			api = [
+				aiohttp.web.get(p.join(base, 'api/build'), H(self.handle_api_build), allow_head=False),
+				aiohttp.web.get(p.join(base, 'api/list'), H(self.handle_api_list), allow_head=False),
+				aiohttp.web.post(p.join(base, 'api/jobs'), H(self.handle_api_job_submit)),
+				aiohttp.web.post(p.join(base, 'api/batch'), H(self.handle_api_batch)),
+				# HEAD is the cheap probe
+				aiohttp.web.get(p.join(base, 'api/manifest/{digest}'), H(self.handle_api_manifest)),
+				aiohttp.web.get(p.join(base, 'api/manifest/{digest}/image'), H(self.handle_api_manifest_image), allow_head=False),
+				aiohttp.web.post(p.join(base, 'api/manifest/{digest}'), H(self.handle_api_manifest_build)),
+				aiohttp.web.get(p.join(base, 'api/jobs/{job_id}'), H(self.handle_api_job_status), allow_head=False),
+				aiohttp.web.get(p.join(base, 'api/jobs/{job_id}/image'), H(self.handle_api_job_image), allow_head=False),
+			]
 		return [
 			aiohttp.web.get(p.join(base, ''), H(self.handle_get_readme)),
 			aiohttp.web.get(p.join(base, 'get'), H(self.handle_get_sh, api='build')),
 			aiohttp.web.get(p.join(base, 'list'), H(self.handle_get_sh, api='list')),
-			aiohttp.web.get(p.join(base, 'api/build'), H(self.handle_api_build), allow_head=False),
-			aiohttp.web.get(p.join(base, 'api/list'), H(self.handle_api_list), allow_head=False),
+			*api,
+			aiohttp.web.get(p.join(base, 'api/worker'), H(self.handle_api_worker), allow_head=False),
+			aiohttp.web.get(p.join(base, 'api/stats'), H(self.handle_api_stats), allow_head=False),
+			aiohttp.web.get(p.join(base, 'metrics'), H(self.handle_metrics), allow_head=False),
 		]
 
 
 class UpenwrtApp(aiohttp.web.Application):
 	def __init__(self, context: UpenwrtContext):
 		super().__init__()
+		self.context = context
+		self.context.metrics = Metrics(context=context)
+		if context.trace_file or context.trace_otlp:
+			self.context.tracer = tracing.Tracer(context=context)
+			tracing.tracer = self.context.tracer
+		self.context.locks = FileLocks(lockdir=context.lockdir)
+		self.context.scheduler = Scheduler(context=context)
+		self.context.cache = CacheManager(context=context)
+		self.context.pool = ImagebuilderPool(context=context)
+		self.context.checkouts = CheckoutManager(context=context)
+		self.context.build_cache = BuildCache(context=context)
+		self.context.package_cache = PackageCache(context=context)
+		self.context.repacker = Repacker(context=context)
+		self.context.downloader = Downloader(segments=context.download_segments, locks=context.locks)
+		self.context.flights = SingleFlight()
+		self.context.metaindex = MetadataIndex(context=context)
+		self.context.manifests = ManifestIndex(context=context)
+		self.context.artifacts = ArtifactRegistry(context=context)
+		self.context.jobs = JobManager(context=context)
+		self.context.prefetcher = Prefetcher(context=context)
+		self.context.dispatcher = Dispatcher(context=context)
 		handler = UpenwrtHandler(context)
 		self.add_routes(handler.routes())
+		self.on_startup.append(self.start_services)
+		self.on_cleanup.append(self.stop_services)
+
+
+	async def start_services(self, app):
+		if self.context.tracer:
+			await self.context.tracer.start()
+		await self.context.cache.start()
+		await self.context.pool.start()
+		await self.context.checkouts.start()
+		await self.context.jobs.start()
+		await self.context.prefetcher.start()
+		await self.context.dispatcher.start()
+
+
+	async def stop_services(self, app):
+		await self.context.dispatcher.stop()
+		await self.context.prefetcher.stop()
+		await self.context.jobs.stop()
+		await self.context.repacker.stop()
+		await self.context.pool.stop()
+		await self.context.checkouts.stop()
+		await self.context.cache.stop()
+		await self.context.metaindex.close()
+		await self.context.downloader.close()
+		if self.context.tracer:
+			await self.context.tracer.stop()
 
 
 def upenwrt_serve(host, port, app: UpenwrtApp):
@@ -219,3 +740,58 @@ def upenwrt_serve(host, port, app: UpenwrtApp):
 		host=host,
 		port=port,
 	)
+
+
+def upenwrt_serve_workers(host, port, context: UpenwrtContext):
+	# each worker binds its own SO_REUSEPORT socket and the kernel spreads connections between them;
+	# whatever they share lives in cachedir and is coordinated through FileLocks
+	for d in (context.pooldir, context.checkoutdir, p.join(context.workdir, 'jobs')):
+		shutil.rmtree(d, ignore_errors=True)
+
+	children = dict()
+	stopping = False
+
+	def spawn(worker):
+		pid = os.fork()
+		if pid == 0:
+			status = 0
+			try:
+				signal.signal(signal.SIGTERM, signal.SIG_DFL)
+				signal.signal(signal.SIGINT, signal.SIG_DFL)
+				logging.info(f'upenwrt_serve_workers: worker {worker} started (pid {os.getpid()})')
+				aiohttp.web.run_app(
+					app=UpenwrtApp(context.for_worker(worker)),
+					host=host,
+					port=port,
+					reuse_port=True,
+					print=None,
+				)
+			except BaseException:
+				logging.exception(f'upenwrt_serve_workers: worker {worker} failed')
+				status = 1
+			finally:
+				os._exit(status)
+		children[pid] = worker
+
+	def terminate(signum, frame):
+		nonlocal stopping
+		stopping = True
+		for pid in children:
+			os.kill(pid, signal.SIGTERM)
+
+	signal.signal(signal.SIGTERM, terminate)
+	signal.signal(signal.SIGINT, terminate)
+
+	for worker in range(context.workers):
+		spawn(worker)
+
+	while children:
+		try:
+			pid, status = os.wait()
+		except ChildProcessError:
+			break
+		worker = children.pop(pid, None)
+		if worker is not None and not stopping:
+			logging.warning(f'upenwrt_serve_workers: worker {worker} (pid {pid}) exited with status {status}, restarting')
+			time.sleep(1)
+			spawn(worker)
@@ -0,0 +1,94 @@
+#!/hint/python3
+
+import logging
+import asyncio
+
+
+class Flight:
+	def __init__(self, *, group, key, op):
+		self.group = group
+		self.key = key
+		self.op = op
+		self.refcount = 0
+		self.idle = asyncio.Event()
+		self.future = asyncio.get_event_loop().create_future()
+		# nobody might be left to retrieve the exception
+		self.future.add_done_callback(lambda f: f.cancelled() or f.exception())
+		self.task = asyncio.ensure_future(self._run())
+
+
+	async def _run(self):
+		try:
+			async with self.op:
+				try:
+					result = await self.op.build()
+				except Exception as e:
+					self.future.set_exception(e)
+					return
+				self.future.set_result(result)
+
+				# keep the operation (and its outputs) alive until every attached request is done with it
+				while self.refcount > 0:
+					self.idle.clear()
+					await self.idle.wait()
+				self.group._discard(self)
+		finally:
+			self.group._discard(self)
+
+
+	def acquire(self):
+		self.refcount += 1
+
+
+	def release(self):
+		self.refcount -= 1
+		if self.refcount == 0:
+			self.idle.set()
+
+
+class FlightHandle:
+	def __init__(self, flight):
+		self.flight = flight
+		self.flight.acquire()
+		self.attached = True
+
+
+	@property
+	def op(self):
+		return self.flight.op
+
+
+	async def result(self):
+		# the build must not be cancelled if this particular request goes away
+		return await asyncio.shield(self.flight.future)
+
+
+	async def __aenter__(self):
+		return self
+
+
+	async def __aexit__(self, *args, **kwargs):
+		if self.attached:
+			self.attached = False
+			self.flight.release()
+
+
+class SingleFlight:
+	def __init__(self):
+		self.flights = dict()
+
+
+	def join(self, *, key, op):
+		flight = self.flights.get(key)
+		if flight is None:
+			logging.debug(f'SingleFlight: starting {key}')
+			flight = Flight(group=self, key=key, op=op)
+			self.flights[key] = flight
+		else:
+			logging.info(f'SingleFlight: attaching to in-flight {key}')
+		return FlightHandle(flight)
+
+
+	def _discard(self, flight):
+		if self.flights.get(flight.key) is flight:
+			del self.flights[flight.key]
@@ -1,12 +1,15 @@
 #!/hint/python3
 
 import os.path as p
+import logging
+import hashlib
 import re
-import tempfile
+import aiofiles
+from contextlib import asynccontextmanager
 
 from . import util
 from . import wrapio
-from .targetinfo import OpenwrtTargetinfo
+from . import tracing
 
 
 class OpenwrtSource:
@@ -30,43 +33,103 @@ class OpenwrtSource:
 		self.targetinfo = None
 
 
-	async def get_checkout(self, target_dir):
-		repo_path = p.join(self.context.repodir, 'openwrt.git')
-		target_path = tempfile.mkdtemp(dir=target_dir, prefix='worktree')
-		git_clone = await util.run(
-			[ 'git', 'clone', '--no-checkout', repo_path, target_path ],
-			cwd=target_dir,
-		)
-		git_checkout = await util.run(
-			[ 'git', 'checkout', '--force', self.ref ],
-			cwd=target_path,
-		)
-		# Apply specific patches to the buildsystem that help us to (ab)use it in the way we want
+	def repo_path(self):
+		return p.join(self.context.repodir, 'openwrt.git')
+
+
+	async def get_patches(self):
+		# Specific patches to the buildsystem that help us to (ab)use it in the way we want
 		patchdir = p.join(self.context.staticdir, 'patches')
-		for f in sorted(await wrapio.os_listdir(patchdir)):
-			if not f.endswith('.patch'):
-				continue
-			git_am = await util.run(
-				[ 'git', 'am', '-3', p.join(patchdir, f) ],
-				cwd=target_path,
-			)
-		return target_path
+		return [
+			p.join(patchdir, f)
+			for f in sorted(await wrapio.os_listdir(patchdir))
+			if f.endswith('.patch')
+		]
 
 
-	async def _make_targetinfo(self, source_dir):
+	async def get_commit(self):
+		git_rev_parse = await util.run(
+			[ 'git', 'rev-parse', '--verify', f'{self.ref}^{{commit}}' ],
+			cwd=self.repo_path(),
+		)
+		return git_rev_parse.output.strip()
+
+
+	async def get_patches_hash(self):
+		h = hashlib.sha256()
+		for f in await self.get_patches():
+			async with aiofiles.open(f, 'rb') as patch:
+				h.update(p.basename(f).encode('utf-8'))
+				h.update(await patch.read())
+		return h.hexdigest()
+
+
+	@asynccontextmanager
+	async def checkout(self, *, commit, patches_hash):
+		async with self.context.checkouts.checkout(
+			repo_path=self.repo_path(),
+			commit=commit,
+			patches=await self.get_patches(),
+			patches_hash=patches_hash,
+		) as checkout:
+			yield checkout
+
+
+	def _board_arch(self):
 		if self.target_name.count('/') != 1:
 			raise ValueError(f'OpenwrtSource: bad board name: {self.target_name} (expected exactly 1 slash)')
 		board_arch, board_soc = p.split(self.target_name)
+		return board_arch
+
+
+	async def _make_targetinfo(self, source_dir):
+		board_arch = self._board_arch()
 		targetinfo_path = p.join(source_dir, 'tmp', 'info', f'.targetinfo-{board_arch}')
 		if not p.exists(targetinfo_path):
-			make_tmpinfo = await util.run(
-				[ 'make', 'prepare-tmpinfo' ],
-				cwd=source_dir,
-			)
+			with self.context.metrics.phase_seconds.time(phase='targetinfo'):
+				make_tmpinfo = await util.run(
+					[ 'make', 'prepare-tmpinfo' ],
+					cwd=source_dir,
+				)
 		return targetinfo_path
 
 
-	async def get_targetinfo(self, source_dir):
+	async def _get_targetinfo_file(self):
+		# the generated targetinfo only depends on the source commit, our patches and the board arch
+		board_arch = self._board_arch()
+		commit = await self.get_commit()
+		patches_hash = await self.get_patches_hash()
+		cache_dir = p.join(self.context.cachedir, 'targetinfo', f'{commit}-{patches_hash[:16]}')
+		cache_path = p.join(cache_dir, f'.targetinfo-{board_arch}')
+
+		# serializes generation of identical targetinfo cache entries, across all workers
+		async with self.context.locks.lock(f'targetinfo:{cache_path}'):
+			if p.exists(cache_path):
+				logging.info(f'OpenwrtSource: using cached targetinfo for {self.ref} ({commit}): {cache_path}')
+				await self.context.cache.touch(cache_path)
+				self.context.cache.record('targetinfo', hit=True)
+				return cache_path
+
+			self.context.cache.record('targetinfo', hit=False)
+
+			logging.info(f'OpenwrtSource: generating targetinfo for {self.ref} ({commit})')
+			async with self.context.scheduler.slot('source'):
+				async with self.checkout(commit=commit, patches_hash=patches_hash) as checkout:
+					async with checkout.lock:
+						targetinfo_path = await self._make_targetinfo(checkout.path)
+
+						await wrapio.os_makedirs(cache_dir, exist_ok=True)
+						staging_path = await wrapio.tempfile_mktemp(dir=cache_dir, prefix=f'.targetinfo-{board_arch}.')
+						await wrapio.shutil_copyfile(targetinfo_path, staging_path)
+						await wrapio.os_rename(staging_path, cache_path)
+
+		return cache_path
+
+
+	@tracing.traced('source.get_targetinfo')
+	async def get_targetinfo(self):
 		if self.targetinfo is None:
-			self.targetinfo = OpenwrtTargetinfo(await self._make_targetinfo(source_dir))
+			targetinfo_path = await self._get_targetinfo_file()
+			async with self.context.cache.pin(targetinfo_path):
+				self.targetinfo = await self.context.metaindex.load_targetinfo(targetinfo_path)
 		return self.targetinfo
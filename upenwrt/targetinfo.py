@@ -1,6 +1,11 @@
 #!/hint/python3
 
 import logging
+import contextlib
+import functools
+import itertools
+import collections
+import mmap
 import re
 import attr
 
@@ -26,75 +31,218 @@ class OpenwrtPackage:
 	aliases = attr.ib(type=dict)
 
 
+class MetadataPattern:
+	# Matches the `@@` section terminators of the .targetinfo/.packageinfo format
+	# and only those `Key: value` lines whose keys are listed in `fields`
+	# (which maps metadata field names to section keys).
+	def __init__(self, fields):
+		self.fields = { k.encode('utf-8'): v for k, v in fields.items() }
+		# `[^\n]*` always runs up to the end of the line, so only `@@` needs the lookahead
+		line = b'(?:(' + b'|'.join(re.escape(k) for k in self.fields.keys()) + rb'): ([^\n]*)|@@(?=\n|\Z))'
+		self.first = re.compile(line)
+		self.rest = re.compile(b'\n' + line)
+
+
+	def parse(self, data):
+		# Yields a dict per `@@`-terminated section. `data` may be str, bytes, bytearray or mmap.
+		if isinstance(data, str):
+			data = data.encode('utf-8')
+		section = dict()
+		m = self.first.match(data)
+		matches = itertools.chain([m] if m else [], self.rest.finditer(data))
+		fields = self.fields
+		for m in matches:
+			key, value = m.groups()
+			if key is None:
+				yield section
+				section = dict()
+			else:
+				section[fields[key]] = value.decode('utf-8', errors='replace')
+
+
+	def tokens(self, data):
+		# Returns the matched lines as a list of (key, value) byte strings, with an empty key for `@@`.
+		# Cheaper than parse() where the caller only needs a couple of fields per section.
+		if isinstance(data, str):
+			data = data.encode('utf-8')
+		m = self.first.match(data)
+		tokens = [ (m[1] or b'', m[2] or b'') ] if m else []
+		tokens += self.rest.findall(data)
+		return tokens
+
+
+	@staticmethod
+	@contextlib.contextmanager
+	def map_file(path):
+		with open(path, 'rb') as f:
+			try:
+				data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+			except ValueError:
+				# empty files cannot be mapped
+				data = f.read()
+			try:
+				yield data
+			finally:
+				if isinstance(data, mmap.mmap):
+					data.close()
+
+
+	def parse_file(self, path):
+		with MetadataPattern.map_file(path) as data:
+			yield from self.parse(data)
+
+
+	def tokens_file(self, path):
+		with MetadataPattern.map_file(path) as data:
+			return self.tokens(data)
+
+
 class OpenwrtPackageinfo:
-	PACKAGEINFO_PACKAGE = re.compile('Package: (.+)')
-	PACKAGEINFO_PROVIDES = re.compile('Provides: (.+)')
+	METADATA = MetadataPattern({
+		'Package': 'package',
+		'Provides': 'provides',
+	})
+
+	# correlations memoised per packageinfo, see OpenwrtOperation.prepare()
+	CORRELATIONS_SIZE = 1024
 
 	def __init__(self, packageinfo):
 		self.packages = dict()
 		self.aliases = dict()
+		self.correlations = collections.OrderedDict()
+
+		logging.debug(f'OpenwrtPackageinfo(f={packageinfo}): parsing packageinfo')
+		self._parse_packageinfo(self.METADATA.tokens_file(packageinfo), name=packageinfo)
 
-		with open(packageinfo, 'r') as f:
-			logging.debug(f'OpenwrtPackageinfo(f={f.name}): parsing packageinfo')
-			self._parse_packageinfo(f)
 
+	@classmethod
+	def from_bytes(cls, data, name='<bytes>'):
+		packageinfo = cls.__new__(cls)
+		packageinfo._parse_packageinfo(cls.METADATA.tokens(data), name=name)
+		return packageinfo
 
-	def _parse_packageinfo(self, f):
+
+	def _parse_packageinfo(self, tokens, name):
 		packages = dict()
 		aliases = dict()
-		section = dict()
-		section_raw = []
-
-		for line in f:
-			line = line.rstrip('\n')
-			section_raw.append(line)
-
-			m = self.PACKAGEINFO_PACKAGE.fullmatch(line)
-			if m:
-				section['package'] = m[1]
-				continue
-			m = self.PACKAGEINFO_PROVIDES.fullmatch(line)
-			if m:
-				section['provides'] = set(m[1].split(' '))
-
-			if line == '@@':
-				if 'package' in section.keys():
-					package = OpenwrtPackage(
-						name=section['package'],
-						aliases=section.get('provides', set()),
-					)
-
-					packages[package.name] = package
-					aliases.setdefault(package.name, list()).append(package)
-					for a in package.aliases:
-						aliases.setdefault(a, list()).append(package)
-
-				else:
-					section_raw_string = '\n'.join(section_raw)
-					logging.debug(f'OpenwrtPackageinfo(f={f.name}): strange section:\n{section_raw_string}')
-
-				section = dict()
-				section_raw = []
+		strange = 0
+
+		# only two fields are needed, so tokens are consumed directly rather than assembled into sections,
+		# and values are only decoded once their section turns out to describe a package
+		package_name = None
+		provides = None
+		alias_list = aliases.setdefault
+		for key, value in tokens:
+			if key == b'Package':
+				package_name = value
+			elif key:
+				provides = value
+			elif package_name:
+				package_name = package_name.decode('utf-8', errors='replace')
+				# noinspection PyArgumentList
+				package = OpenwrtPackage(
+					name=package_name,
+					aliases=set(provides.decode('utf-8', errors='replace').split(' ')) if provides else set(),
+				)
+
+				packages[package_name] = package
+				alias_list(package_name, []).append(package)
+				for a in package.aliases:
+					alias_list(a, []).append(package)
+				package_name = provides = None
+			else:
+				provides = None
+				strange += 1
+
+		if strange:
+			logging.debug(f'OpenwrtPackageinfo(f={name}): skipped {strange} strange sections')
 
 		self.packages = packages
 		self.aliases = aliases
+		self.correlations = collections.OrderedDict()
+
+
+	@functools.cached_property
+	def providers(self):
+		# built on first use: parsing is on the critical path of every new imagebuilder, correlation is not
+		return OpenwrtPackageinfo.make_providers(self.aliases)
+
+
+	@staticmethod
+	def make_providers(aliases):
+		# alias -> name of the only package that provides it, or None if there are several
+		providers = dict()
+		for alias, packages in aliases.items():
+			names = { package.name for package in packages }
+			providers[alias] = names.pop() if len(names) == 1 else None
+		return providers
+
+
+	def memoise(self, key, compute):
+		# LRU of correlations against this packageinfo
+		try:
+			value = self.correlations[key]
+		except KeyError:
+			value = compute()
+			self.correlations[key] = value
+			if len(self.correlations) > OpenwrtPackageinfo.CORRELATIONS_SIZE:
+				self.correlations.popitem(last=False)
+		else:
+			self.correlations.move_to_end(key)
+		return value
+
+
+	def resolve(self, package, aliases):
+		# maps a client package and its client-side aliases onto a name that exists in this packageinfo
+		if package in self.providers:
+			return package
+
+		correlated = { a for a in aliases if a in self.providers }
+		if len(correlated) > 1:
+			# HACK: if we managed to get into this situation, try to select a single preferred alias that is a substring of package name
+			preferred = { c for c in correlated if c in package }
+			if len(preferred) == 1:
+				return preferred.pop()
+
+			# there may be multiple aliases pointing to the same package, both in source information and in target information
+			# e. g. in source, libwolfssl<unique> provides libwolfssl, libcyassl
+			#       in target, libwolfssl<unique2> provides libwolfssl, libcyassl
+			# naïvely, this is a failure condition because libwolfssl<unique> is referenced by two aliases both of which exist in target
+			# but in fact, the situation is still unambiguous
+			providers = { self.providers[c] for c in correlated }
+			if len(providers) == 1 and None not in providers:
+				return providers.pop()
+
+			raise RuntimeError(f'OpenwrtPackageinfo: package {package} has more than one alias in target: {correlated}')
+		elif correlated:
+			return correlated.pop()
+		else:
+			return package
 
 
 class OpenwrtTargetinfo:
-	TARGETINFO_TARGET = re.compile('Target: (.*)')
-	TARGETINFO_TARGET_PACKAGES = re.compile('Default-Packages: (.*)')
-
-	TARGETINFO_PROFILE = re.compile('Target-Profile: DEVICE_(.*)')
-	TARGETINFO_PROFILE_DEVICES = re.compile('Target-Profile-SupportedDevices: (.*)')
-	TARGETINFO_PROFILE_PACKAGES = re.compile('Target-Profile-Packages: (.*)')
+	METADATA = MetadataPattern({
+		'Target': 'target',
+		'Default-Packages': 'target_packages',
+		'Target-Profile': 'profile',
+		'Target-Profile-SupportedDevices': 'profile_devices',
+		'Target-Profile-Packages': 'profile_packages',
+	})
 
 	def __init__(self, targetinfo):
 		self.profiles = dict()
 		self.targets = dict()
 
-		with open(targetinfo, 'r') as f:
-			logging.debug(f'OpenwrtTargetinfo(f={f.name}): parsing targetinfo')
-			self._parse_targetinfo(f)
+		logging.debug(f'OpenwrtTargetinfo(f={targetinfo}): parsing targetinfo')
+		self._parse_targetinfo(self.METADATA.parse_file(targetinfo), name=targetinfo)
+
+
+	@classmethod
+	def from_bytes(cls, data, name='<bytes>'):
+		targetinfo = cls.__new__(cls)
+		targetinfo._parse_targetinfo(cls.METADATA.parse(data), name=name)
+		return targetinfo
+
 
 	def dump(self, target=None):
 		dump = self._dump([target] if target is not None else self.targets.keys())
@@ -112,75 +260,43 @@ class OpenwrtTargetinfo:
 
 
 
-	def _parse_targetinfo(self, f):
+	def _parse_targetinfo(self, sections, name):
 		targets = dict()
 		profiles = dict()
-		section = dict()
-		section_raw = []
 		last_target = None
-		profiles_by_target = dict()
-
-		for line in f:
-			line = line.rstrip('\n')
-			section_raw.append(line)
-
-			# parse target fields
-			m = self.TARGETINFO_TARGET.fullmatch(line)
-			if m:
-				section['target'] = m[1]
-				continue
-			m = self.TARGETINFO_TARGET_PACKAGES.fullmatch(line)
-			if m:
-				section['target_packages'] = m[1].split()
-				continue
-
-			# parse profile fields
-			m = self.TARGETINFO_PROFILE.fullmatch(line)
-			if m:
-				section['profile'] = m[1]
-				continue
-			m = self.TARGETINFO_PROFILE_DEVICES.fullmatch(line)
-			if m:
-				section['profile_devices'] = m[1].split()
-				continue
-			m = self.TARGETINFO_PROFILE_PACKAGES.fullmatch(line)
-			if m:
-				section['profile_packages'] = m[1].split()
-				continue
-
-			# parse separator
-			if line == '@@':
-				if {'profile'} <= section.keys():
-					# noinspection PyArgumentList
-					profile = OpenwrtProfile(
-						name=section['profile'],
-						target=last_target,  # NOTE: stateful format!
-						devices=section.get('profile_devices', []),
-						packages=section.get('profile_packages', []),
-					)
-					logging.debug(f'OpenwrtTargetinfo(f={f.name}): {profile}')
-					# lookup dict
-					for d in profile.devices:
-						profiles[d] = profile
-					profiles[profile.name] = profile
-					# hierarchy dict
-					last_target.profiles[profile.name] = profile
-				elif {'target'} <= section.keys():
-					# noinspection PyArgumentList
-					target = OpenwrtTarget(
-						name=section['target'],
-						packages=section.get('target_packages', []),
-						profiles=dict(),
-					)
-					logging.debug(f'OpenwrtTargetinfo(f={f.name}): {target}')
-					targets[target.name] = target
-					last_target = target
-				else:
-					section_raw_string = '\n'.join(section_raw)
-					logging.debug(f'OpenwrtTargetinfo(f={f.name}: strange section:\n{section_raw_string}')
-
-				section = dict()
-				section_raw = []
+		strange = 0
+
+		for section in sections:
+			profile_name = section.get('profile', '')
+			if profile_name.startswith('DEVICE_'):
+				# noinspection PyArgumentList
+				profile = OpenwrtProfile(
+					name=profile_name[len('DEVICE_'):],
+					target=last_target,  # NOTE: stateful format!
+					devices=section.get('profile_devices', '').split(),
+					packages=section.get('profile_packages', '').split(),
+				)
+				# lookup dict
+				for d in profile.devices:
+					profiles[d] = profile
+				profiles[profile.name] = profile
+				# hierarchy dict
+				last_target.profiles[profile.name] = profile
+			elif 'target' in section:
+				# noinspection PyArgumentList
+				target = OpenwrtTarget(
+					name=section['target'],
+					packages=section.get('target_packages', '').split(),
+					profiles=dict(),
+				)
+				targets[target.name] = target
+				last_target = target
+			else:
+				strange += 1
+
+		if strange:
+			logging.debug(f'OpenwrtTargetinfo(f={name}): skipped {strange} strange sections')
+		logging.debug(f'OpenwrtTargetinfo(f={name}): parsed {len(targets)} targets, {len(profiles)} profile names')
 
 		self.profiles = profiles
 		self.targets = targets
@@ -0,0 +1,219 @@
+#!/hint/python3
+
+import os
+import os.path as p
+import json
+import logging
+import asyncio
+import contextvars
+import functools
+import time
+import uuid
+import aiohttp
+import aiofiles.os
+import attr
+from contextlib import contextmanager
+
+
+# assigned per request in UpenwrtHandler.wrap() and inherited by everything it spawns (including shared builds)
+request_id = contextvars.ContextVar('upenwrt_request_id', default=None)
+current_span = contextvars.ContextVar('upenwrt_span', default=None)
+
+# set up by UpenwrtApp when tracing is configured
+tracer = None
+
+RUSAGE_WRAPPER = p.join(p.dirname(p.abspath(__file__)), 'rusage.py')
+
+
+def new_trace_id():
+	return uuid.uuid4().hex
+
+
+def new_span_id():
+	return os.urandom(8).hex()
+
+
+@attr.s(kw_only=True)
+class Span:
+	trace_id = attr.ib(type=str)
+	span_id = attr.ib(type=str)
+	parent_id = attr.ib(type=str, default=None)
+	name = attr.ib(type=str)
+	kind = attr.ib(type=str, default='internal')
+	start_ns = attr.ib(type=int, factory=time.time_ns)
+	end_ns = attr.ib(type=int, default=None)
+	attributes = attr.ib(type=dict, factory=dict)
+	error = attr.ib(type=str, default=None)
+
+	def to_json(self):
+		return {
+			'trace_id': self.trace_id,
+			'span_id': self.span_id,
+			'parent_id': self.parent_id,
+			'name': self.name,
+			'kind': self.kind,
+			'start': self.start_ns / 1e9,
+			'duration': (self.end_ns - self.start_ns) / 1e9,
+			'attributes': self.attributes,
+			'error': self.error,
+		}
+
+	def to_otlp(self):
+		def value(v):
+			if isinstance(v, bool):
+				return { 'boolValue': v }
+			if isinstance(v, int):
+				return { 'intValue': str(v) }
+			if isinstance(v, float):
+				return { 'doubleValue': v }
+			if isinstance(v, (list, tuple)):
+				return { 'arrayValue': { 'values': [ value(x) for x in v ] } }
+			return { 'stringValue': str(v) }
+
+		span = {
+			'traceId': self.trace_id,
+			'spanId': self.span_id,
+			'name': self.name,
+			# SPAN_KIND_INTERNAL, SPAN_KIND_SERVER
+			'kind': 2 if self.kind == 'server' else 1,
+			'startTimeUnixNano': str(self.start_ns),
+			'endTimeUnixNano': str(self.end_ns),
+			'attributes': [ { 'key': k, 'value': value(v) } for k, v in self.attributes.items() if v is not None ],
+			# STATUS_CODE_ERROR, STATUS_CODE_UNSET
+			'status': { 'code': 2, 'message': self.error } if self.error else { 'code': 0 },
+		}
+		if self.parent_id:
+			span['parentSpanId'] = self.parent_id
+		return span
+
+
+class Tracer:
+	FLUSH_INTERVAL = 1
+
+	def __init__(self, *, context):
+		self.context = context
+		self.trace_file = context.trace_file
+		self.trace_otlp = context.trace_otlp
+		self.pending = []
+		self.session = None
+		self.task = None
+
+
+	def begin(self, name, *, kind='internal', **attributes):
+		trace_id = request_id.get()
+		if trace_id is None:
+			trace_id = new_trace_id()
+			request_id.set(trace_id)
+		parent = current_span.get()
+
+		# noinspection PyArgumentList
+		return Span(
+			trace_id=trace_id,
+			span_id=new_span_id(),
+			parent_id=parent.span_id if parent and parent.trace_id == trace_id else None,
+			name=name,
+			kind=kind,
+			attributes=attributes,
+		)
+
+
+	def end(self, span, *, error=None, **attributes):
+		span.end_ns = time.time_ns()
+		span.error = error
+		span.attributes.update(attributes)
+		self.pending.append(span)
+
+
+	async def start(self):
+		if self.trace_otlp:
+			self.session = aiohttp.ClientSession()
+		self.task = asyncio.ensure_future(self._run())
+
+
+	async def stop(self):
+		if self.task:
+			self.task.cancel()
+			try:
+				await self.task
+			except asyncio.CancelledError:
+				pass
+			self.task = None
+		await self.flush()
+		if self.session:
+			await self.session.close()
+			self.session = None
+
+
+	async def _run(self):
+		while True:
+			await asyncio.sleep(Tracer.FLUSH_INTERVAL)
+			try:
+				await self.flush()
+			except Exception as e:
+				logging.warning(f'Tracer: could not export spans: {e}')
+
+
+	def _write_sync(self, spans):
+		with open(self.trace_file, 'a') as f:
+			for span in spans:
+				f.write(json.dumps(span.to_json()) + '\n')
+
+
+	async def flush(self):
+		spans, self.pending = self.pending, []
+		if not spans:
+			return
+
+		if self.trace_file:
+			await aiofiles.os.wrap(self._write_sync)(spans)
+
+		if self.trace_otlp and self.session:
+			payload = {
+				'resourceSpans': [ {
+					'resource': { 'attributes': [ { 'key': 'service.name', 'value': { 'stringValue': 'upenwrt' } } ] },
+					'scopeSpans': [ {
+						'scope': { 'name': 'upenwrt' },
+						'spans': [ span.to_otlp() for span in spans ],
+					} ],
+				} ],
+			}
+			async with self.session.post(self.trace_otlp, json=payload) as r:
+				r.raise_for_status()
+
+
+def begin(name, **kwargs):
+	return tracer.begin(name, **kwargs) if tracer else None
+
+
+def end(span, **kwargs):
+	if span is not None:
+		tracer.end(span, **kwargs)
+
+
+@contextmanager
+def span(name, **kwargs):
+	s = begin(name, **kwargs)
+	if s is None:
+		yield None
+		return
+
+	token = current_span.set(s)
+	error = None
+	try:
+		yield s
+	except BaseException as e:
+		error = f'{type(e).__name__}: {e}'
+		raise
+	finally:
+		current_span.reset(token)
+		end(s, error=error)
+
+
+def traced(name):
+	def decorator(fn):
+		@functools.wraps(fn)
+		async def wrapped(*args, **kwargs):
+			with span(name):
+				return await fn(*args, **kwargs)
+		return wrapped
+	return decorator
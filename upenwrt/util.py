@@ -1,17 +1,16 @@
 #!/hint/python3
 
-import os.path as p
 import logging
 import time
 import calendar
+import os
+import os.path as p
+import sys
+import json
 import subprocess
-import requests
 import asyncio
-import aiohttp
-import aiofiles
-import aiofiles.os
 
-from . import wrapio
+from . import tracing
 
 
 class UpenwrtError(Exception):
@@ -22,6 +21,12 @@ class UpenwrtUserError(UpenwrtError):
 	pass
 
 
+class UpenwrtBusyError(UpenwrtError):
+	def __init__(self, *args, retry_after):
+		super().__init__(*args)
+		self.retry_after = retry_after
+
+
 def configure_logging(*, prefix, debug):
 	fmt = '%(levelname)s: %(message)s'
 	kwargs = {}
@@ -38,6 +43,14 @@ def configure_logging(*, prefix, debug):
 	logging.info(f'Logging enabled')
 
 
+def parse_size(s):
+	units = { 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40 }
+	s = s.strip().upper().rstrip('B').rstrip('I')
+	if s and s[-1] in units:
+		return int(float(s[:-1]) * units[s[-1]])
+	return int(s)
+
+
 def get_last_modified(st):
 	return time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(st.st_mtime))
 
@@ -46,56 +59,6 @@ def parse_last_modified(s):
 	return calendar.timegm(time.strptime(s, '%a, %d %b %Y %H:%M:%S GMT'))
 
 
-async def copy_stream(src, dst, chunk_size=256 * 1024):
-	while True:
-		chunk = await src.read(chunk_size)
-		if not chunk:
-			return
-		await dst.write(chunk)
-
-
-aiohttp_session = None
-
-
-async def get_file(url, *args, dest, headers=None, **kwargs):
-	# TODO: what if we just defer to curl(1)?
-	headers = headers or {}
-
-	try:
-		headers.update({
-			'If-Modified-Since': get_last_modified(await aiofiles.os.stat(dest))
-		})
-	except FileNotFoundError as e:
-		logging.info(f'get_file(url={url}, dest={dest}): dest does not exist, proceeding')
-		pass
-
-	# FIXME: find a better owner for aiohttp.ClientSession()
-	global aiohttp_session
-	if not aiohttp_session:
-		aiohttp_session = aiohttp.ClientSession()
-
-	async with aiohttp_session.get(url, *args, **kwargs, headers=headers) as r:
-		r.raise_for_status()
-		if r.status == requests.codes.not_modified:
-			logging.info(f'get_file(url={url}, dest={dest}): not modified')
-			return r
-
-		if r.status == requests.codes.ok and 'If-Modified-Since' in headers and 'Last-Modified' in r.headers:
-			req_mtime = parse_last_modified(headers['If-Modified-Since'])
-			resp_mtime = parse_last_modified(r.headers['Last-Modified'])
-			if resp_mtime <= req_mtime:
-				logging.warning(f'get_file(url={url}, dest={dest}): remote is not new enough (Last-Modified={r.headers["Last-Modified"]}, If-Modified-Since={headers["If-Modified-Since"]})!')
-				return r
-
-		logging.debug(f'get_file(url={url}, dest={dest}): commencing download of {r.content_length} bytes')
-		await wrapio.os_makedirs(p.dirname(dest), exist_ok=True)
-		async with aiofiles.open(dest, 'wb') as f:
-			await copy_stream(src=r.content, dst=f)
-
-		logging.info(f'get_file(url={url}, dest={dest}): downloaded {r.content_length} bytes')
-		return r
-
-
 async def run(args, **kwargs):
 	run_kwargs = {
 		'stdin': asyncio.subprocess.DEVNULL,
@@ -104,10 +67,43 @@ async def run(args, **kwargs):
 	}
 	run_kwargs.update(kwargs)
 
-	process = await asyncio.create_subprocess_exec(
-		*args,
-		**run_kwargs,
-	)
+	span = tracing.begin(p.basename(args[0]), argv=list(args), cwd=run_kwargs.get('cwd'))
+	if span is None:
+		return await _run(args, args, run_kwargs)
+
+	# asyncio reaps its children itself, so have a wrapper collect the rusage for us
+	rusage_r, rusage_w = os.pipe()
+	run_kwargs['pass_fds'] = tuple(run_kwargs.get('pass_fds', ())) + (rusage_w,)
+	error = None
+	process = None
+	try:
+		process = await _run(args, [ sys.executable, '-I', '-S', tracing.RUSAGE_WRAPPER, str(rusage_w), *args ], run_kwargs, started=lambda: os.close(rusage_w))
+		return process
+	except BaseException as e:
+		error = f'{type(e).__name__}: {e}'
+		if isinstance(e, subprocess.CalledProcessError):
+			process = e
+		raise
+	finally:
+		# only read the rusage if the wrapper has exited, never block on it
+		with os.fdopen(rusage_r, 'r') as f:
+			try:
+				rusage = json.loads(f.read()) if process is not None else {}
+			except ValueError:
+				rusage = {}
+		tracing.end(span, error=error, returncode=getattr(process, 'returncode', None), **rusage)
+
+
+async def _run(args, exec_args, run_kwargs, started=None):
+	try:
+		process = await asyncio.create_subprocess_exec(
+			*exec_args,
+			**run_kwargs,
+		)
+	finally:
+		# e. g. close our end of the pipes passed to the child
+		if started:
+			started()
 	logging.debug(f'run({args}): [{process.pid}] started')
 
 	stdout = []
@@ -129,4 +125,5 @@ async def run(args, **kwargs):
 			output='\n'.join(stdout),
 			stderr=None,
 		)
+	process.output = '\n'.join(stdout)
 	return process
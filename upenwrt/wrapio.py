@@ -7,7 +7,17 @@ import shutil
 
 
 os_makedirs = aiofiles.os.wrap(os.makedirs)
+os_open = aiofiles.os.wrap(os.open)
 os_listdir = aiofiles.os.wrap(os.listdir)
+os_stat = aiofiles.os.wrap(os.stat)
+os_fstat = aiofiles.os.wrap(os.fstat)
+os_pread = aiofiles.os.wrap(os.pread)
+os_utime = aiofiles.os.wrap(os.utime)
+os_rename = aiofiles.os.wrap(os.rename)
+os_unlink = aiofiles.os.wrap(os.unlink)
 tempfile_mkdtemp = aiofiles.os.wrap(tempfile.mkdtemp)
 tempfile_mktemp = aiofiles.os.wrap(tempfile.mktemp)
+tempfile_mkstemp = aiofiles.os.wrap(tempfile.mkstemp)
 shutil_rmtree = aiofiles.os.wrap(shutil.rmtree)
+shutil_copyfile = aiofiles.os.wrap(shutil.copyfile)
+builtins_open = aiofiles.os.wrap(open)